@@ -0,0 +1,47 @@
+import importlib
+import os
+import tempfile
+import time
+
+from bench.corpus import build_store
+from bench.llm_server import start_server
+from utils.store import open_store
+
+PROVIDER = os.environ.get("BENCH_PROVIDER", "openai")
+DOCUMENTS = int(os.environ.get("BENCH_DOCUMENTS", 100))
+BATCH_MAX_ITEMS = int(os.environ.get("BENCH_BATCH_MAX_ITEMS", 40))
+
+
+def run_benchmark():
+    server, base_url = start_server(batch_polls=2)
+    with tempfile.TemporaryDirectory() as root:
+        os.environ.pop("OPENAI_API_KEY" if PROVIDER == "anthropic" else "ANTHROPIC_API_KEY", None)
+        os.environ["OPENAI_API_KEY" if PROVIDER == "openai" else "ANTHROPIC_API_KEY"] = "stand-in"
+        os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+        os.environ["ANTHROPIC_BASE_URL"] = base_url
+        os.environ["LLM_CACHE_PATH"] = os.path.join(root, "cache/llm-responses.sqlite")
+
+        build_store(root, DOCUMENTS)
+        parser_l2 = importlib.import_module("parser.parser-l2")
+        parser_l2.store = open_store(root, "files")
+        parser_l2.TELEMETRY_PATH = os.path.join(root, "json/l2-telemetry.jsonl")
+        parser_l2.BATCH_STATE_PATH = os.path.join(root, "json/l2-batches.json")
+        parser_l2.BATCH_MAX_ITEMS = BATCH_MAX_ITEMS
+        parser_l2.BATCH_POLL_SECONDS = 0
+
+        start = time.perf_counter()
+        success_count, error_count = parser_l2.parse_biographies_batch()
+        elapsed = time.perf_counter() - start
+        print(f"[{PROVIDER}] batch mode: {success_count} biographies in {elapsed:.2f}s, {error_count} failed")
+
+        start = time.perf_counter()
+        parser_l2.FORCE_RUN = True
+        success_count, error_count = parser_l2.parse_biographies()
+        elapsed = time.perf_counter() - start
+        print(f"[{PROVIDER}] synchronous re-run from the cache filled by the batch: {elapsed:.2f}s")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,102 @@
+import os
+import time
+from urllib.parse import urljoin
+
+import html2text
+from bs4 import BeautifulSoup
+
+from bench.corpus import biography_corpus
+from crawler import crawler
+
+BASE_URL = "https://mathshistory.st-andrews.ac.uk/Biographies/"
+FIXTURES_DIR = os.environ.get("BENCH_FIXTURES_DIR")
+DOCUMENTS = int(os.environ.get("BENCH_DOCUMENTS", 200))
+
+
+def legacy_render_biography(bio_url, html):
+    while "<!--noindex-->" in html and "<!--endnoindex-->" in html:
+        start = html.find("<!--noindex-->")
+        end = html.find("<!--endnoindex-->", start) + len("<!--endnoindex-->")
+        if end > start:
+            html = html[:start] + html[end:]
+        else:
+            break
+    html = "\n".join(
+        line
+        for line in html.splitlines()
+        if not line.strip().startswith("Written by") and not line.strip().startswith("Last Update")
+    )
+
+    soup = BeautifulSoup(html, "html.parser")
+    meta_tag = soup.new_tag("meta")
+    meta_tag.attrs["charset"] = "utf-8"
+    if soup.head is None:
+        head_tag = soup.new_tag("head")
+        head_tag.append(meta_tag)
+        if soup.html is None:
+            html_tag = soup.new_tag("html")
+            html_tag.append(head_tag)
+            soup.append(html_tag)
+        else:
+            soup.html.insert(0, head_tag)
+    else:
+        soup.head.insert(0, meta_tag)
+    for a in soup.find_all("a", href=True):
+        a["href"] = urljoin(bio_url, a["href"])
+
+    h = html2text.HTML2Text()
+    h.ignore_links = False
+    h.body_width = 0
+    md = h.handle(str(soup)).strip()
+    while "\n\n" in md:
+        md = md.replace("\n\n", "\n")
+    for wrong, correct in crawler.MOJIBAKE.items():
+        md = md.replace(wrong, correct)
+    return md
+
+
+def load_fixtures():
+    if FIXTURES_DIR:
+        for filename in sorted(os.listdir(FIXTURES_DIR)):
+            if filename.endswith(".html"):
+                with open(os.path.join(FIXTURES_DIR, filename), "r", encoding="utf-8") as f:
+                    yield filename[: -len(".html")], f.read()
+    else:
+        yield from biography_corpus(DOCUMENTS)
+
+
+def timed(render, bio_url, html):
+    start = time.process_time()
+    markdown = render(bio_url, html)
+    return markdown, time.process_time() - start
+
+
+def run_benchmark():
+    legacy_times = []
+    new_times = []
+    mismatches = []
+
+    for id, html in load_fixtures():
+        bio_url = f"{BASE_URL}{id}/"
+        expected, legacy_time = timed(legacy_render_biography, bio_url, html)
+        actual, new_time = timed(crawler.render_biography, bio_url, html)
+        legacy_times.append(legacy_time)
+        new_times.append(new_time)
+        if actual != expected:
+            mismatches.append(id)
+
+    pages = len(new_times)
+    legacy_ms = sum(legacy_times) * 1000 / pages
+    new_ms = sum(new_times) * 1000 / pages
+    print(f"Converted {pages} pages")
+    print(f"legacy: {legacy_ms:.2f} ms CPU/page, max {max(legacy_times) * 1000:.2f} ms")
+    print(f"single-pass: {new_ms:.2f} ms CPU/page, max {max(new_times) * 1000:.2f} ms ({legacy_ms / new_ms:.2f}x)")
+    if mismatches:
+        print(f"!!! {len(mismatches)} pages differ from the legacy output: {', '.join(mismatches[:10])}")
+    else:
+        print("Output is byte-identical to the legacy pipeline")
+    return not mismatches
+
+
+if __name__ == "__main__":
+    run_benchmark()
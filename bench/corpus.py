@@ -0,0 +1,192 @@
+import importlib
+import os
+import random
+
+from crawler.crawler import render_biography
+
+PLACES = [
+    ("Basel", "Switzerland"),
+    ("Paris", "France"),
+    ("Göttingen", "Germany"),
+    ("St Petersburg", "Russia"),
+    ("Cambridge", "England"),
+    ("Bologna", "Italy"),
+    ("Kraków", "Poland"),
+    ("Edinburgh", "Scotland"),
+]
+MONTHS = ["January", "March", "April", "June", "September", "November"]
+WORDS = (
+    "theory of numbers algebra geometry analysis calculus series integral equation function mechanics astronomy "
+    "university professor lecture student academy prize memoir treatise correspondence"
+).split()
+TRICKY_FRAGMENTS = [
+    "Poincar&eacute;&nbsp;conjecture &ndash; see also Poincaré",
+    "Smith &amp; Jones - 1900 and x &lt; -1 while y &gt; - 2",
+    "&#233;cole &#8212; &#x41;cad&eacute;mie &copy 1850 &unknown; ok",
+    "MÃ¼nchen, ZÃ¼rich and the GÃ¶ttingen Ã©cole",
+    "<b>bold <i>nested</b> italics</i> then a stray </span> close",
+    "1. not a list &amp; + not a plus",
+]
+
+BIOGRAPHY_TEMPLATE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>{name} ({born} - {died}) - Biography - MacTutor History of Mathematics</title>
+<link rel="stylesheet" href="../../static/css/site.css">
+<script>var page = "{id}"; if (a < b && c) {{ console.log("</p>"); }}</script>
+</head>
+<body>
+<!--noindex-->
+<nav class="navbar"><a href="../../">MacTutor</a> <a href="../">Biographies</a> <a href="../letter-a/">A</a></nav>
+<!--endnoindex-->
+<main class="container">
+<h1>{name}</h1>
+<div class="row"><div class="col-md-3"><a href="pictures/"><img src="thumbnail.jpg" alt="Thumbnail of {name}"></a></div>
+<div class="col-md-9"><h3>Quick Info</h3>
+<dl>
+<dt>Born</dt><dd>{born_day} {born}<br><a href="../../Map/#{born_place}">{born_place}, {born_country}</a></dd>
+<dt>Died</dt><dd>{died_day} {died}<br>{died_place}, {died_country}</dd>
+</dl>
+<h3>Summary</h3>
+<p><strong>{name}</strong> was a mathematician who worked on {topic}.</p>
+</div></div>
+<hr>
+<!--noindex--><div class="share"><a href="https://twitter.com/share">Share</a></div><!--endnoindex-->
+<h3>Biography</h3>
+{paragraphs}
+<h3>References (show)</h3>
+<ol>
+{references}
+</ol>
+<p>Written by J J O'Connor and E F Robertson</p>
+<p>Last Update November 2020</p>
+</main>
+</body>
+</html>
+"""
+
+
+def biography_id(letter, index):
+    return f"{letter.upper()}mathematician{index}"
+
+
+def letter_html(letter, count):
+    links = "\n".join(
+        f'<li><a href="../{biography_id(letter, i)}/">{biography_id(letter, i)}</a></li>' for i in range(count)
+    )
+    return f"""<html><body><a href="../">Index</a> <a href="../letter-b/">B</a>
+<a href="../category-women/">Women</a> <a href="../../chronological/">Chronology</a>
+<ul>
+{links}
+</ul></body></html>"""
+
+
+def paragraph(rng, others, links):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(40, 120))]
+    for _ in range(links):
+        other = rng.choice(others)
+        position = rng.randrange(len(words))
+        words[position] = f'<a href="../{other}/" class="mathlink">{other}</a>'
+    if rng.random() < 0.5:
+        reference = rng.randint(1, 20)
+        words.append(f'<a href="#reference-{reference}">[{reference}]</a>')
+    if rng.random() < 0.3:
+        words.append(rng.choice(TRICKY_FRAGMENTS))
+    return "<p>" + " ".join(words) + "</p>"
+
+
+def biography_html(id, rng=None, paragraphs=12, links_per_paragraph=3, others=None):
+    rng = rng or random.Random(id)
+    others = others or [biography_id(letter, i) for letter in "abc" for i in range(20)]
+    born = rng.randint(1500, 1900)
+    born_place, born_country = rng.choice(PLACES)
+    died_place, died_country = rng.choice(PLACES)
+    references = "\n".join(
+        f'<li id="reference-{i}">A Author, <em>Title {i}</em> (<a href="https://example.org/{i}">link</a>)</li>'
+        for i in range(1, 21)
+    )
+    return BIOGRAPHY_TEMPLATE.format(
+        id=id,
+        name=id.replace("_", " "),
+        born=born,
+        born_day=f"{rng.randint(1, 28)} {rng.choice(MONTHS)}",
+        born_place=born_place,
+        born_country=born_country,
+        died=born + rng.randint(20, 90),
+        died_day=f"{rng.randint(1, 28)} {rng.choice(MONTHS)}",
+        died_place=died_place,
+        died_country=died_country,
+        topic=" ".join(rng.choice(WORDS) for _ in range(6)),
+        paragraphs="\n".join(paragraph(rng, others, links_per_paragraph) for _ in range(paragraphs)),
+        references=references,
+    )
+
+
+def markdown_corpus(count, seed=0, **kwargs):
+    for id, html in biography_corpus(count, seed, **kwargs):
+        yield id, render_biography(f"https://mathshistory.st-andrews.ac.uk/Biographies/{id}/", html)
+
+
+def biography_corpus(count, seed=0, large_every=50, link_heavy_every=25):
+    rng = random.Random(seed)
+    ids = [biography_id(chr(ord("a") + i % 26), i // 26) for i in range(count)]
+    for i, id in enumerate(ids):
+        if large_every and i % large_every == large_every - 1:
+            yield id, biography_html(id, rng, paragraphs=400, others=ids)
+        elif link_heavy_every and i % link_heavy_every == link_heavy_every - 1:
+            yield id, biography_html(id, rng, paragraphs=30, links_per_paragraph=40, others=ids)
+        else:
+            yield id, biography_html(id, rng, others=ids)
+
+
+def build_store(root, count, seed=0):
+    parser_l1 = importlib.import_module("parser.parser-l1")
+    for directory in ("md", "json/l1", "json/l2"):
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    for id, markdown in markdown_corpus(count, seed):
+        with open(os.path.join(root, "md", f"{id}.md"), "w", encoding="utf-8") as f:
+            f.write(markdown)
+        with open(os.path.join(root, "json/l1", f"{id}.json"), "w", encoding="utf-8") as f:
+            f.write(parser_l1.extract_biography_data(id, markdown))
+    return root
+
+
+PROFESSIONS = ["Mathematician", "Astronomer", "Physicist", "Philosopher", "Engineer", "Teacher", "Priest", "Lawyer"]
+RELIGIONS = ["Catholic", "Protestant", "Lutheran", "Jewish", "Anglican", "Orthodox"]
+INSTITUTIONS = [f"University of {place}" for place, _ in PLACES] + ["Académie des Sciences", "Royal Society"]
+CONNECTION_TYPES = ["student of", "teacher of", "collaborated with", "influenced by", "friend of", "rival of"]
+
+
+def l2_document(id, rng, ids):
+    # A merged L2 document as parser-merge leaves it, with connections keyed to other biographies in the corpus
+    born = rng.choice([None] + [rng.randint(1500, 1950)] * 9)
+    died = born + rng.randint(20, 90) if born is not None else rng.choice([None, rng.randint(1550, 2000)])
+    places = [", ".join(place) for place in PLACES]
+    connections = []
+    for key in rng.sample(ids, min(len(ids), rng.randint(2, 25))):
+        connections.append(
+            {"person": key.replace("_", " "), "connection_type": rng.choice(CONNECTION_TYPES), "key": key}
+        )
+    connections += [{"person": "Frederick the Great", "connection_type": "patron"}] * rng.randint(0, 1)
+    return {
+        "id": id,
+        "name": id.replace("_", " "),
+        "summary": f"{id} was a mathematician who worked on {' '.join(rng.choice(WORDS) for _ in range(12))}.",
+        "born": {"year": born, "approx": rng.random() < 0.1, "place": rng.choice(places), "link": None},
+        "died": {"year": died, "approx": rng.random() < 0.1, "place": rng.choice(places), "link": None},
+        "picture": f"https://mathshistory.st-andrews.ac.uk/Biographies/{id}/thumbnail.jpg",
+        "connections": connections,
+        "lived_in": rng.sample(places, rng.randint(1, 4)),
+        "worked_in": rng.sample(places, rng.randint(1, 3)),
+        "religions": rng.choice([None, rng.sample(RELIGIONS, 1)]),
+        "profession": rng.sample(PROFESSIONS, rng.randint(1, 3)),
+        "institution_affiliation": rng.sample(INSTITUTIONS, rng.randint(0, 3)),
+    }
+
+
+def l2_corpus(count, seed=0):
+    rng = random.Random(seed)
+    ids = [biography_id(chr(ord("a") + i % 26), i // 26) for i in range(count)]
+    for id in ids:
+        yield l2_document(id, rng, ids)
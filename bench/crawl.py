@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench.corpus import biography_html, biography_id, letter_html
+from crawler import crawler
+from utils.store import open_store
+
+LETTERS = os.environ.get("BENCH_LETTERS", "abcd")
+BIOS_PER_LETTER = int(os.environ.get("BENCH_BIOS_PER_LETTER", 50))
+LATENCY_MS = int(os.environ.get("BENCH_LATENCY_MS", 50))
+# Index pages are much larger than biographies and slower to serve
+INDEX_LATENCY_MS = int(os.environ.get("BENCH_INDEX_LATENCY_MS", 500))
+CONCURRENCY = int(os.environ.get("BENCH_CONCURRENCY", crawler.CONCURRENCY))
+# Every this many biographies answer 404 the first time they are requested
+FLAKY_EVERY = int(os.environ.get("BENCH_FLAKY_EVERY", 20))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = Counter()
+    first_biography = None
+    lock = threading.Lock()
+    flaky = False
+
+    def do_GET(self):
+        parts = [part for part in self.path.split("/") if part]
+        with self.lock:
+            StandInHandler.requests[self.path] += 1
+            attempt = StandInHandler.requests[self.path]
+            if len(parts) == 2 and not parts[1].startswith("letter-") and parts[1] != "chronological":
+                StandInHandler.first_biography = StandInHandler.first_biography or time.perf_counter()
+        if len(parts) == 2 and parts[1].startswith("letter-"):
+            time.sleep(INDEX_LATENCY_MS / 1000)
+            body = letter_html(parts[1][len("letter-") :], BIOS_PER_LETTER)
+        elif len(parts) == 2 and parts[1] == "chronological":
+            # Every biography again, in a different order, as the chronological listing does
+            time.sleep(INDEX_LATENCY_MS / 1000)
+            ids = [biography_id(letter, i) for i in range(BIOS_PER_LETTER) for letter in LETTERS]
+            body = "<ul>" + "".join(f'<li><a href="../{id}/#born">{id}</a></li>' for id in ids) + "</ul>"
+        elif len(parts) == 2:
+            time.sleep(LATENCY_MS / 1000)
+            if self.flaky and attempt == 1 and sum(map(ord, parts[1])) % FLAKY_EVERY == 0:
+                self.send_error(404)
+                return
+            body = biography_html(parts[1])
+        else:
+            self.send_error(404)
+            return
+        payload = body.encode("utf-8")
+        etag = f'"{hashlib.sha256(payload).hexdigest()[:16]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def reset_requests():
+    StandInHandler.requests = Counter()
+    StandInHandler.first_biography = None
+
+
+def biography_requests():
+    return sum(
+        count
+        for path, count in StandInHandler.requests.items()
+        if "letter-" not in path and "chronological" not in path
+    )
+
+
+def point_at(root):
+    crawler.store = open_store(root)
+    crawler.MANIFEST_PATH = os.path.join(root, "crawl-manifest.json")
+    crawler.FRONTIER_PATH = os.path.join(root, "crawl-frontier.sqlite")
+    crawler.ARCHIVE_DIR = os.path.join(root, "archive")
+
+
+async def discover_then_fetch(base_url):
+    # The previous crawl: every index page first, then the biographies
+    throttle = crawler.HostThrottle(concurrency=min(CONCURRENCY, crawler.HOST_CONCURRENCY))
+    async with crawler.create_client(CONCURRENCY) as client:
+        letter_urls = [f"{base_url}letter-{letter}/" for letter in LETTERS]
+        pages = await asyncio.gather(*(crawler.fetch_html(client, throttle, url) for url in letter_urls))
+        urls = [link for url, html in zip(letter_urls, pages) for link in crawler.get_biography_links(url, html)]
+        await asyncio.gather(*(crawler.process_biography(client, throttle, url, {}) for url in urls))
+
+
+async def interrupted_crawl(base_url, stop_after):
+    task = asyncio.create_task(crawler.crawl_biographies_async(base_url, list(LETTERS), CONCURRENCY))
+    while biography_requests() < stop_after and not task.done():
+        await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def run_benchmark():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    # Requests cancelled by the interrupted crawl would print broken pipe tracebacks
+    server.handle_error = lambda request, client_address: None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/Biographies/"
+    biographies = len(LETTERS) * BIOS_PER_LETTER
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        point_at(output_dir)
+        for run in ("cold", "conditional"):
+            reset_requests()
+            start = time.perf_counter()
+            success_count, error_count = crawler.crawl_biographies(base_url, list(LETTERS), CONCURRENCY)
+            elapsed = time.perf_counter() - start
+            pages = success_count + error_count + len(LETTERS)
+            print(
+                f"[{run}] Fetched {pages} pages in {elapsed:.2f}s ({pages / elapsed:.1f} pages/sec), first biography "
+                f"requested after {StandInHandler.first_biography - start:.2f}s"
+            )
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        point_at(output_dir)
+        reset_requests()
+        start = time.perf_counter()
+        asyncio.run(discover_then_fetch(base_url))
+        elapsed = time.perf_counter() - start
+        print(
+            f"[discover then fetch] {biographies + len(LETTERS)} pages in {elapsed:.2f}s, first biography requested "
+            f"after {StandInHandler.first_biography - start:.2f}s"
+        )
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        point_at(output_dir)
+        reset_requests()
+        asyncio.run(interrupted_crawl(base_url, biographies // 2))
+        before = biography_requests()
+        success_count, error_count = crawler.crawl_biographies(base_url, list(LETTERS), CONCURRENCY)
+        fetched_twice = sum(count > 1 for path, count in StandInHandler.requests.items() if "letter-" not in path)
+        print(
+            f"[interrupted] {before} biography requests before the interruption, {biography_requests() - before} "
+            f"after resuming, {fetched_twice} biographies fetched twice (requests in flight when interrupted), "
+            f"{len(crawler.load_manifest())} in the manifest"
+        )
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        point_at(output_dir)
+        reset_requests()
+        StandInHandler.flaky = True
+        success_count, error_count = crawler.crawl_biographies(
+            base_url, list(LETTERS), CONCURRENCY, sections=["letters", "chronological"]
+        )
+        StandInHandler.flaky = False
+        counts = crawler.Frontier(crawler.FRONTIER_PATH).counts()
+        print(
+            f"[letters and chronological, flaky] {success_count} succeeded, {error_count} failed, "
+            f"{biography_requests()} biography requests for {biographies} biographies "
+            f"({sum(count > 1 for count in StandInHandler.requests.values())} re-queued after a 404), "
+            f"frontier {dict(sorted(counts.items()))}"
+        )
+
+    server.shutdown()
+    print(f"Latency {LATENCY_MS}ms (index pages {INDEX_LATENCY_MS}ms), concurrency {CONCURRENCY}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,83 @@
+import gzip
+import importlib
+import json
+import os
+import tempfile
+import time
+
+from bench.corpus import l2_corpus
+
+exporter = importlib.import_module("export.exporter")
+
+DOCUMENTS = int(os.environ.get("BENCH_DOCUMENTS", 3000))
+YEAR_RANGES = [(1700, 1799), (1600, 1899), (1500, 2000)]
+
+
+def firestore_view(documents, min_year, max_year):
+    # What the app's range queries return for a year range: documents read and their JSON size
+    view = [
+        document for document in documents if min_year <= (exporter.estimated_birth_year(document) or -1) <= max_year
+    ]
+    return len(view), sum(len(json.dumps(document, ensure_ascii=False).encode("utf-8")) for document in view)
+
+
+def bundle_view(index, min_year, max_year):
+    # The index plus every shard overlapping the range, one request each
+    shards = [
+        shard
+        for shard in index["shards"]
+        if shard["from"] is not None and shard["from"] <= max_year and shard["to"] >= min_year
+    ]
+    return 1 + len(shards), sum(shard["bytes"] for shard in shards)
+
+
+def check_bundle(index, documents):
+    # Every document must be rebuilt from the bundle with its fields and resolved connections intact
+    by_id = {document["id"]: document for document in documents}
+    mismatches = 0
+    for shard in index["shards"]:
+        with open(os.path.join(exporter.EXPORT_DIR, shard["file"]), "rb") as f:
+            payload = json.loads(gzip.decompress(f.read()))
+        for offset in range(shard["count"]):
+            position = shard["start"] + offset
+            document = by_id[index["nodes"]["id"][position]]
+            for field in exporter.LIST_FIELDS:
+                values = [index["strings"][value] for value in payload["nodes"][field][offset]]
+                mismatches += values != (document.get(field) or [])
+            place = payload["nodes"]["born_place"][offset]
+            mismatches += index["strings"][place] != document["born"]["place"]
+            targets = {
+                index["nodes"]["id"][target]
+                for source, target in zip(payload["edges"]["source"], payload["edges"]["target"])
+                if source == position and target != -1
+            }
+            mismatches += targets != {
+                connection["key"] for connection in document["connections"] if "key" in connection
+            }
+    return mismatches
+
+
+def run_benchmark():
+    documents = list(l2_corpus(DOCUMENTS))
+    with tempfile.TemporaryDirectory() as root:
+        exporter.EXPORT_DIR = root
+        start = time.perf_counter()
+        index, stats = exporter.export_bundle(documents, locations={})
+        elapsed = time.perf_counter() - start
+        mismatches = check_bundle(index, documents)
+
+    print(f"\n{DOCUMENTS} biographies exported in {elapsed:.2f}s, {len(index['shards'])} shards")
+    print(f"documents differing after a round trip: {mismatches}")
+    print(f"{'years':<12} {'reads':>6} {'firestore KiB':>14} {'requests':>9} {'bundle KiB':>11} {'ratio':>7}")
+    for min_year, max_year in YEAR_RANGES:
+        reads, raw_bytes = firestore_view(documents, min_year, max_year)
+        requests, shard_bytes = bundle_view(index, min_year, max_year)
+        bundle_bytes = shard_bytes + stats["index_bytes"]
+        print(
+            f"{min_year}-{max_year:<7} {reads:>6} {raw_bytes / 1024:>14.0f} {requests:>9} "
+            f"{bundle_bytes / 1024:>11.0f} {raw_bytes / bundle_bytes:>6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    run_benchmark()
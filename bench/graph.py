@@ -0,0 +1,147 @@
+import importlib
+import os
+import random
+import time
+import tracemalloc
+
+from bench.corpus import l2_corpus
+
+DOCUMENTS = int(os.environ.get("BENCH_DOCUMENTS", 10000))
+LINEAGE_QUERIES = int(os.environ.get("BENCH_LINEAGE_QUERIES", 200))
+
+graph_module = importlib.import_module("graph.graph")
+
+
+def dict_graph(documents):
+    # What a global analysis looks like over the documents as loaded: an id-keyed dict of connection lists
+    ids = {document["id"] for document in documents}
+    return {
+        document["id"]: [
+            (connection["key"], graph_module.connection_type(connection))
+            for connection in document["connections"]
+            if connection.get("key") in ids and connection["key"] != document["id"]
+        ]
+        for document in documents
+    }
+
+
+def dict_pagerank(adjacency):
+    count = len(adjacency)
+    rank = dict.fromkeys(adjacency, 1 / count)
+    for _ in range(graph_module.MAX_ITERATIONS):
+        dangling = sum(rank[id] for id, edges in adjacency.items() if not edges)
+        updated = dict.fromkeys(adjacency, (1 - graph_module.DAMPING + graph_module.DAMPING * dangling) / count)
+        for id, edges in adjacency.items():
+            for target, _ in edges:
+                updated[target] += graph_module.DAMPING * rank[id] / len(edges)
+        change = sum(abs(updated[id] - rank[id]) for id in adjacency)
+        rank = updated
+        if change < graph_module.TOLERANCE:
+            break
+    return rank
+
+
+def dict_components(adjacency):
+    undirected = {id: set() for id in adjacency}
+    for id, edges in adjacency.items():
+        for target, _ in edges:
+            undirected[id].add(target)
+            undirected[target].add(id)
+    sizes = []
+    seen = set()
+    for id in adjacency:
+        if id in seen:
+            continue
+        stack = [id]
+        seen.add(id)
+        size = 0
+        while stack:
+            node = stack.pop()
+            size += 1
+            for neighbour in undirected[node]:
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    stack.append(neighbour)
+        sizes.append(size)
+    return sorted(sizes, reverse=True)
+
+
+def dict_lineage_length(adjacency, student, ancestor):
+    teachers = {id: [] for id in adjacency}
+    for id, edges in adjacency.items():
+        for target, edge_type in edges:
+            if edge_type == graph_module.STUDENT_OF:
+                teachers[id].append(target)
+            elif edge_type == graph_module.TEACHER_OF:
+                teachers[target].append(id)
+    distances = {student: 0}
+    queue = [student]
+    for node in queue:
+        for teacher in teachers[node]:
+            if teacher not in distances:
+                distances[teacher] = distances[node] + 1
+                queue.append(teacher)
+    return distances.get(ancestor)
+
+
+def measured(function, *args):
+    # Timed on its own, then run again under tracemalloc, which slows allocation down too much to time
+    start = time.perf_counter()
+    value = function(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, elapsed, peak
+
+
+def run_benchmark():
+    rng = random.Random(0)
+    documents = list(l2_corpus(DOCUMENTS))
+
+    graph, build_elapsed, build_peak = measured(graph_module.build_graph, documents)
+    (nodes, sizes), analyse_elapsed, analyse_peak = measured(graph.analyse)
+    adjacency, dict_build_elapsed, dict_build_peak = measured(dict_graph, documents)
+
+    start = time.perf_counter()
+    expected_rank = dict_pagerank(adjacency)
+    expected_sizes = dict_components(adjacency)
+    dict_analyse_elapsed = time.perf_counter() - start
+
+    scale = graph.count
+    rank_error = max(abs(nodes["rank"][graph.node(id)] - value * scale) for id, value in expected_rank.items())
+    pairs = [(rng.choice(graph.ids), rng.choice(graph.ids)) for _ in range(LINEAGE_QUERIES)]
+    start = time.perf_counter()
+    paths = [graph.lineage(student, ancestor) for student, ancestor in pairs]
+    lineage_elapsed = (time.perf_counter() - start) / len(pairs)
+    lineage_mismatches = sum(
+        (len(path) - 1 if path else None) != dict_lineage_length(adjacency, student, ancestor)
+        for path, (student, ancestor) in zip(paths, pairs)
+    )
+    start = time.perf_counter()
+    reached = [len(graph.neighbourhood(id, 2)) for id, _ in pairs[:50]]
+    neighbourhood_elapsed = (time.perf_counter() - start) / 50
+
+    print(f"\n{graph.count} people, {graph.edges} connections, {len(graph.types)} connection types")
+    print(
+        f"CSR build: {build_elapsed:.2f}s, {graph.nbytes() / 1024 / 1024:.1f} MiB of arrays, "
+        f"peak {build_peak / 1024 / 1024:.1f} MiB"
+    )
+    print(f"dict build: {dict_build_elapsed:.2f}s, {dict_build_peak / 1024 / 1024:.1f} MiB")
+    print(
+        f"analysis (pagerank, degrees, components, generations): {analyse_elapsed * 1000:.0f}ms, "
+        f"peak {analyse_peak / 1024 / 1024:.1f} MiB"
+    )
+    print(f"dict-based pagerank and components: {dict_analyse_elapsed * 1000:.0f}ms")
+    print(f"largest rank difference from the dict-based pagerank: {rank_error:.2e}")
+    print(f"component sizes match the dict-based search: {sizes == expected_sizes}")
+    print(f"lineage queries: {lineage_elapsed * 1000:.2f}ms each, {lineage_mismatches} of {len(pairs)} mismatched")
+    print(
+        f"2-hop neighbourhoods: {neighbourhood_elapsed * 1000:.2f}ms each, "
+        f"{sum(reached) / len(reached):.0f} people on average"
+    )
+
+
+if __name__ == "__main__":
+    run_benchmark()
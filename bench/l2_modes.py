@@ -0,0 +1,126 @@
+import asyncio
+import importlib
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from bench.corpus import build_store
+from bench.llm_server import start_server
+from utils.store import open_store
+
+PROVIDER = os.environ.get("BENCH_PROVIDER", "openai")
+DOCUMENTS = int(os.environ.get("BENCH_DOCUMENTS", 20))
+LATENCY_MS = int(os.environ.get("BENCH_LATENCY_MS", 300))
+OUTPUT_TOKEN_MS = float(os.environ.get("BENCH_OUTPUT_TOKEN_MS", 2))
+FIXTURES_DIR = os.environ.get("BENCH_FIXTURES_DIR")
+LIVE = os.environ.get("BENCH_LIVE", "").lower() in ("1", "true", "yes")
+MODES = os.environ.get("BENCH_MODES", "sequential,concurrent,combined").split(",")
+
+
+def configure_environment(root, base_url):
+    if not LIVE:
+        os.environ.pop("OPENAI_API_KEY" if PROVIDER == "anthropic" else "ANTHROPIC_API_KEY", None)
+        os.environ["OPENAI_API_KEY" if PROVIDER == "openai" else "ANTHROPIC_API_KEY"] = "stand-in"
+        os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+        os.environ["ANTHROPIC_BASE_URL"] = base_url
+        os.environ["LLM_RPM"] = "0"
+        os.environ["LLM_TPM"] = "0"
+    os.environ["LLM_CACHE_PATH"] = os.path.join(root, "cache/llm-responses.sqlite")
+    os.environ["LLM_CACHE_BYPASS"] = "1"
+
+
+def load_fixtures(parser_l2, store):
+    parser_l2.store = store
+    filenames = sorted(parser_l2.list_biographies())[:DOCUMENTS]
+    return [(filename, *parser_l2.read_inputs(filename)) for filename in filenames]
+
+
+async def run_mode(llm, parser_l2, mode, fixtures):
+    records = {}
+    async with llm.AsyncLLMClient() as client:
+        for filename, markdown_text, l1_data in fixtures:
+            usage_before = (client.requests, client.input_tokens, client.output_tokens)
+            start = time.perf_counter()
+            result = await parser_l2.extract_biography_data(client, markdown_text, l1_data, mode)
+            elapsed = time.perf_counter() - start
+            requests, input_tokens, output_tokens = (
+                after - before
+                for after, before in zip((client.requests, client.input_tokens, client.output_tokens), usage_before)
+            )
+            records[filename] = {
+                "latency": elapsed,
+                "requests": requests,
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "result": json.loads(result) if result else None,
+            }
+    return records
+
+
+def normalize(field, value):
+    if field == "connections":
+        return {
+            (str(connection.get("person", "")).lower(), str(connection.get("connection_type", "")).lower())
+            for connection in value or []
+            if isinstance(connection, dict)
+        }
+    if isinstance(value, list):
+        return {str(item).strip().lower() for item in value}
+    return value
+
+
+def field_agreement(fields, baseline, records):
+    agreement = {}
+    for field in fields:
+        compared = [
+            normalize(field, baseline[filename]["result"].get(field)) == normalize(field, record["result"].get(field))
+            for filename, record in records.items()
+            if record["result"] and baseline[filename]["result"]
+        ]
+        agreement[field] = sum(compared) / len(compared) if compared else 0
+    return agreement
+
+
+def report(parser_l2, results):
+    fields = (*parser_l2.BIO_FIELDS, "connections")
+    baseline_mode = MODES[0]
+    print(f"\n{len(next(iter(results.values())))} biographies, agreement measured against {baseline_mode}")
+    print(
+        f"{'mode':<12}{'ok':>5}{'p50 s':>8}{'mean s':>8}{'req/item':>10}{'in tok/item':>13}{'out tok/item':>14}"
+        f"{'agreement':>11}  lowest field"
+    )
+    for mode, records in results.items():
+        succeeded = [record for record in records.values() if record["result"]]
+        latencies = [record["latency"] for record in records.values()]
+        count = len(records)
+        agreement = field_agreement(fields, results[baseline_mode], records)
+        lowest = min(agreement, key=agreement.get)
+        print(
+            f"{mode:<12}{len(succeeded):>5}{statistics.median(latencies):>8.2f}{statistics.mean(latencies):>8.2f}"
+            f"{sum(record['requests'] for record in records.values()) / count:>10.2f}"
+            f"{sum(record['input_tokens'] for record in records.values()) / count:>13.0f}"
+            f"{sum(record['output_tokens'] for record in records.values()) / count:>14.0f}"
+            f"{statistics.mean(agreement.values()):>11.1%}  {lowest} ({agreement[lowest]:.1%})"
+        )
+
+
+def run_benchmark():
+    server, base_url = (None, None) if LIVE else start_server(latency_ms=LATENCY_MS, output_token_ms=OUTPUT_TOKEN_MS)
+    with tempfile.TemporaryDirectory() as root:
+        configure_environment(root, base_url)
+        llm = importlib.import_module("utils.llm")
+        parser_l2 = importlib.import_module("parser.parser-l2")
+        fixtures = load_fixtures(
+            parser_l2, open_store(FIXTURES_DIR) if FIXTURES_DIR else open_store(build_store(root, DOCUMENTS), "files")
+        )
+        results = {mode: asyncio.run(run_mode(llm, parser_l2, mode, fixtures)) for mode in MODES}
+        report(parser_l2, results)
+
+    if server:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,73 @@
+import functools
+import importlib
+import os
+import tempfile
+import time
+
+from bench.corpus import build_store
+from bench.llm_server import StandInLLMHandler, start_server
+from utils.store import open_store
+
+PROVIDER = os.environ.get("BENCH_PROVIDER", "openai")
+DOCUMENTS = int(os.environ.get("BENCH_DOCUMENTS", 200))
+LATENCY_MS = int(os.environ.get("BENCH_LATENCY_MS", 300))
+SERVER_RPM = int(os.environ.get("BENCH_SERVER_RPM", 3000))
+RATE_LIMIT_RATIO = float(os.environ.get("BENCH_RATE_LIMIT_RATIO", 0.02))
+CLIENT_RPMS = [int(rpm) for rpm in os.environ.get("BENCH_CLIENT_RPMS", "3000,100000").split(",")]
+# Share of requests answered with a 500, and of connections dropped without a response, in the transient error run
+ERROR_RATIO = float(os.environ.get("BENCH_ERROR_RATIO", 0.01))
+
+
+def configure_environment(root, base_url):
+    os.environ.pop("OPENAI_API_KEY" if PROVIDER == "anthropic" else "ANTHROPIC_API_KEY", None)
+    os.environ["OPENAI_API_KEY" if PROVIDER == "openai" else "ANTHROPIC_API_KEY"] = "stand-in"
+    os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+    os.environ["ANTHROPIC_BASE_URL"] = base_url
+    os.environ["LLM_CACHE_PATH"] = os.path.join(root, "cache/llm-responses.sqlite")
+    os.environ["LLM_CACHE_BYPASS"] = "1"
+
+
+def run_benchmark():
+    server, base_url = start_server(
+        latency_ms=LATENCY_MS, rate_limit_ratio=RATE_LIMIT_RATIO, requests_per_minute=SERVER_RPM
+    )
+    with tempfile.TemporaryDirectory() as root:
+        configure_environment(root, base_url)
+        build_store(root, DOCUMENTS)
+        llm = importlib.import_module("utils.llm")
+        parser_l2 = importlib.import_module("parser.parser-l2")
+        parser_l2.store = open_store(root, "files")
+        parser_l2.TELEMETRY_PATH = os.path.join(root, "json/l2-telemetry.jsonl")
+        parser_l2.FORCE_RUN = True
+
+        results = []
+        for client_rpm in CLIENT_RPMS:
+            parser_l2.AsyncLLMClient = functools.partial(llm.AsyncLLMClient, requests_per_minute=client_rpm)
+            start = time.perf_counter()
+            success_count, error_count = parser_l2.parse_biographies()
+            elapsed = time.perf_counter() - start
+            results.append((client_rpm, success_count, error_count, elapsed))
+
+        # Transient errors are retried with backoff instead of failing the biography
+        StandInLLMHandler.server_error_ratio = StandInLLMHandler.drop_ratio = ERROR_RATIO
+        parser_l2.AsyncLLMClient = functools.partial(llm.AsyncLLMClient, requests_per_minute=SERVER_RPM)
+        start = time.perf_counter()
+        transient = (*parser_l2.parse_biographies(), time.perf_counter() - start)
+
+    server.shutdown()
+    print(f"\nServer ceiling {SERVER_RPM} requests/min, latency {LATENCY_MS}ms, random 429 ratio {RATE_LIMIT_RATIO}")
+    for client_rpm, success_count, error_count, elapsed in results:
+        requests_per_minute = success_count * 2 / elapsed * 60
+        print(
+            f"client budget {client_rpm:>7} rpm: {success_count} biographies in {elapsed:.2f}s "
+            f"({requests_per_minute:.0f} requests/min), {error_count} failed"
+        )
+    success_count, error_count, elapsed = transient
+    print(
+        f"with {StandInLLMHandler.injected['server_error']} injected 500s and {StandInLLMHandler.injected['dropped']} "
+        f"dropped connections: {success_count} biographies in {elapsed:.2f}s, {error_count} failed"
+    )
+
+
+if __name__ == "__main__":
+    run_benchmark()
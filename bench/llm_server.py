@@ -0,0 +1,306 @@
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONNECTIONS_PATTERN = re.compile(r"following connections:\n\[(.*?)\]")
+# Message Batches rejects the whole batch when any custom_id falls outside this pattern
+ANTHROPIC_CUSTOM_ID_PATTERN = re.compile(r"^[a-zA-Z0-9_-]{1,64}$")
+
+
+def extraction_answer(prompt):
+    answer = {}
+    if "lived_in" in prompt:
+        answer.update(
+            lived_in=["Basel", "St Petersburg"],
+            worked_in=["Berlin"],
+            religions=None,
+            profession=["mathematician"],
+            institution_affiliation=["Academy of Sciences"],
+        )
+    connections = CONNECTIONS_PATTERN.search(prompt)
+    if connections is not None:
+        people = [person.strip() for person in connections.group(1).split(",") if person.strip()]
+        answer["connections"] = [
+            {"person": person.replace("_", " "), "connection_type": "student of"} for person in people
+        ]
+    return answer
+
+
+def chat_completion(body):
+    prompt = "\n".join(message["content"] for message in body["messages"])
+    answer = json.dumps(extraction_answer(prompt))
+    return {
+        "id": "chatcmpl-stand-in",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": len(prompt) // 4,
+            "completion_tokens": len(answer) // 4,
+            "total_tokens": len(prompt) // 4 + len(answer) // 4,
+        },
+    }
+
+
+def anthropic_message(params):
+    prompt = "\n".join(message["content"] for message in params["messages"])
+    answer = json.dumps(extraction_answer(prompt))
+    return {
+        "id": "msg_stand_in",
+        "type": "message",
+        "role": "assistant",
+        "model": params["model"],
+        "content": [{"type": "text", "text": answer}],
+        "stop_reason": "end_turn",
+        "usage": {"input_tokens": len(prompt) // 4, "output_tokens": len(answer) // 4},
+    }
+
+
+class StandInLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency_ms = 0
+    output_token_ms = 0.0
+    rate_limit_ratio = 0.0
+    server_error_ratio = 0.0
+    drop_ratio = 0.0
+    injected = Counter()
+    requests_per_minute = 0
+    request_times = []
+    batch_polls = 2
+    files = {}
+    batches = {}
+    ids = itertools.count(1)
+    lock = threading.Lock()
+
+    def send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, text):
+        body = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/jsonl; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def next_id(self, prefix):
+        with self.lock:
+            return f"{prefix}{next(self.ids)}"
+
+    def over_ceiling(self):
+        # Sliding one-second window holding a sixtieth of the per-minute ceiling
+        if not self.requests_per_minute:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            while self.request_times and self.request_times[0] <= now - 1:
+                self.request_times.pop(0)
+            if len(self.request_times) >= max(1, self.requests_per_minute // 60):
+                return self.request_times[0] + 1 - now
+            self.request_times.append(now)
+            return 0
+
+    def rate_limited(self):
+        retry_after = self.over_ceiling()
+        if not retry_after and random.random() >= self.rate_limit_ratio:
+            return False
+        error = {"error": {"type": "rate_limit_error", "code": "rate_limit_exceeded", "message": "Rate limited"}}
+        self.send_json(error, status=429, headers={"retry-after": f"{max(retry_after, 0.1):.3f}"})
+        return True
+
+    def failed(self):
+        # Transient failures: a 500, or the connection closed without any response
+        roll = random.random()
+        if roll < self.drop_ratio:
+            with self.lock:
+                self.injected["dropped"] += 1
+            self.close_connection = True
+            return True
+        if roll < self.drop_ratio + self.server_error_ratio:
+            with self.lock:
+                self.injected["server_error"] += 1
+            error = {"type": "error", "error": {"type": "api_error", "message": "Internal server error"}}
+            self.send_json(error, status=500)
+            return True
+        return False
+
+    def generate(self, output_tokens):
+        # Decoding time grows with the response length on top of the fixed latency
+        time.sleep(output_tokens * self.output_token_ms / 1000)
+
+    def do_POST(self):
+        time.sleep(self.latency_ms / 1000)
+        body = self.read_body()
+        if self.path == "/v1/chat/completions":
+            if not self.failed() and not self.rate_limited():
+                completion = chat_completion(json.loads(body))
+                self.generate(completion["usage"]["completion_tokens"])
+                self.send_json(completion)
+        elif self.path == "/v1/messages":
+            if not self.failed() and not self.rate_limited():
+                message = anthropic_message(json.loads(body))
+                self.generate(message["usage"]["output_tokens"])
+                self.send_json(message)
+        elif self.path == "/v1/files":
+            self.create_file(body)
+        elif self.path == "/v1/batches":
+            self.create_openai_batch(json.loads(body))
+        elif self.path == "/v1/messages/batches":
+            self.create_anthropic_batch(json.loads(body))
+        else:
+            self.send_json({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+
+    def do_GET(self):
+        parts = [part for part in self.path.split("/") if part]
+        if parts[:2] == ["v1", "batches"] and len(parts) == 3:
+            self.send_json(self.poll_batch(parts[2]))
+        elif parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content":
+            self.send_text(self.files[parts[2]])
+        elif parts[:3] == ["v1", "messages", "batches"] and len(parts) == 4:
+            self.send_json(self.poll_batch(parts[3]))
+        elif parts[:3] == ["v1", "messages", "batches"] and len(parts) == 5 and parts[4] == "results":
+            self.send_text(self.anthropic_results(parts[3]))
+        else:
+            self.send_json({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+
+    def create_file(self, body):
+        message = BytesParser(policy=policy.default).parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + body
+        )
+        content = ""
+        for part in message.iter_parts():
+            if part.get_param("name", header="content-disposition") == "file":
+                content = part.get_payload(decode=True).decode("utf-8")
+        file_id = self.next_id("file-")
+        self.files[file_id] = content
+        self.send_json(
+            {
+                "id": file_id,
+                "object": "file",
+                "bytes": len(content),
+                "created_at": int(time.time()),
+                "filename": "batch.jsonl",
+                "purpose": "batch",
+                "status": "processed",
+            }
+        )
+
+    def create_openai_batch(self, body):
+        batch_id = self.next_id("batch_")
+        self.batches[batch_id] = {
+            "kind": "openai",
+            "polls": 0,
+            "requests": [json.loads(line) for line in self.files[body["input_file_id"]].splitlines() if line],
+            "payload": {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": body["endpoint"],
+                "input_file_id": body["input_file_id"],
+                "completion_window": body["completion_window"],
+                "created_at": int(time.time()),
+                "status": "in_progress",
+                "output_file_id": None,
+                "error_file_id": None,
+            },
+        }
+        self.send_json(self.batches[batch_id]["payload"])
+
+    def create_anthropic_batch(self, body):
+        invalid = [
+            request["custom_id"]
+            for request in body["requests"]
+            if not ANTHROPIC_CUSTOM_ID_PATTERN.match(request["custom_id"])
+        ]
+        if invalid:
+            error = {"message": f"requests.custom_id: invalid value {invalid[0]!r}", "type": "invalid_request_error"}
+            self.send_json({"type": "error", "error": error}, status=400)
+            return
+        batch_id = self.next_id("msgbatch_")
+        self.batches[batch_id] = {
+            "kind": "anthropic",
+            "polls": 0,
+            "requests": body["requests"],
+            "payload": {
+                "id": batch_id,
+                "type": "message_batch",
+                "processing_status": "in_progress",
+                "results_url": None,
+            },
+        }
+        self.send_json(self.batches[batch_id]["payload"])
+
+    def poll_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        batch["polls"] += 1
+        payload = batch["payload"]
+        if batch["polls"] < self.batch_polls:
+            return payload
+        if batch["kind"] == "openai" and payload["status"] != "completed":
+            lines = [
+                {
+                    "id": f"response-{i}",
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": chat_completion(request["body"])},
+                    "error": None,
+                }
+                for i, request in enumerate(batch["requests"])
+            ]
+            output_file_id = self.next_id("file-")
+            self.files[output_file_id] = "".join(json.dumps(line) + "\n" for line in lines)
+            payload.update(status="completed", output_file_id=output_file_id)
+        elif batch["kind"] == "anthropic":
+            host = f"http://{self.headers['Host']}"
+            payload.update(processing_status="ended", results_url=f"{host}/v1/messages/batches/{batch_id}/results")
+        return payload
+
+    def anthropic_results(self, batch_id):
+        lines = [
+            {
+                "custom_id": request["custom_id"],
+                "result": {"type": "succeeded", "message": anthropic_message(request["params"])},
+            }
+            for request in self.batches[batch_id]["requests"]
+        ]
+        return "".join(json.dumps(line) + "\n" for line in lines)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(
+    latency_ms=0,
+    rate_limit_ratio=0.0,
+    batch_polls=2,
+    requests_per_minute=0,
+    output_token_ms=0.0,
+    server_error_ratio=0.0,
+    drop_ratio=0.0,
+):
+    StandInLLMHandler.latency_ms = latency_ms
+    StandInLLMHandler.server_error_ratio = server_error_ratio
+    StandInLLMHandler.drop_ratio = drop_ratio
+    StandInLLMHandler.output_token_ms = output_token_ms
+    StandInLLMHandler.rate_limit_ratio = rate_limit_ratio
+    StandInLLMHandler.requests_per_minute = requests_per_minute
+    StandInLLMHandler.batch_polls = batch_polls
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInLLMHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
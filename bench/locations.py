@@ -0,0 +1,107 @@
+import importlib
+import json
+import os
+import random
+import re
+import tempfile
+import time
+
+from bench.corpus import PLACES, l2_corpus
+from utils.store import open_store
+
+parser_locations = importlib.import_module("parser.parser-locations")
+
+DOCUMENTS = int(os.environ.get("BENCH_DOCUMENTS", 3000))
+FILTERS = int(os.environ.get("BENCH_FILTERS", 200))
+SELECTED = int(os.environ.get("BENCH_SELECTED", 3))
+
+
+def place_variant(rng, place):
+    # The spellings MacTutor and the model produce for the same place
+    city, country = place.split(", ")
+    roll = rng.random()
+    if roll < 0.15:
+        return city
+    if roll < 0.2:
+        return f"{city} (now {country})"
+    if roll < 0.25:
+        return f"{city}, Old {country} (now {city}, {country})"
+    return place
+
+
+def build_documents(store, count):
+    rng = random.Random(0)
+    documents = []
+    for document in l2_corpus(count):
+        for field in ("born", "died"):
+            document[field]["place"] = place_variant(rng, document[field]["place"])
+        for field in parser_locations.PLACE_FIELDS:
+            document[field] = [place_variant(rng, place) for place in document[field]]
+        documents.append((document["id"], store.dump(document)))
+    store.put_many("l2", documents)
+
+
+def location_parts(location):
+    return [re.sub(r"[()]", "", part.strip()).lower() for part in re.split(r",\s*", location)]
+
+
+def app_filter(documents, locations):
+    # The app's client-side location filter, splitting and cross-comparing every place on every filter change
+    matched = []
+    for document in documents:
+        places = [*(document.get("lived_in") or []), *(document.get("worked_in") or [])]
+        places += [place for place in (document["born"].get("place"), document["died"].get("place")) if place]
+        if any(
+            place == location
+            or any(part in location_parts(location) for part in location_parts(place))
+            or any(part in location_parts(place) for part in location_parts(location))
+            for location in locations
+            for place in places
+        ):
+            matched.append(document["id"])
+    return matched
+
+
+def indexed_filter(index, location_ids):
+    matched = set()
+    for location_id in location_ids:
+        matched.update(index.get(location_id, ()))
+    return matched
+
+
+def run_benchmark():
+    with tempfile.TemporaryDirectory() as root:
+        parser_locations.store = open_store(root)
+        parser_locations.LOCATIONS_PATH = os.path.join(root, "locations.json")
+        build_documents(parser_locations.store, DOCUMENTS)
+        start = time.perf_counter()
+        table, index = parser_locations.build_location_index()
+        build_elapsed = time.perf_counter() - start
+        documents = [json.loads(content) for _, content in parser_locations.store.items("l2")]
+
+    rng = random.Random(1)
+    countries = sorted({country for _, country in PLACES})
+    selections = [rng.sample(countries, SELECTED) for _ in range(FILTERS)]
+
+    start = time.perf_counter()
+    app_matches = [set(app_filter(documents, selection)) for selection in selections]
+    app_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed_matches = [
+        indexed_filter(index, [parser_locations.slug(country) for country in selection]) for selection in selections
+    ]
+    indexed_elapsed = time.perf_counter() - start
+
+    missed_by_app = sum(len(indexed - app) for app, indexed in zip(app_matches, indexed_matches))
+    missed_by_index = sum(len(app - indexed) for app, indexed in zip(app_matches, indexed_matches))
+    print(f"\n{DOCUMENTS} documents, {len(table)} locations, index built in {build_elapsed:.2f}s")
+    print(f"{FILTERS} filter changes selecting {SELECTED} countries each")
+    print(f"string comparison: {app_elapsed / FILTERS * 1000:8.2f} ms per filter change")
+    print(f"location index:    {indexed_elapsed / FILTERS * 1000:8.2f} ms per filter change")
+    print(f"matches only found by the index (bare city names, renamed places): {missed_by_app}")
+    print(f"matches only found by string comparison: {missed_by_index}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,230 @@
+import copy
+import glob
+import importlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import unicodedata
+
+from utils.store import open_store
+
+parser_merge = importlib.import_module("parser.parser-merge")
+
+FILES = int(os.environ.get("BENCH_FILES", 3000))
+CONNECTIONS = int(os.environ.get("BENCH_CONNECTIONS", 40))
+HEAVY_CONNECTIONS = int(os.environ.get("BENCH_HEAVY_CONNECTIONS", 300))
+HEAVY_EVERY = int(os.environ.get("BENCH_HEAVY_EVERY", 25))
+WORKERS = int(os.environ.get("BENCH_WORKERS", parser_merge.WORKERS))
+
+# L1 connection keys and the way the model tends to name the same person in L2
+PEOPLE = [
+    ("Euler", ["Leonhard Euler", "Euler"]),
+    ("Bernoulli_Johann", ["Johann Bernoulli", "Johann I Bernoulli"]),
+    ("Bernoulli_Daniel", ["Daniel Bernoulli"]),
+    ("Bernoulli_Jacob", ["Jacob Bernoulli", "Jakob Bernoulli"]),
+    ("Gauss", ["Carl Friedrich Gauss", "C F Gauss"]),
+    ("De_Morgan", ["Augustus De Morgan", "Augustus de Morgan"]),
+    ("Van_der_Waerden", ["Bartel van der Waerden", "B L van der Waerden"]),
+    ("Lobachevsky", ["Nikolai Lobachevskii", "Nikolai Ivanovich Lobachevsky"]),
+    ("Chebyshev", ["Pafnuty Chebyshev", "Pafnuty Chebychev"]),
+    ("Cauchy", ["Augustin-Louis Cauchy"]),
+    ("Abel", ["Niels Henrik Abel"]),
+    ("Galois", ["Évariste Galois"]),
+    ("Hardy", ["G H Hardy", "Godfrey Harold Hardy"]),
+    ("Littlewood", ["J E Littlewood", "John Edensor Littlewood"]),
+    ("Ramanujan", ["Srinivasa Ramanujan"]),
+    ("Noether_Emmy", ["Emmy Noether"]),
+    ("Noether_Max", ["Max Noether"]),
+    ("Poincare", ["Henri Poincaré"]),
+    ("Hilbert", ["David Hilbert"]),
+    ("Klein", ["Felix Klein"]),
+    ("Riemann", ["Bernhard Riemann", "G F B Riemann"]),
+    ("Dirichlet", ["Peter Gustav Lejeune Dirichlet", "Lejeune Dirichlet"]),
+    ("Erdos", ["Paul Erdős", "Paul Erdos"]),
+    ("Godel", ["Kurt Gödel"]),
+    ("Al-Khwarizmi", ["Muhammad ibn Musa al-Khwarizmi", "al-Khwarizmi"]),
+    ("Fermat", ["Pierre de Fermat"]),
+    ("Pascal", ["Blaise Pascal"]),
+    ("Descartes", ["René Descartes"]),
+    ("Leibniz", ["Gottfried Wilhelm Leibniz", "Gottfried Leibniz"]),
+    ("Newton", ["Isaac Newton", "Sir Isaac Newton"]),
+    ("Lagrange", ["Joseph-Louis Lagrange"]),
+    ("Laplace", ["Pierre-Simon Laplace"]),
+    ("Legendre", ["Adrien-Marie Legendre"]),
+    ("Fourier", ["Joseph Fourier"]),
+    ("Jacobi", ["Carl Jacobi", "C G J Jacobi"]),
+    ("Weierstrass", ["Karl Weierstrass", "Karl Weierstraß"]),
+    ("Kronecker", ["Leopold Kronecker"]),
+    ("Dedekind", ["Richard Dedekind"]),
+    ("Cantor", ["Georg Cantor"]),
+    ("Abelson", ["Harold Abelson"]),
+    ("Smith_Henry", ["H J S Smith", "Henry Smith"]),
+    ("Smith_David", ["David Eugene Smith"]),
+    ("Markov", ["Andrei Markov", "Andrey Markov"]),
+    ("Lyapunov", ["Aleksandr Lyapunov", "Alexander Liapunov"]),
+]
+SYLLABLES = "ber cha dov fel gau hil kov lam mar nes pol ros sch tor vic wen".split()
+GIVEN_NAMES = ["Anna", "Boris", "Carl", "Dora", "Emil", "Friedrich", "Giulia", "Hans", "Ivan", "Jean", "Karl", "Lucia"]
+NOISE_PEOPLE = ["Frederick the Great", "Catherine the Great", "Napoleon Bonaparte", "Queen Victoria", "Pope Gregory"]
+
+
+def generated_people(rng, count):
+    # Surnames built from syllables, a fifth of them shared by two people told apart by their given names
+    people = []
+    for number in range(count):
+        surname = "".join(rng.choice(SYLLABLES) for _ in range(3)).capitalize()
+        given_names = rng.sample(GIVEN_NAMES, 2 if number % 5 == 0 else 1)
+        if len(given_names) == 1:
+            people.append((surname, [f"{given_names[0]} {surname}", f"{given_names[0][0]} {surname}"]))
+        else:
+            people += [(f"{surname}_{given}", [f"{given} {surname}", f"{given[0]} {surname}"]) for given in given_names]
+    return people
+
+
+def build_files(root, count, seed=0):
+    rng = random.Random(seed)
+    truth = {}
+    population = PEOPLE + generated_people(rng, 2000)
+    variants = dict(population)
+    for directory in ("json/l1", "json/l2"):
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    for number in range(count):
+        size = HEAVY_CONNECTIONS if number % HEAVY_EVERY == 0 else CONNECTIONS
+        famous = min(size, len(PEOPLE)) // 2
+        keys = list(dict.fromkeys(key for key, _ in rng.sample(PEOPLE, famous) + rng.sample(population, size - famous)))
+        people = {key: rng.choice(variants[key]) for key in keys if rng.random() < 0.9}
+        connections = [{"person": person, "connection_type": "student of"} for person in people.values()]
+        connections += [{"person": person, "connection_type": "patron"} for person in rng.sample(NOISE_PEOPLE, 2)]
+        rng.shuffle(connections)
+        id = f"Person{number}"
+        truth[f"{id}.json"] = people
+        with open(os.path.join(root, "json/l1", f"{id}.json"), "w", encoding="utf-8") as f:
+            f.write(json.dumps({"id": id, "name": id, "connections": keys}, indent=4))
+        with open(os.path.join(root, "json/l2", f"{id}.json"), "w", encoding="utf-8") as f:
+            f.write(json.dumps({"id": id, "connections": connections}, indent=4))
+    return truth
+
+
+def legacy_merge_connections(keys, l2_connections):
+    for conn in l2_connections:
+        conn.pop("key", None)
+    for connection in keys:
+        l2_connection = next(
+            (
+                conn
+                for conn in l2_connections
+                if connection.split("_")[0]
+                in unicodedata.normalize("NFKD", conn["person"]).encode("ascii", "ignore").decode()
+            ),
+            None,
+        )
+        if l2_connection:
+            l2_connection["key"] = connection
+        else:
+            l2_connections.append({"person": connection, "key": connection, "connection_type": "Other"})
+
+
+def legacy_merge_json_files(l1_dir, l2_dir):
+    for l1_file_path in glob.glob(os.path.join(l1_dir, "*.json")):
+        filename = os.path.basename(l1_file_path)
+        l2_file_path = os.path.join(l2_dir, filename)
+
+        with open(l1_file_path, 'r', encoding='utf-8') as f:
+            l1_data = json.load(f)
+
+        with open(l2_file_path, 'r', encoding='utf-8') as f:
+            l2_data = json.load(f)
+
+        for key, value in l1_data.items():
+            if key != "connections":
+                l2_data[key] = value
+            else:
+                legacy_merge_connections(value, l2_data.get("connections", []))
+
+        with open(l2_file_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(l2_data, indent=4, ensure_ascii=False))
+
+
+def score(l2_dir, truth):
+    correct = wrong = missed = 0
+    for filename, people in truth.items():
+        with open(os.path.join(l2_dir, filename), "r", encoding="utf-8") as f:
+            connections = json.load(f)["connections"]
+        keyed = {}
+        for connection in connections:
+            if connection.get("connection_type") != "Other" and "key" in connection:
+                keyed[connection["key"]] = connection["person"]
+        for key, person in people.items():
+            if keyed.get(key) == person:
+                correct += 1
+            elif key in keyed:
+                wrong += 1
+            else:
+                missed += 1
+        wrong += sum(key not in people for key in keyed)
+    return correct, wrong, missed
+
+
+def time_matching(root):
+    # Matching alone on data already in memory, without the file I/O both merges share
+    pairs = []
+    for filename in os.listdir(os.path.join(root, "json/l1")):
+        with open(os.path.join(root, "json/l1", filename), "r", encoding="utf-8") as f:
+            keys = json.load(f)["connections"]
+        with open(os.path.join(root, "json/l2", filename), "r", encoding="utf-8") as f:
+            connections = json.load(f)["connections"]
+        pairs.append((keys, connections))
+
+    timings = {}
+    for name, merge_connections in (
+        ("legacy", legacy_merge_connections),
+        ("indexed", parser_merge.merge_connections),
+    ):
+        copies = [(keys, copy.deepcopy(connections)) for keys, connections in pairs]
+        start = time.perf_counter()
+        for keys, connections in copies:
+            merge_connections(keys, connections)
+        timings[name] = time.perf_counter() - start
+    return timings
+
+
+def run_benchmark():
+    with tempfile.TemporaryDirectory() as root:
+        legacy_root = os.path.join(root, "legacy")
+        indexed_root = os.path.join(root, "indexed")
+        truth = build_files(legacy_root, FILES)
+        shutil.copytree(legacy_root, indexed_root)
+        matching = time_matching(legacy_root)
+
+        parser_merge.store = open_store(indexed_root, "files")
+        parser_merge.REPORT_PATH = os.path.join(indexed_root, "json/merge-report.json")
+        parser_merge.INDEXES_PATH = os.path.join(indexed_root, "json/firestore.indexes.json")
+
+        timings = {"legacy": [], "indexed": []}
+        for _ in range(2):
+            start = time.perf_counter()
+            legacy_merge_json_files(os.path.join(legacy_root, "json/l1"), os.path.join(legacy_root, "json/l2"))
+            timings["legacy"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            parser_merge.merge_json_files(workers=WORKERS)
+            timings["indexed"].append(time.perf_counter() - start)
+
+        print(
+            f"\n{FILES} files, {CONNECTIONS} connections each ({HEAVY_CONNECTIONS} every {HEAVY_EVERY}th file), "
+            f"{WORKERS} workers"
+        )
+        for name, root_dir in (("legacy", legacy_root), ("indexed", indexed_root)):
+            correct, wrong, missed = score(os.path.join(root_dir, "json/l2"), truth)
+            first_run, re_run = timings[name]
+            print(
+                f"{name:<8} matching {matching[name]:6.2f}s  first run {first_run:6.2f}s  re-run {re_run:6.2f}s  "
+                f"recall {correct / (correct + missed):.1%}  wrong matches {wrong}  missed {missed}"
+            )
+
+
+if __name__ == "__main__":
+    run_benchmark()
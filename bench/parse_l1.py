@@ -0,0 +1,194 @@
+import importlib
+import json
+import os
+import re
+import time
+
+from bench.corpus import markdown_corpus
+
+parser_l1 = importlib.import_module("parser.parser-l1")
+
+DOCUMENTS = int(os.environ.get("BENCH_DOCUMENTS", 200))
+WORST_CASE_SIZE = int(os.environ.get("BENCH_WORST_CASE_SIZE", 2_000_000))
+REPEAT = int(os.environ.get("BENCH_REPEAT", 3))
+
+EDGE_CASES = [
+    "",
+    "# Name only",
+    "Summary",
+    "Summary \n",
+    "Summary  ",
+    "Born ",
+    "Born  \n",
+    "Born 1900\n",
+    "Died 3 May 1950 Paris\n* * *\nmore",
+    "Died\n\n[Paris](https://mathshistory.st-andrews.ac.uk/Map/#Paris)\n",
+    "Summary\n[Euler](https://mathshistory.st-andrews.ac.uk/Biographies/Euler/) was [great]",
+    "Born about 1500 somewhere Died c 1560\t*\n*\r* and more",
+    "Died first 1700 then Born 1600 Died again",
+    "![Thumbnail of broken\n![Thumbnail of X](thumb.jpg) ![Thumbnail of Y](other.jpg)",
+    "SummaryBorn 12 March 1800 [Town](link)Died",
+    " ".join(
+        f"[{name}](https://mathshistory.st-andrews.ac.uk/Biographies/{link})"
+        for name, link in [("a", "Gauss/"), ("b", "Gauss"), ("c", "Abel/quotations/"), ("d", "Self/"), ("e", "Abel/")]
+    ),
+    "[b](http://mathshistory.st-andrews.ac.uk/Biographies/Abel/)",
+]
+
+
+def legacy_extract_name(text):
+    lines = text.split("\n")
+    if lines and lines[0].startswith("# "):
+        return lines[0][2:].strip()
+    return ""
+
+
+def legacy_extract_summary(text):
+    summary_match = re.search(r"Summary\s+(.+?)(?=\[|$)", text, re.DOTALL | re.MULTILINE)
+    if summary_match:
+        summary_text = summary_match.group(1).strip()
+        return re.sub(r"\*\*(.+?)\*\*", r"\1", summary_text)
+    return ""
+
+
+def legacy_extract_picture(text):
+    picture_match = re.search(r"!\[Thumbnail of .+?\]\((.+?)\)", text)
+    if picture_match:
+        return picture_match.group(1).strip()
+    return None
+
+
+def legacy_extract_date_info(text_section):
+    info = {"year": None, "approx": False, "place": None, "link": None}
+
+    if not text_section:
+        return info
+
+    year_match = re.search(r"(\d{1,2}\s+\w+\s+)?(\d{4})", text_section)
+    if year_match:
+        try:
+            info["year"] = int(year_match.group(2))
+            has_month_day = year_match.group(1) is not None
+            info["approx"] = "approx" in text_section.lower() or "about" in text_section.lower() or not has_month_day
+        except ValueError:
+            pass
+
+    place_link_match = re.search(r"\[(.*?)\]\((.*?)\)", text_section)
+    if place_link_match:
+        info["place"] = place_link_match.group(1).strip()
+        info["link"] = place_link_match.group(2).strip()
+    else:
+        place_match = re.search(r"\d{4}\s+(.+)", text_section)
+        if place_match:
+            info["place"] = place_match.group(1).strip()
+        elif not year_match:
+            info["place"] = text_section.strip()
+
+    return info
+
+
+def legacy_extract_birth_info(text):
+    born_section = re.search(r"Born\s+(.+?)(?=Died|$)", text, re.DOTALL)
+    if born_section:
+        return legacy_extract_date_info(born_section.group(1).strip())
+    return {"year": None, "approx": None, "place": None, "link": None}
+
+
+def legacy_extract_death_info(text):
+    died_section = re.search(r"Died\s+(.+?)(?=\*\s\*\s\*|$)", text, re.DOTALL)
+    if died_section:
+        return legacy_extract_date_info(died_section.group(1).strip())
+    return {"year": None, "approx": None, "place": None, "link": None}
+
+
+def legacy_extract_connections(text, id):
+    connections = re.findall(
+        r"\[.+?]\((https?://mathshistory\.st-andrews\.ac\.uk/Biographies/[^#)]+?)/?\)",
+        text,
+    )
+    if connections:
+        unique_connections = []
+        prefix = "https://mathshistory.st-andrews.ac.uk/Biographies/"
+        for link in connections:
+            clean_link = link.rstrip("/")
+            # Skip self-links (links to the current biography)
+            if (
+                f"Biographies/{id}" not in clean_link
+                and "#reference-" not in clean_link
+                and "/quotations" not in clean_link
+                and "/poster/" not in clean_link
+            ):
+                # Remove the prefix
+                if clean_link.startswith(prefix):
+                    clean_link = clean_link[len(prefix) :]
+                    # Add to unique connections if not already there
+                    if clean_link not in unique_connections:
+                        unique_connections.append(clean_link)
+        return unique_connections
+    return []
+
+
+def legacy_extract_biography_data(id, text):
+    data = {
+        "id": id,
+        "name": legacy_extract_name(text),
+        "summary": legacy_extract_summary(text),
+        "born": legacy_extract_birth_info(text),
+        "died": legacy_extract_death_info(text),
+        "picture": f"https://mathshistory.st-andrews.ac.uk/Biographies/{id}/{legacy_extract_picture(text)}",
+        "connections": legacy_extract_connections(text, id),
+    }
+    return json.dumps(data, indent=4, ensure_ascii=False)
+
+
+def worst_case_documents():
+    link = "[Gauss](https://mathshistory.st-andrews.ac.uk/Biographies/Gauss_{}/) "
+    filler = "word " * (WORST_CASE_SIZE // 5)
+    return {
+        "no anchors": filler,
+        "born without died": "Summary " + filler + "\nBorn " + filler,
+        "died without separator": "Died " + filler,
+        "summary without links": "Summary " + filler.replace(" ", "\t"),
+        "link heavy": "".join(link.format(i % 2000) for i in range(WORST_CASE_SIZE // len(link))),
+    }
+
+
+def best_time(extract, id, text):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        extract(id, text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def check_regressions():
+    documents = list(EDGE_CASES)
+    stored = [markdown for _, markdown in parser_l1.store.items("md")]
+    documents.extend(stored or (markdown for _, markdown in markdown_corpus(DOCUMENTS)))
+
+    mismatches = 0
+    for i, text in enumerate(documents):
+        expected = legacy_extract_biography_data("Self", text)
+        actual = parser_l1.extract_biography_data("Self", text)
+        if json.loads(actual) != json.loads(expected) or actual != expected:
+            mismatches += 1
+            print(f"!!! Document {i} differs:\n{expected}\n{actual}")
+    print(f"Checked {len(documents)} documents, {mismatches} differ from the legacy extractor")
+    return mismatches == 0
+
+
+def run_benchmark():
+    for name, text in worst_case_documents().items():
+        legacy_time = best_time(legacy_extract_biography_data, "Self", text)
+        new_time = best_time(parser_l1.extract_biography_data, "Self", text)
+        print(
+            f"{name:<24} {len(text) / 1_000_000:.1f} MB: legacy {legacy_time * 1000:8.1f} ms, "
+            f"one-pass {new_time * 1000:8.1f} ms ({legacy_time / new_time:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    if check_regressions():
+        run_benchmark()
@@ -0,0 +1,124 @@
+import asyncio
+import importlib
+import os
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+from bench.crawl import BIOS_PER_LETTER, StandInHandler, biography_requests, reset_requests
+from bench.llm import configure_environment
+from bench.llm_server import start_server
+from utils.store import open_store
+
+LETTERS = os.environ.get("BENCH_LETTERS", "abcd")
+LLM_LATENCY_MS = int(os.environ.get("BENCH_LLM_LATENCY_MS", 300))
+
+
+def point_at(root, modules):
+    # Every manifest, report and telemetry file of the run lives in the scratch directory
+    crawler, parser_l1, parser_l2, parser_merge, parser_locations = modules
+    store = open_store(root)
+    for module in modules:
+        module.store = store
+    crawler.MANIFEST_PATH = os.path.join(root, "crawl-manifest.json")
+    crawler.FRONTIER_PATH = os.path.join(root, "crawl-frontier.sqlite")
+    crawler.ARCHIVE_DIR = os.path.join(root, "archive")
+    parser_l1.MANIFEST_PATH = os.path.join(root, "l1-manifest.json")
+    parser_l2.TELEMETRY_PATH = os.path.join(root, "l2-telemetry.jsonl")
+    parser_merge.REPORT_PATH = os.path.join(root, "merge-report.json")
+    parser_merge.INDEXES_PATH = os.path.join(root, "firestore.indexes.json")
+    parser_locations.LOCATIONS_PATH = os.path.join(root, "locations.json")
+    return store
+
+
+def run_sequential(base_url, root, modules):
+    crawler, parser_l1, parser_l2, parser_merge, parser_locations = modules
+    point_at(root, modules)
+    timings = []
+    for stage, run in (
+        ("crawl", lambda: crawler.crawl_biographies(base_url, list(LETTERS))),
+        ("l1", parser_l1.parse_l1),
+        ("l2", parser_l2.parse_biographies),
+        ("merge", parser_merge.merge_json_files),
+        ("locations", parser_locations.build_location_index),
+    ):
+        start = time.perf_counter()
+        run()
+        timings.append((stage, time.perf_counter() - start))
+    return timings
+
+
+async def interrupted_pipeline(pipeline, base_url, store, ledger, stop_after):
+    runner = pipeline.Pipeline(store, ledger, False)
+    task = asyncio.create_task(runner.run("crawl", base_url, list(LETTERS)))
+    while biography_requests() < stop_after and not task.done():
+        await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def run_benchmark():
+    crawl_server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=crawl_server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{crawl_server.server_address[1]}/Biographies/"
+    llm_server, llm_url = start_server(latency_ms=LLM_LATENCY_MS)
+
+    with tempfile.TemporaryDirectory() as root:
+        configure_environment(root, llm_url)
+        os.environ["LLM_RPM"] = os.environ["LLM_TPM"] = "100000000"
+        pipeline = importlib.import_module("pipeline.pipeline")
+        modules = (
+            pipeline.crawler,
+            pipeline.parser_l1,
+            pipeline.parser_l2,
+            pipeline.parser_merge,
+            pipeline.parser_locations,
+        )
+
+        sequential = run_sequential(base_url, os.path.join(root, "sequential"), modules)
+
+        streamed = []
+        store = point_at(os.path.join(root, "pipeline"), modules)
+        ledger = pipeline.Ledger(os.path.join(root, "pipeline", "ledger.sqlite"))
+        for run in ("cold", "re-run"):
+            elapsed = pipeline.run_pipeline("crawl", False, base_url, list(LETTERS), store, ledger)
+            streamed.append((run, elapsed, ledger.counts()))
+
+        sequential_store = open_store(os.path.join(root, "sequential"))
+        differing = sum(
+            sequential_store.hashes(collection) != store.hashes(collection) for collection in ("md", "l1", "l2")
+        )
+
+        # Interrupted halfway through the crawl, then run again: the frontier resumes the crawl and the biographies
+        # fetched before the interruption still go through the later stages
+        store = point_at(os.path.join(root, "interrupted"), modules)
+        ledger = pipeline.Ledger(os.path.join(root, "interrupted", "ledger.sqlite"))
+        reset_requests()
+        asyncio.run(interrupted_pipeline(pipeline, base_url, store, ledger, len(LETTERS) * BIOS_PER_LETTER // 2))
+        before = biography_requests()
+        pipeline.run_pipeline("crawl", False, base_url, list(LETTERS), store, ledger)
+        resumed = (before, biography_requests() - before, ledger.counts().get(("merge", "done"), 0))
+        interrupted_differing = sum(
+            sequential_store.hashes(collection) != store.hashes(collection) for collection in ("md", "l1", "l2")
+        )
+
+    crawl_server.shutdown()
+    llm_server.shutdown()
+    print(f"\nLLM latency {LLM_LATENCY_MS}ms, letters {LETTERS}")
+    print(
+        f"sequential stages: {', '.join(f'{stage} {elapsed:.2f}s' for stage, elapsed in sequential)}, "
+        f"total {sum(elapsed for _, elapsed in sequential):.2f}s"
+    )
+    for run, elapsed, counts in streamed:
+        done = sum(count for (stage, status), count in counts.items() if status == "done")
+        print(f"pipeline {run}: {elapsed:.2f}s, {done} stage results recorded in the ledger")
+    print(f"Collections differing between sequential and pipeline runs: {differing}")
+    print(
+        f"interrupted pipeline: {resumed[0]} biography requests before the interruption, {resumed[1]} after resuming, "
+        f"{resumed[2]} merged, collections differing from the sequential run: {interrupted_differing}"
+    )
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,117 @@
+import importlib
+import json
+import os
+import random
+import time
+
+from bench.corpus import INSTITUTIONS, PROFESSIONS, RELIGIONS, l2_corpus
+
+DOCUMENTS = int(os.environ.get("BENCH_DOCUMENTS", 10000))
+FILTERS = int(os.environ.get("BENCH_FILTERS", 500))
+
+parser_merge = importlib.import_module("parser.parser-merge")
+
+FACETS = (("profession", "profession", PROFESSIONS), ("religions", "religions", RELIGIONS))
+FACETS += (("institutions", "institution_affiliation", INSTITUTIONS),)
+
+
+def random_filters(rng):
+    start = rng.randint(1500, 1950)
+    filters = {"from": start, "to": start + rng.choice([10, 50, 100, 200]), "unknown": rng.random() < 0.3}
+    for name, field, values in FACETS:
+        if rng.random() < 0.4:
+            filters[name] = (field, rng.sample(values, rng.randint(1, 2)))
+    return filters
+
+
+def facets_match(document, filters):
+    return all(
+        any(value in (document.get(field) or []) for value in values)
+        for name, (field, values) in ((name, filters[name]) for name, _, _ in FACETS if name in filters)
+    )
+
+
+def app_reads(documents, filters):
+    # useFirestore: born.year in range, born.year null with died.year in the shifted range, and the unknowns, then
+    # every filter again on the client
+    read = []
+    for document in documents:
+        born = document["born"]["year"]
+        died = document["died"]["year"]
+        if born is not None:
+            selected = filters["from"] <= born <= filters["to"]
+        elif died is not None:
+            selected = (
+                filters["from"] + parser_merge.AVERAGE_LIFESPAN <= died <= filters["to"] + parser_merge.AVERAGE_LIFESPAN
+            )
+        else:
+            selected = filters["unknown"]
+        if selected:
+            read.append(document)
+    return read, {document["id"] for document in read if facets_match(document, filters)}
+
+
+def indexed_reads(documents, filters):
+    # One range query on query.born_year with array-contains-any on the first facet filter (plus one on query.known for
+    # the unknowns); Firestore allows a single array-contains-any, so further facets are still checked on the client
+    facet = next((name for name, _, _ in FACETS if name in filters), None)
+    wanted = {value.lower() for value in filters[facet][1]} if facet else None
+    read = []
+    for document in documents:
+        query = document["query"]
+        if query["known"]:
+            if not filters["from"] <= query["born_year"] <= filters["to"]:
+                continue
+        elif not filters["unknown"]:
+            continue
+        if facet and not wanted.intersection(query[facet]):
+            continue
+        read.append(document)
+    return read, {document["id"] for document in read if facets_match(document, filters)}
+
+
+def size(documents):
+    return sum(len(json.dumps(document, ensure_ascii=False).encode("utf-8")) for document in documents)
+
+
+def run_benchmark():
+    rng = random.Random(0)
+    documents = list(l2_corpus(DOCUMENTS))
+    # The app reads documents without the query map
+    plain_sizes = {document["id"]: size([document]) for document in documents}
+    plain_bytes = sum(plain_sizes.values())
+    start = time.perf_counter()
+    for document in documents:
+        document["query"] = parser_merge.query_fields(document)
+    elapsed = time.perf_counter() - start
+
+    queries = [random_filters(rng) for _ in range(FILTERS)]
+    app_count = indexed_count = app_bytes = indexed_bytes = mismatches = 0
+    app_queries = indexed_queries = 0
+    for filters in queries:
+        app_read, app_matched = app_reads(documents, filters)
+        indexed_read, indexed_matched = indexed_reads(documents, filters)
+        app_count += len(app_read)
+        indexed_count += len(indexed_read)
+        app_bytes += sum(plain_sizes[document["id"]] for document in app_read)
+        indexed_bytes += size(indexed_read)
+        app_queries += 2 + filters["unknown"]
+        indexed_queries += 1 + filters["unknown"]
+        mismatches += app_matched != indexed_matched
+
+    print(f"\n{DOCUMENTS} documents, query fields computed in {elapsed / DOCUMENTS * 1e6:.0f}us each")
+    print(f"document size with the query map: {(size(documents) / plain_bytes - 1) * 100:.1f}% larger")
+    print(f"{len(parser_merge.index_definitions()['indexes'])} composite index definitions")
+    print(
+        f"app filters: {app_queries / FILTERS:.1f} queries, {app_count / FILTERS:.0f} documents and "
+        f"{app_bytes / FILTERS / 1024:.0f} KiB read per filter change"
+    )
+    print(
+        f"query fields: {indexed_queries / FILTERS:.1f} queries, {indexed_count / FILTERS:.0f} documents and "
+        f"{indexed_bytes / FILTERS / 1024:.0f} KiB read per filter change"
+    )
+    print(f"filters with a different result: {mismatches} of {FILTERS}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,72 @@
+import os
+import random
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+from bench.crawl import LATENCY_MS, LETTERS, StandInHandler, point_at
+from crawler import crawler
+
+WORKERS = int(os.environ.get("BENCH_WORKERS", crawler.REPLAY_WORKERS))
+READS = int(os.environ.get("BENCH_READS", 1000))
+
+
+def stored_markdown():
+    return dict(crawler.store.items("md"))
+
+
+def run_benchmark():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/Biographies/"
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        point_at(output_dir)
+        start = time.perf_counter()
+        crawler.crawl_biographies(base_url, list(LETTERS))
+        crawl_elapsed = time.perf_counter() - start
+        crawled = stored_markdown()
+        server.shutdown()
+
+        archive = crawler.Archive(crawler.ARCHIVE_DIR)
+        records = archive.latest()
+        raw_bytes = sum(len(archive.read(*record[1:])[3]) for record in records)
+        stats = archive.stats()
+
+        # Random access through the offset index
+        rng = random.Random(0)
+        sample = [rng.choice(records) for _ in range(READS)]
+        start = time.perf_counter()
+        for record in sample:
+            archive.read(*record[1:])
+        read_elapsed = time.perf_counter() - start
+
+        # Replay into an empty markdown store with no server running
+        crawler.store.delete("md", list(crawled))
+        os.remove(crawler.MANIFEST_PATH)
+        results = {}
+        for workers in sorted({1, WORKERS}):
+            start = time.perf_counter()
+            success_count, error_count = crawler.replay_biographies(workers)
+            results[workers] = time.perf_counter() - start
+        replayed = stored_markdown()
+        mismatches = sum(replayed.get(key) != markdown for key, markdown in crawled.items())
+
+        # A re-crawl after the replay still sends conditional requests from the rebuilt manifest
+        manifest = crawler.load_manifest()
+        conditional = sum(bool(crawler.conditional_headers(url, manifest)) for url in manifest)
+
+    print(f"\n{len(crawled)} biographies crawled in {crawl_elapsed:.2f}s (latency {LATENCY_MS}ms)")
+    print(
+        f"archive: {stats['records']} records, {stats['bytes'] / 1024:.0f} KiB for {raw_bytes / 1024:.0f} KiB of "
+        f"responses ({raw_bytes / stats['bytes']:.1f}x), random read {read_elapsed / READS * 1e6:.0f}us per record"
+    )
+    for workers, elapsed in results.items():
+        print(f"replay with {workers} workers: {elapsed:.2f}s ({success_count / elapsed:.0f} biographies/sec)")
+    print(f"replayed markdown different from the crawl: {mismatches} of {len(crawled)}, {error_count} failed")
+    print(f"manifest entries with conditional headers after the replay: {conditional} of {len(manifest)}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
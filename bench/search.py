@@ -0,0 +1,166 @@
+import bisect
+import itertools
+import gzip
+import importlib
+import json
+import math
+import os
+import random
+import tempfile
+import time
+
+from bench.corpus import WORDS, markdown_corpus
+from utils.store import open_store
+
+DOCUMENTS = int(os.environ.get("BENCH_DOCUMENTS", 3000))
+QUERIES = int(os.environ.get("BENCH_QUERIES", 200))
+CHANGED = int(os.environ.get("BENCH_CHANGED", 20))
+DELETED = int(os.environ.get("BENCH_DELETED", 5))
+WORKERS = int(os.environ.get("BENCH_WORKERS", 4))
+
+search = importlib.import_module("search.search")
+parser_l1 = importlib.import_module("parser.parser-l1")
+
+
+def build_store(root):
+    store = open_store(root)
+    documents = list(markdown_corpus(DOCUMENTS))
+    store.put_many("md", documents)
+    store.put_many("l1", [(id, parser_l1.extract_biography_data(id, markdown)) for id, markdown in documents])
+    return store
+
+
+def queries(store, rng):
+    # Single words, word pairs and phrases lifted from the documents, so every phrase has at least one match
+    keys = store.keys("md")
+    generated = []
+    for i in range(QUERIES):
+        if i % 3 == 0:
+            generated.append(rng.choice(WORDS))
+        elif i % 3 == 1:
+            generated.append(f"{rng.choice(WORDS)} {rng.choice(WORDS)}")
+        else:
+            tokens = search.tokenize(search.document_text(store.get("md", rng.choice(keys))))
+            start = rng.randrange(len(tokens) - 3)
+            generated.append('"' + " ".join(tokens[start : start + 3]) + '"')
+    return generated
+
+
+def scan_search(texts, query):
+    # What searching without an index costs: fold and tokenise every biography for each query
+    terms, phrases = search.parse_query(query)
+    matches = []
+    for key, text in texts.items():
+        tokens = search.tokenize(search.document_text(text))
+        if not any(term in tokens for term in terms):
+            continue
+        joined = " " + " ".join(tokens) + " "
+        if all(f" {' '.join(phrase)} " in joined for phrase in phrases):
+            matches.append(key)
+    return matches
+
+
+def timed_queries(search_index, generated):
+    latencies = []
+    for query in generated:
+        start = time.perf_counter()
+        search_index.search(query)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[min(len(latencies) - 1, round(0.99 * (len(latencies) - 1)))]
+
+
+def load_bundle(export_dir):
+    with gzip.open(os.path.join(export_dir, search.INDEX_FILENAME), "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def bundle_search(export_dir, index, query, limit=10):
+    # The client side: find each term's shard by its first term, undo the gap encoding and score with BM25
+    documents = index["documents"]
+    average = sum(documents["length"]) / len(documents["length"])
+    firsts = [shard["first"] for shard in index["shards"]]
+    terms, phrases = search.parse_query(query)
+    scores = {}
+    positions = {}
+    for term in terms:
+        shard = index["shards"][max(0, bisect.bisect_right(firsts, term) - 1)]
+        with gzip.open(os.path.join(export_dir, shard["file"]), "rt", encoding="utf-8") as f:
+            payload = json.load(f)
+        if term not in payload["terms"]:
+            continue
+        position = payload["terms"].index(term)
+        docs = list(itertools.accumulate(payload["documents"][position]))
+        idf = math.log(1 + (len(documents["length"]) - len(docs) + 0.5) / (len(docs) + 0.5))
+        for doc, frequency, gaps in zip(docs, payload["frequencies"][position], payload["positions"][position]):
+            norm = index["k1"] * (1 - index["b"] + index["b"] * documents["length"][doc] / average)
+            scores[doc] = scores.get(doc, 0) + idf * frequency * (index["k1"] + 1) / (frequency + norm)
+            positions.setdefault(doc, {})[term] = list(itertools.accumulate(gaps))
+    for phrase in phrases:
+        for doc in list(scores):
+            found = positions[doc]
+            if not all(term in found for term in phrase) or not search.contains_phrase(found, phrase):
+                del scores[doc]
+    best = sorted(scores.items(), key=lambda item: -item[1])[:limit]
+    return [(documents["key"][doc], round(score, 4)) for doc, score in best]
+
+
+def run_benchmark():
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as root:
+        store = build_store(root)
+        search_index = search.SearchIndex(os.path.join(root, "search.sqlite"))
+
+        start = time.perf_counter()
+        search_index.update(store, WORKERS)
+        build_elapsed = time.perf_counter() - start
+        index_bytes = os.path.getsize(search_index.path)
+        markdown_bytes = sum(len(text.encode("utf-8")) for _, text in store.items("md"))
+
+        generated = queries(store, rng)
+        p50, p99 = timed_queries(search_index, generated)
+
+        texts = dict(store.items("md"))
+        mismatches = 0
+        scan_start = time.perf_counter()
+        for query in generated[:20]:
+            expected = set(scan_search(texts, query))
+            found = {result["key"] for result in search_index.search(query, limit=len(texts))}
+            mismatches += expected != found
+        scan_elapsed = (time.perf_counter() - scan_start) / 20
+
+        keys = store.keys("md")
+        revised = [
+            (key, texts[key] + "\nHe corresponded with Kurt Gödel about Łukasiewicz.\n") for key in keys[:CHANGED]
+        ]
+        store.put_many("md", revised)
+        store.delete("md", keys[CHANGED : CHANGED + DELETED])
+        start = time.perf_counter()
+        indexed, removed = search_index.update(store, WORKERS)
+        update_elapsed = time.perf_counter() - start
+        folded = {result["key"] for result in search_index.search('"kurt godel" lukasiewicz', limit=DOCUMENTS)}
+
+        export_dir = os.path.join(root, "bundle")
+        index = search_index.export(export_dir)
+        bundle_bytes = sum(os.path.getsize(os.path.join(export_dir, name)) for name in os.listdir(export_dir))
+        differing = 0
+        for query in generated[:20]:
+            expected = [(result["key"], result["score"]) for result in search_index.search(query)]
+            differing += bundle_search(export_dir, load_bundle(export_dir), query) != expected
+
+    print(f"\n{DOCUMENTS} biographies, {markdown_bytes / 1024 / 1024:.1f} MiB of markdown")
+    print(f"full build: {build_elapsed:.2f}s, index {index_bytes / 1024 / 1024:.1f} MiB")
+    print(
+        f"incremental update ({CHANGED} changed, {DELETED} deleted): {indexed} indexed, {removed} removed "
+        f"in {update_elapsed:.2f}s"
+    )
+    print(f"accent-folded phrase query matched {len(folded)} of the {CHANGED} revised biographies")
+    print(f"{len(generated)} queries: p50 {p50 * 1000:.1f}ms, p99 {p99 * 1000:.1f}ms")
+    print(f"scanning every biography instead: {scan_elapsed * 1000:.0f}ms per query")
+    print(f"queries matching a different set than the scan: {mismatches} of 20")
+    print(f"exported bundle: {len(index['shards'])} shards, {bundle_bytes / 1024:.0f} KiB")
+    print(f"queries ranked differently from the bundle: {differing} of 20")
+
+
+if __name__ == "__main__":
+    run_benchmark()
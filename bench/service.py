@@ -0,0 +1,155 @@
+import asyncio
+import importlib
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from urllib.parse import urlencode
+
+import httpx
+
+from bench.corpus import INSTITUTIONS, PLACES, PROFESSIONS, RELIGIONS, l2_corpus
+from utils.store import open_store
+
+DOCUMENTS = int(os.environ.get("BENCH_DOCUMENTS", 10000))
+REQUESTS = int(os.environ.get("BENCH_REQUESTS", 2000))
+CONCURRENCY = [int(value) for value in os.environ.get("BENCH_CONCURRENCY", "1,16,64").split(",")]
+CHECKED = int(os.environ.get("BENCH_CHECKED", 50))
+
+service = importlib.import_module("service.service")
+exporter = importlib.import_module("export.exporter")
+
+
+def random_filters(rng):
+    start = rng.randint(1500, 1950)
+    filters = {"from": start, "to": start + rng.choice([10, 50, 100, 200]), "mode": rng.choice(["born", "alive"])}
+    if rng.random() < 0.3:
+        filters["unknown"] = 1
+    for name, values in (
+        ("profession", PROFESSIONS),
+        ("religions", RELIGIONS),
+        ("institutions", INSTITUTIONS),
+        ("locations", [", ".join(place) for place in PLACES]),
+    ):
+        if rng.random() < 0.3:
+            filters[name] = rng.sample(values, rng.randint(1, 2))
+    return filters
+
+
+def scan_query(documents, filters):
+    # The same filters applied to every document, as the app does after its Firestore queries
+    matched = []
+    for document in documents:
+        lifespan = service.estimated_lifespan(document)
+        if lifespan is None:
+            if not filters.get("unknown"):
+                continue
+        elif filters["mode"] == "born" and not filters["from"] <= lifespan[0] <= filters["to"]:
+            continue
+        elif filters["mode"] == "alive" and (lifespan[0] > filters["to"] or lifespan[1] < filters["from"]):
+            continue
+        if all(
+            {service.facet_key(value) for value in service.facet_values(document, service.FACETS[name])}
+            & {service.facet_key(value) for value in filters[name]}
+            for name in service.FACETS
+            if name in filters
+        ):
+            matched.append(document["id"])
+    return matched
+
+
+def serve(root, ports):
+    service.store = open_store(root)
+    service.run_service(port=0, ready=ports.put)
+
+
+async def fetch(reader, writer, path):
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n".encode("latin-1"))
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = int(next(line for line in head.split(b"\r\n") if line.lower().startswith(b"content-length:"))[15:])
+    return await reader.readexactly(length)
+
+
+async def load(host, port, paths, concurrency):
+    # A keep-alive connection per simulated client, spoken to directly: with httpx the client itself used most of the
+    # CPU at higher concurrency and its own slowdown was what got measured
+    latencies = []
+    sizes = []
+    pending = iter(paths)
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port, limit=2**24)
+        for path in pending:
+            start = time.perf_counter()
+            body = await fetch(reader, writer, path)
+            latencies.append(time.perf_counter() - start)
+            sizes.append(len(body))
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return elapsed, latencies, sum(sizes) / len(sizes)
+
+
+def run_benchmark():
+    rng = random.Random(0)
+    documents = list(l2_corpus(DOCUMENTS))
+    queries = [random_filters(rng) for _ in range(REQUESTS)]
+    paths = ["/query?" + urlencode(filters, doseq=True) for filters in queries]
+
+    with tempfile.TemporaryDirectory() as root:
+        store = open_store(root)
+        store.put_many("l2", [(document["id"], store.dump(document)) for document in documents])
+        ports = multiprocessing.Queue()
+        process = multiprocessing.Process(target=serve, args=(root, ports), daemon=True)
+        start = time.perf_counter()
+        process.start()
+        port = ports.get(timeout=600)
+        base_url = f"http://127.0.0.1:{port}"
+        startup = time.perf_counter() - start
+        try:
+            mismatches = 0
+            for filters, path in zip(queries[:CHECKED], paths):
+                payload = httpx.get(base_url + path, timeout=120).json()
+                mismatches += sorted(node["id"] for node in payload["nodes"]) != sorted(scan_query(documents, filters))
+            results = [
+                (concurrency, *asyncio.run(load("127.0.0.1", port, paths, concurrency))) for concurrency in CONCURRENCY
+            ]
+            facets = httpx.get(base_url + "/facets").json()
+        finally:
+            process.terminate()
+            process.join()
+
+    scan_start = time.perf_counter()
+    for filters in queries[:CHECKED]:
+        scan_query(documents, filters)
+    scan_elapsed = (time.perf_counter() - scan_start) / CHECKED
+    firestore_bytes = []
+    for filters in queries[:CHECKED]:
+        # What the app downloads for the same filters: everyone in the birth year range, filtered afterwards
+        view = [
+            document
+            for document in documents
+            if filters["from"] <= (exporter.estimated_birth_year(document) or -1) <= filters["to"]
+        ]
+        firestore_bytes.append(sum(len(json.dumps(document, ensure_ascii=False).encode("utf-8")) for document in view))
+
+    print(f"\n{DOCUMENTS} people, service ready in {startup:.2f}s, {sum(map(len, facets.values()))} facet values")
+    print(f"queries answered differently from a scan of every document: {mismatches} of {CHECKED}")
+    print(f"scanning every document instead: {scan_elapsed * 1000:.1f}ms per query")
+    print(f"app download for the same year ranges: {sum(firestore_bytes) / len(firestore_bytes) / 1024:.0f} KiB")
+    for concurrency, elapsed, latencies, size in results:
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[min(len(latencies) - 1, round(0.99 * (len(latencies) - 1)))]
+        print(
+            f"{concurrency:>3} concurrent: {len(latencies) / elapsed:.0f} queries/s, p50 {p50 * 1000:.1f}ms, "
+            f"p99 {p99 * 1000:.1f}ms, {size / 1024:.0f} KiB per response"
+        )
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,103 @@
+import importlib
+import os
+import random
+import tempfile
+import time
+
+from bench.corpus import WORDS, l2_corpus
+from utils.store import DirectoryStore, SqliteStore, export_directory, import_directory, open_store
+
+DOCUMENTS = int(os.environ.get("BENCH_DOCUMENTS", 10000))
+LOOKUPS = int(os.environ.get("BENCH_LOOKUPS", 2000))
+PARSE_DOCUMENTS = int(os.environ.get("BENCH_PARSE_DOCUMENTS", 2000))
+WORKERS = int(os.environ.get("BENCH_WORKERS", 4))
+
+
+def corpus(count):
+    rng = random.Random(0)
+    for document in l2_corpus(count):
+        markdown = f"# {document['name']}\n\n" + " ".join(rng.choice(WORDS) for _ in range(rng.randint(500, 3000)))
+        yield document["id"], markdown, document
+
+
+def timed(operation):
+    start = time.perf_counter()
+    result = operation()
+    return time.perf_counter() - start, result
+
+
+def time_operations(store, documents, rng):
+    keys = [key for key, _, _ in documents]
+    lookups = rng.sample(keys, min(LOOKUPS, len(keys))) + [f"missing{i}" for i in range(LOOKUPS // 10)]
+    timings = {}
+    timings["bulk write"], _ = timed(
+        lambda: [
+            store.put_many("md", [(key, markdown) for key, markdown, _ in documents]),
+            store.put_many("l2", [(key, store.dump(document)) for key, _, document in documents]),
+        ]
+    )
+    timings["rewrite unchanged"], _ = timed(
+        lambda: store.put_many("l2", [(key, store.dump(document)) for key, _, document in documents])
+    )
+    timings["list keys"], _ = timed(lambda: [store.keys(collection) for collection in ("md", "l2")])
+    timings["exists checks"], _ = timed(lambda: [store.exists("l2", key) for key in lookups])
+    timings["random reads"], _ = timed(lambda: [store.get("md", key) for key in lookups])
+    timings["read all in key order"], count = timed(
+        lambda: sum(1 for collection in ("md", "l2") for _ in store.items(collection))
+    )
+    timings["content hashes"], _ = timed(lambda: [store.hashes(collection) for collection in ("md", "l2")])
+    return timings
+
+
+def check_bridge(root):
+    # Import the directory layout, export it again elsewhere and compare every file byte for byte
+    files = DirectoryStore(os.path.join(root, "files"))
+    store = SqliteStore(os.path.join(root, "bridge", "corpus.sqlite"))
+    import_directory(store, files.root)
+    export_directory(store, os.path.join(root, "exported"))
+    exported = DirectoryStore(os.path.join(root, "exported"))
+    differing = 0
+    for collection in ("md", "l2"):
+        original = dict(files.items(collection))
+        differing += original != dict(exported.items(collection))
+    return differing
+
+
+def time_parse_l1(root, backend):
+    parser_l1 = importlib.import_module("parser.parser-l1")
+    source = DirectoryStore(os.path.join(root, "files"))
+    parser_l1.store = open_store(os.path.join(root, f"parse-{backend}"), backend)
+    parser_l1.MANIFEST_PATH = os.path.join(root, f"parse-{backend}", "l1-manifest.json")
+    parser_l1.store.put_many("md", list(source.items("md", source.keys("md")[:PARSE_DOCUMENTS])))
+    first, _ = timed(lambda: parser_l1.parse_l1(workers=WORKERS))
+    unchanged, _ = timed(lambda: parser_l1.parse_l1(workers=WORKERS))
+    return first, unchanged
+
+
+def run_benchmark():
+    documents = list(corpus(DOCUMENTS))
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        for backend in ("files", "sqlite"):
+            store = open_store(os.path.join(root, backend), backend)
+            results[backend] = time_operations(store, documents, random.Random(1))
+            results[backend]["parse_l1 (first run)"], results[backend]["parse_l1 (unchanged)"] = time_parse_l1(
+                root, backend
+            )
+        differing = check_bridge(root)
+        size = os.path.getsize(os.path.join(root, "sqlite", "corpus.sqlite"))
+        file_count = sum(len(files) for _, _, files in os.walk(os.path.join(root, "files")))
+
+    print(
+        f"\n{DOCUMENTS} biographies (md + l2), {LOOKUPS} lookups, parse_l1 on {PARSE_DOCUMENTS} with {WORKERS} workers"
+    )
+    print(f"files: {file_count} files, sqlite: one {size / 1024 / 1024:.1f} MB database")
+    print(f"{'operation':<24} {'files s':>9} {'sqlite s':>9} {'speedup':>8}")
+    for operation in results["files"]:
+        files_time, sqlite_time = results["files"][operation], results["sqlite"][operation]
+        print(f"{operation:<24} {files_time:>9.3f} {sqlite_time:>9.3f} {files_time / sqlite_time:>7.1f}x")
+    print(f"collections differing after an import/export round trip: {differing}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
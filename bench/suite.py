@@ -0,0 +1,283 @@
+import importlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.corpus import biography_corpus, markdown_corpus
+from bench.llm import configure_environment
+from bench.llm_server import start_server
+from utils.ratelimit import AdaptiveRate
+from utils.store import QUERY_BATCH, open_store
+
+SIZES = [int(size) for size in os.environ.get("BENCH_SIZES", "1000,10000,100000").split(",")]
+PATHS = os.environ.get("BENCH_PATHS", "convert,parse_l1,parse_l2,merge,upload").split(",")
+LATENCY_SAMPLE = int(os.environ.get("BENCH_LATENCY_SAMPLE", 2000))
+LLM_LATENCY_MS = int(os.environ.get("BENCH_LLM_LATENCY_MS", 50))
+RATE_LIMIT_RATIO = float(os.environ.get("BENCH_RATE_LIMIT_RATIO", 0.02))
+RESULTS_DIR = os.environ.get("BENCH_RESULTS_DIR", os.path.join(os.path.dirname(__file__), "results"))
+BASELINE = os.environ.get("BENCH_BASELINE", "baseline")
+SAVE_BASELINE = os.environ.get("BENCH_SAVE_BASELINE", "").lower() in ("1", "true", "yes")
+# Slowdown of throughput or p99 over the baseline that counts as a regression
+TOLERANCE = float(os.environ.get("BENCH_TOLERANCE", 0.2))
+
+BIOGRAPHY_PREFIX = "https://mathshistory.st-andrews.ac.uk/Biographies/"
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux; worker processes are covered by RUSAGE_CHILDREN
+    peak = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def result(path, size, items, elapsed, latencies):
+    return {
+        "path": path,
+        "documents": size,
+        "items": items,
+        "seconds": round(elapsed, 3),
+        "throughput": round(items / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def ensure_inputs(store, size, collections):
+    # Each path can run alone: whatever earlier paths would have left in the store is generated untimed
+    parser_l1 = importlib.import_module("parser.parser-l1")
+    if "md" in collections and len(store.keys("md")) < size:
+        batch = []
+        for id, markdown in markdown_corpus(size):
+            batch.append((id, markdown))
+            if len(batch) == QUERY_BATCH:
+                store.put_many("md", batch)
+                batch = []
+        store.put_many("md", batch)
+    if "l1" in collections and len(store.keys("l1")) < size:
+        documents = store.items("md")
+        store.put_many("l1", [(id, parser_l1.extract_biography_data(id, md, store.indent)) for id, md in documents])
+    if "l2" in collections and len(store.keys("l2")) < size:
+        store.put_many("l2", list(store.items("l1")))
+
+
+def timed_calls(function, arguments):
+    latencies = []
+    for argument in arguments:
+        start = time.perf_counter()
+        function(*argument)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_convert(root, size):
+    # The CPU part of process_biography: HTML clean-up and markdown conversion of every page
+    crawler = importlib.import_module("crawler.crawler")
+    store = open_store(root)
+    latencies = []
+    batch = []
+    for id, html in biography_corpus(size):
+        start = time.perf_counter()
+        markdown = crawler.render_biography(f"{BIOGRAPHY_PREFIX}{id}/", html)
+        latencies.append(time.perf_counter() - start)
+        batch.append((id, markdown))
+        if len(batch) == QUERY_BATCH:
+            store.put_many("md", batch)
+            batch = []
+    store.put_many("md", batch)
+    return result("convert", size, size, sum(latencies), latencies)
+
+
+def bench_parse_l1(root, size):
+    # Latency of single extractions on a sample, throughput of the parallel parse_l1 run
+    parser_l1 = importlib.import_module("parser.parser-l1")
+    parser_l1.store = store = open_store(root)
+    parser_l1.MANIFEST_PATH = os.path.join(root, "l1-manifest.json")
+    parser_l1.FORCE_RUN = True
+    ensure_inputs(store, size, ("md",))
+    sample = list(store.items("md", store.keys("md")[:LATENCY_SAMPLE]))
+    latencies = timed_calls(parser_l1.extract_biography_data, sample)
+    start = time.perf_counter()
+    success_count, _ = parser_l1.parse_l1()
+    return result("parse_l1", size, success_count, time.perf_counter() - start, latencies)
+
+
+def bench_parse_l2(root, size):
+    # Against the stand-in LLM server with injected latency and 429s; latencies come from the telemetry records
+    server, base_url = start_server(latency_ms=LLM_LATENCY_MS, rate_limit_ratio=RATE_LIMIT_RATIO)
+    configure_environment(root, base_url)
+    os.environ["LLM_RPM"] = os.environ["LLM_TPM"] = "100000000"
+    parser_l2 = importlib.import_module("parser.parser-l2")
+    parser_l2.store = store = open_store(root)
+    parser_l2.TELEMETRY_PATH = os.path.join(root, "l2-telemetry.jsonl")
+    parser_l2.FORCE_RUN = True
+    ensure_inputs(store, size, ("md", "l1"))
+    start = time.perf_counter()
+    success_count, _ = parser_l2.parse_biographies()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    with open(parser_l2.TELEMETRY_PATH, "r", encoding="utf-8") as f:
+        latencies = [json.loads(line)["latency_seconds"] for line in f]
+    return result("parse_l2", size, success_count, elapsed, latencies)
+
+
+def bench_merge(root, size):
+    parser_merge = importlib.import_module("parser.parser-merge")
+    parser_merge.store = store = open_store(root)
+    parser_merge.REPORT_PATH = os.path.join(root, "merge-report.json")
+    parser_merge.INDEXES_PATH = os.path.join(root, "firestore.indexes.json")
+    ensure_inputs(store, size, ("md", "l1", "l2"))
+    latencies = timed_calls(parser_merge.process_file, [(key,) for key in store.keys("l1")[:LATENCY_SAMPLE]])
+    start = time.perf_counter()
+    parser_merge.merge_json_files()
+    return result("merge", size, size, time.perf_counter() - start, latencies)
+
+
+def stub_client(client):
+    # Without an emulator, writes are still encoded into batches by the real client, but a commit sends nothing
+    from google.cloud.firestore_v1.batch import WriteBatch
+
+    class StubWriteBatch(WriteBatch):
+        def commit(self, *args, **kwargs):
+            return []
+
+    client.batch = lambda: StubWriteBatch(client)
+    return client
+
+
+def bench_upload(root, size):
+    # Against the Firestore emulator when FIRESTORE_EMULATOR_HOST is set, otherwise against a stub client that commits
+    # nothing; latencies are per committed batch of up to 500 writes or 9 MiB
+    firestore = "emulator" if os.environ.get("FIRESTORE_EMULATOR_HOST") else "stub"
+    if firestore == "stub":
+        # The uploader creates its client on import; with an emulator address it needs no credentials and connects to
+        # nothing until a commit, which the stub never sends
+        os.environ["FIRESTORE_EMULATOR_HOST"] = "localhost:8080"
+    uploader = importlib.import_module("upload.uploader")
+    if firestore == "stub":
+        stub_client(uploader.db)
+        # The write rate stands for the Firestore quota, which the stub does not have
+        uploader.write_rate = AdaptiveRate(1_000_000_000)
+    uploader.store = store = open_store(root)
+    uploader.MANIFEST_PATH = os.path.join(root, "upload-manifest.json")
+    uploader.FORCE_RUN = True
+    ensure_inputs(store, size, ("md", "l1", "l2"))
+    latencies = []
+    commit_batch = uploader.commit_batch
+
+    def timed_commit_batch(collection, writes):
+        start = time.perf_counter()
+        outcome = commit_batch(collection, writes)
+        latencies.append(time.perf_counter() - start)
+        return outcome
+
+    uploader.commit_batch = timed_commit_batch
+    start = time.perf_counter()
+    writes = sum(uploader.sync_collection(collection)[0] for collection in uploader.COLLECTIONS)
+    return {**result("upload", size, writes, time.perf_counter() - start, latencies), "firestore": firestore}
+
+
+BENCHMARKS = {
+    "convert": bench_convert,
+    "parse_l1": bench_parse_l1,
+    "parse_l2": bench_parse_l2,
+    "merge": bench_merge,
+    "upload": bench_upload,
+}
+
+
+def run_case(path, size, root):
+    # Every case runs in its own process so peak RSS belongs to that case alone; the result is the last stdout line
+    process = subprocess.run(
+        [sys.executable, "-m", "bench.suite", path, str(size), root], capture_output=True, text=True
+    )
+    if process.returncode != 0:
+        return {"path": path, "documents": size, "failed": process.stderr.strip().splitlines()[-1:]}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def compare(results, baseline):
+    # Lower throughput or higher p99 than the baseline by more than TOLERANCE is reported as a regression
+    previous = {(case["path"], case["documents"]): case for case in baseline.get("results", [])}
+    regressions = []
+    for case in results:
+        before = previous.get((case["path"], case["documents"]))
+        if not before or "throughput" not in case or "throughput" not in before:
+            continue
+        if case.get("firestore") != before.get("firestore"):
+            # Uploads to the emulator and to the stub are not comparable
+            continue
+        changes = []
+        if before["throughput"] and case["throughput"] < before["throughput"] * (1 - TOLERANCE):
+            changes.append(f"throughput {before['throughput']} -> {case['throughput']}/s")
+        if before["p99_ms"] and case["p99_ms"] and case["p99_ms"] > before["p99_ms"] * (1 + TOLERANCE):
+            changes.append(f"p99 {before['p99_ms']} -> {case['p99_ms']}ms")
+        if changes:
+            regressions.append(f"{case['path']} at {case['documents']}: {', '.join(changes)}")
+    return regressions
+
+
+def write_results(filename, payload):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, filename)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(payload, indent=4))
+    os.replace(tmp_path, path)
+    return path
+
+
+def run_suite():
+    results = []
+    print(f"{'path':<10} {'documents':>9} {'seconds':>9} {'items/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'rss MB':>8}")
+    for size in SIZES:
+        # Paths at one size share a store, so later paths work on what the earlier ones produced
+        with tempfile.TemporaryDirectory() as root:
+            for path in PATHS:
+                case = run_case(path, size, root)
+                results.append(case)
+                if "skipped" in case or "failed" in case:
+                    print(f"{path:<10} {size:>9} {case.get('skipped') or case.get('failed')}")
+                    continue
+                print(
+                    f"{path:<10} {size:>9} {case['seconds']:>9.2f} {case['throughput']:>9.1f} "
+                    f"{case['p50_ms'] or 0:>9.2f} {case['p99_ms'] or 0:>9.2f} {case['peak_rss_mb']:>8.1f}"
+                )
+
+    payload = {
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    print(f"Results written to {write_results('latest.json', payload)}")
+    baseline_path = os.path.join(RESULTS_DIR, f"{BASELINE}.json")
+    if SAVE_BASELINE:
+        print(f"Baseline saved to {write_results(f'{BASELINE}.json', payload)}")
+    elif os.path.exists(baseline_path):
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f))
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        print(f"{len(regressions)} regressions against {baseline_path} (tolerance {TOLERANCE:.0%})")
+        return len(regressions)
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4:
+        print(json.dumps(BENCHMARKS[sys.argv[1]](sys.argv[3], int(sys.argv[2]))))
+    else:
+        sys.exit(1 if run_suite() else 0)
@@ -0,0 +1,71 @@
+import importlib
+import os
+import shutil
+import tempfile
+import time
+
+from bench.corpus import build_store
+from utils.store import import_directory, open_store
+
+DOCUMENTS = int(os.environ.get("BENCH_DOCUMENTS", 2000))
+CHANGED = int(os.environ.get("BENCH_CHANGED", 20))
+DELETED = int(os.environ.get("BENCH_DELETED", 5))
+
+
+def point_uploader_at(uploader, root):
+    uploader.store = open_store(root)
+    uploader.MANIFEST_PATH = os.path.join(root, "upload-manifest.json")
+    import_directory(uploader.store, root)
+
+
+def upload_all(uploader):
+    start = time.perf_counter()
+    writes = sum(uploader.sync_collection(collection)[0] for collection in uploader.COLLECTIONS)
+    return writes, time.perf_counter() - start
+
+
+def check_remote(uploader):
+    # Every local document must be in the emulator with the same content, and nothing else
+    mismatches = 0
+    for collection in uploader.COLLECTIONS:
+        local = set(uploader.local_hashes(collection))
+        for snapshot in uploader.db.collection(collection).stream():
+            if snapshot.id not in local or snapshot.to_dict() != uploader.read_document(collection, snapshot.id):
+                mismatches += 1
+            local.discard(snapshot.id)
+        mismatches += len(local)
+    return mismatches
+
+
+def run_benchmark():
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        raise Exception("Start the Firestore emulator and set FIRESTORE_EMULATOR_HOST (e.g. localhost:8080)")
+
+    uploader = importlib.import_module("upload.uploader")
+    with tempfile.TemporaryDirectory() as root:
+        build_store(root, DOCUMENTS)
+        shutil.rmtree(os.path.join(root, "json/l2"))
+        shutil.copytree(os.path.join(root, "json/l1"), os.path.join(root, "json/l2"))
+        point_uploader_at(uploader, root)
+        uploader.RECONCILE = True
+
+        initial_writes, initial_elapsed = upload_all(uploader)
+        unchanged_writes, unchanged_elapsed = upload_all(uploader)
+
+        keys = uploader.store.keys("md")
+        revised = [(key, content + "\nRevised\n") for key, content in uploader.store.items("md", keys[:CHANGED])]
+        uploader.store.put_many("md", revised)
+        uploader.store.delete("md", keys[CHANGED : CHANGED + DELETED])
+        refresh_writes, refresh_elapsed = upload_all(uploader)
+
+        mismatches = check_remote(uploader)
+
+    print(f"\n{DOCUMENTS} biographies in 3 collections")
+    print(f"initial upload: {initial_writes} writes in {initial_elapsed:.2f}s")
+    print(f"unchanged re-run: {unchanged_writes} writes in {unchanged_elapsed:.2f}s")
+    print(f"refresh ({CHANGED} changed, {DELETED} deleted): {refresh_writes} writes in {refresh_elapsed:.2f}s")
+    print(f"documents differing from the local store: {mismatches}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -1,28 +1,57 @@
-import concurrent.futures
+import asyncio
+import hashlib
+import itertools
+import json
 import os
+import re
+import sqlite3
+import sys
+import time
+from collections import Counter
 from concurrent.futures import ProcessPoolExecutor
-from urllib.parse import urljoin, urlparse
+from html import unescape
+from html.entities import html5
+from urllib.parse import urldefrag, urljoin, urlparse
 
 import html2text
-import requests
+import httpx
 from bs4 import BeautifulSoup
 from tqdm import tqdm
 
-from utils.workers import get_worker_count
+from utils.archive import Archive
+from utils.metrics import metrics, write_metrics
+from utils.store import open_store
 
 BASE_URL = "https://mathshistory.st-andrews.ac.uk/Biographies/"
-OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "..", "store/md")
-
-WORKERS = get_worker_count()
-
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-
-def get_biography_links(letter_url):
-    session = requests.Session()
-    resp = session.get(letter_url)
-    resp.raise_for_status()
-    soup = BeautifulSoup(resp.text, "html.parser")
+MANIFEST_PATH = os.path.join(os.path.dirname(__file__), "..", "store/crawl-manifest.json")
+FRONTIER_PATH = os.path.join(os.path.dirname(__file__), "..", "store/crawl-frontier.sqlite")
+ARCHIVE_DIR = os.path.join(os.path.dirname(__file__), "..", "store/archive")
+
+CONCURRENCY = int(os.environ.get("CRAWL_CONCURRENCY", 16))
+HOST_CONCURRENCY = int(os.environ.get("CRAWL_HOST_CONCURRENCY", 8))
+HOST_DELAY = float(os.environ.get("CRAWL_HOST_DELAY", 0))
+CONVERT_WORKERS = int(os.environ.get("CONVERT_WORKERS", 0))
+REQUEST_TIMEOUT = 30
+MAX_RETRIES = 3
+# Times a URL is taken from the frontier before it is given up on; each attempt already retries transient errors
+MAX_ATTEMPTS = int(os.environ.get("CRAWL_MAX_ATTEMPTS", 3))
+# Index sections whose pages are parsed for biography links: the letter-* pages and the chronological listing
+SECTIONS = os.environ.get("CRAWL_SECTIONS", "letters").split(",")
+INDEX_SECTIONS = ("letters", "chronological")
+MANIFEST_SAVE_EVERY = 100
+RESTART = os.environ.get("CRAWL_RESTART", "").lower() in ("1", "true", "yes")
+# Raw responses are kept in the archive unless CRAWL_ARCHIVE=0, so the markdown can be regenerated without the network
+ARCHIVE = os.environ.get("CRAWL_ARCHIVE", "1").lower() in ("1", "true", "yes")
+REPLAY_WORKERS = int(os.environ.get("REPLAY_WORKERS", os.cpu_count() or 1))
+REPLAY_BATCH = 64
+
+FORCE_RUN = os.environ.get("FORCE_RUN", "").lower() in ("1", "true", "yes")
+
+store = open_store()
+
+
+def get_biography_links(letter_url, html):
+    soup = BeautifulSoup(html, "html.parser")
     bio_links = []
     for a in soup.select("a[href^='../']"):
         href = a.get("href")
@@ -39,60 +68,158 @@ def get_biography_links(letter_url):
     return bio_links
 
 
-def convert_html_to_markdown(html):
-    h = html2text.HTML2Text()
-    h.ignore_links = False
-    h.body_width = 0
-    md = h.handle(html).strip()
-    while "\n\n" in md:
-        md = md.replace("\n\n", "\n")
-    return md
+VOID_TAGS = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "link",
+    "meta",
+    "param",
+    "source",
+    "track",
+    "wbr",
+}
+
+MOJIBAKE = {
+    "Ã¶": "ö",
+    "Ã¤": "ä",
+    "Ã¼": "ü",
+    "Ã": "Ä",
+    "Ã©": "é",
+    "Ã¨": "è",
+    "Ã¡": "á",
+    "Ã ": "à",
+    "Ã¢": "â",
+    "Ã®": "î",
+    "Ã´": "ô",
+    "Ã»": "û",
+    "Ã§": "ç",
+    "Ã±": "ñ",
+}
+
+# Alternation is tried in table order, which reproduces applying the replacements one after another
+MARKDOWN_FIXES = re.compile("\n{2,}|" + "|".join(re.escape(wrong) for wrong in MOJIBAKE))
+ESCAPED_CHARS = re.compile("([&<>])")
+
+
+class BiographyConverter(html2text.HTML2Text):
+    # Feeds html2text the same token stream it used to get from a BeautifulSoup round trip (entities decoded into
+    # merged text, stray end tags dropped, unclosed tags closed) while resolving links in the same parse
+    def __init__(self, base_url=""):
+        super().__init__()
+        self.ignore_links = False
+        self.body_width = 0
+        self.base_url = base_url
+        self.open_tags = []
+        self.text = []
+
+    def flush_text(self):
+        if not self.text:
+            return
+        text = "".join(self.text)
+        self.text = []
+        for i, piece in enumerate(ESCAPED_CHARS.split(text)):
+            if piece:
+                super().handle_data(piece, i % 2 == 1)
+
+    def handle_data(self, data, entity_char=False):
+        if entity_char:
+            self.flush_text()
+            super().handle_data(data, entity_char)
+        else:
+            self.text.append(data)
+
+    def handle_entityref(self, name):
+        self.text.append(html5.get(name + ";", "&" + name))
+
+    def handle_charref(self, name):
+        self.text.append(unescape(f"&#{name};"))
+
+    def handle_starttag(self, tag, attrs):
+        self.flush_text()
+        attrs = [(name, value or "") for name, value in attrs]
+        if tag == "a" and self.base_url:
+            attrs = [(name, urljoin(self.base_url, value) if name == "href" else value) for name, value in attrs]
+        super().handle_starttag(tag, attrs)
+        if tag in VOID_TAGS:
+            super().handle_endtag(tag)
+        else:
+            self.open_tags.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag not in self.open_tags:
+            return
+        self.flush_text()
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            super().handle_endtag(open_tag)
+            if open_tag == tag:
+                break
 
+    def handle_comment(self, data):
+        self.flush_text()
 
-def save_markdown(url, markdown):
+    def handle_decl(self, decl):
+        self.flush_text()
+
+    def handle_pi(self, data):
+        self.flush_text()
+
+    def unknown_decl(self, data):
+        self.flush_text()
+
+    def close(self):
+        super().close()
+        self.flush_text()
+        while self.open_tags:
+            super().handle_endtag(self.open_tags.pop())
+
+
+def fix_markdown(match):
+    text = match.group(0)
+    return "\n" if text[0] == "\n" else MOJIBAKE[text]
+
+
+def convert_html_to_markdown(html, base_url=""):
+    md = BiographyConverter(base_url).handle(html).strip()
+    return MARKDOWN_FIXES.sub(fix_markdown, md)
+
+
+def markdown_key(url):
     path = urlparse(url).path
-    filename = os.path.basename(path.strip("/")) + ".md"
-    filepath = os.path.join(OUTPUT_DIR, filename)
-
-    replacements = {
-        "Ã¶": "ö",
-        "Ã¤": "ä",
-        "Ã¼": "ü",
-        "Ã": "Ä",
-        "Ã©": "é",
-        "Ã¨": "è",
-        "Ã¡": "á",
-        "Ã ": "à",
-        "Ã¢": "â",
-        "Ã®": "î",
-        "Ã´": "ô",
-        "Ã»": "û",
-        "Ã§": "ç",
-        "Ã±": "ñ",
-    }
+    return os.path.basename(path.strip("/"))
 
-    for wrong, correct in replacements.items():
-        markdown = markdown.replace(wrong, correct)
 
-    with open(filepath, "w", encoding="utf-8") as f:
-        f.write(markdown)
+def markdown_filename(url):
+    return markdown_key(url) + ".md"
 
-    return filename
+
+def save_markdown(url, markdown):
+    store.put("md", markdown_key(url), markdown)
+    return markdown_filename(url)
 
 
 def clean_html(html: str) -> str:
-    while "<!--noindex-->" in html and "<!--endnoindex-->" in html:
-        start = html.find("<!--noindex-->")
-        end = html.find("<!--endnoindex-->", start) + len("<!--endnoindex-->")
-        if end > start:
-            html = html[:start] + html[end:]
-        else:
+    pieces = []
+    pos = 0
+    while True:
+        start = html.find("<!--noindex-->", pos)
+        if start == -1:
+            break
+        end = html.find("<!--endnoindex-->", start)
+        if end == -1:
             break
+        pieces.append(html[pos:start])
+        pos = end + len("<!--endnoindex-->")
+    pieces.append(html[pos:])
 
-    lines = html.splitlines()
     filtered = []
-
-    for line in lines:
+    for line in "".join(pieces).splitlines():
         stripped = line.strip()
         if stripped.startswith("Written by") or stripped.startswith("Last Update"):
             continue
@@ -101,83 +228,477 @@ def clean_html(html: str) -> str:
     return "\n".join(filtered)
 
 
-def process_biography(bio_url):
-    try:
-        session = requests.Session()
-        resp = session.get(bio_url)
-        resp.raise_for_status()
-
-        if resp.encoding.lower() != "utf-8":
-            resp.encoding = "utf-8"
-
-        html = clean_html(resp.text)
-        soup = BeautifulSoup(html, "html.parser")
-
-        meta_tag = soup.new_tag("meta")
-        meta_tag.attrs["charset"] = "utf-8"
-        if soup.head is None:
-            head_tag = soup.new_tag("head")
-            head_tag.append(meta_tag)
-            if soup.html is None:
-                html_tag = soup.new_tag("html")
-                html_tag.append(head_tag)
-                soup.append(html_tag)
-            else:
-                soup.html.insert(0, head_tag)
+def render_biography(bio_url, html):
+    return convert_html_to_markdown(clean_html(html), bio_url)
+
+
+def load_manifest(path=None):
+    path = path or MANIFEST_PATH
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, path=None):
+    path = path or MANIFEST_PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(manifest, indent=4, ensure_ascii=False, sort_keys=True))
+    os.replace(tmp_path, path)
+
+
+def conditional_headers(url, manifest, archive=None):
+    # A page missing from the archive is fetched in full once, so the archive covers unchanged pages as well
+    entry = manifest.get(url)
+    if FORCE_RUN or not entry or not store.exists("md", markdown_key(url)):
+        return {}
+    if archive is not None and archive.latest_digest(url) is None:
+        return {}
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+class HostThrottle:
+    def __init__(self, concurrency=HOST_CONCURRENCY, delay=HOST_DELAY):
+        self.concurrency = concurrency
+        self.delay = delay
+        self.semaphores = {}
+        self.locks = {}
+        self.last_request = {}
+
+    async def wait(self, host):
+        if self.delay <= 0:
+            return
+        lock = self.locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            elapsed = time.monotonic() - self.last_request.get(host, 0)
+            if elapsed < self.delay:
+                await asyncio.sleep(self.delay - elapsed)
+            self.last_request[host] = time.monotonic()
+
+    def semaphore(self, host):
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.concurrency)
+        return self.semaphores[host]
+
+
+def canonical_url(url):
+    # The same page linked from several index pages, with or without a fragment or trailing slash, is crawled once
+    url = urldefrag(url)[0]
+    return url if url.endswith("/") else url + "/"
+
+
+def index_urls(base_url, letters, sections):
+    urls = []
+    for section in sections:
+        if section == "letters":
+            urls += [f"{base_url}letter-{letter}/" for letter in letters]
+        elif section == "chronological":
+            urls.append(f"{base_url}chronological/")
         else:
-            soup.head.insert(0, meta_tag)
+            raise Exception(f"Unknown crawl section {section}, expected one of {', '.join(INDEX_SECTIONS)}")
+    return urls
+
+
+class Frontier:
+    # Every URL the current crawl has seen, with whether it is still to fetch, done or given up on. A crawl that stops
+    # before its frontier is drained is resumed by the next run; a finished one is started over
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, kind TEXT NOT NULL, parent TEXT, "
+                "status TEXT NOT NULL, attempts INTEGER NOT NULL, error TEXT, updated REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS crawl (id INTEGER PRIMARY KEY CHECK (id = 1), started REAL NOT NULL, "
+                "finished REAL)"
+            )
+        return self.connection
+
+    def start(self, seeds, restart=False):
+        # Returns whether an unfinished crawl is being resumed
+        connection = self.connect()
+        row = connection.execute("SELECT finished FROM crawl").fetchone()
+        resumed = row is not None and row[0] is None and not restart
+        if not resumed:
+            connection.execute("BEGIN")
+            connection.execute("DELETE FROM urls")
+            connection.execute(
+                "INSERT OR REPLACE INTO crawl (id, started, finished) VALUES (1, ?, NULL)", (time.time(),)
+            )
+            connection.execute("COMMIT")
+        self.add(seeds, "index")
+        return resumed
+
+    def add(self, urls, kind, parent=None):
+        # Returns the URLs not seen before in this crawl
+        connection = self.connect()
+        added = []
+        connection.execute("BEGIN")
+        for url in dict.fromkeys(map(canonical_url, urls)):
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO urls (url, kind, parent, status, attempts, updated) "
+                "VALUES (?, ?, ?, 'pending', 0, ?)",
+                (url, kind, parent, time.time()),
+            )
+            if cursor.rowcount:
+                added.append(url)
+        connection.execute("COMMIT")
+        return added
+
+    def pending(self):
+        # Index pages first, so discovery runs ahead of the biography fetches
+        return (
+            self.connect()
+            .execute("SELECT url, kind FROM urls WHERE status = 'pending' ORDER BY kind = 'biography', rowid")
+            .fetchall()
+        )
+
+    def complete(self, url):
+        self.connect().execute(
+            "UPDATE urls SET status = 'done', attempts = attempts + 1, error = NULL, updated = ? WHERE url = ?",
+            (time.time(), url),
+        )
+
+    def fail(self, url, error, max_attempts=MAX_ATTEMPTS):
+        # Returns whether the URL goes back into the queue
+        connection = self.connect()
+        attempts = connection.execute("SELECT attempts FROM urls WHERE url = ?", (url,)).fetchone()[0] + 1
+        status = "pending" if attempts < max_attempts else "failed"
+        connection.execute(
+            "UPDATE urls SET status = ?, attempts = ?, error = ?, updated = ? WHERE url = ?",
+            (status, attempts, error, time.time(), url),
+        )
+        return status == "pending"
+
+    def finish(self):
+        # The crawl is over once nothing is left to fetch, failed URLs included
+        connection = self.connect()
+        if connection.execute("SELECT 1 FROM urls WHERE status = 'pending' LIMIT 1").fetchone() is None:
+            connection.execute("UPDATE crawl SET finished = ?", (time.time(),))
+            return True
+        return False
+
+    def done(self, kind="biography"):
+        query = "SELECT url FROM urls WHERE kind = ? AND status = 'done' ORDER BY rowid"
+        return [url for url, in self.connect().execute(query, (kind,))]
+
+    def counts(self):
+        rows = self.connect().execute("SELECT kind, status, COUNT(*) FROM urls GROUP BY kind, status")
+        return {(kind, status): count for kind, status, count in rows}
+
+
+def open_archive():
+    return Archive(ARCHIVE_DIR) if ARCHIVE else None
+
+
+def archive_response(archive, url, resp, kind):
+    if archive is not None:
+        written = archive.append(url, resp.status_code, resp.headers, resp.content, kind)
+        metrics.increment("archive_records", kind=kind, result="written" if written else "unchanged")
+        metrics.increment("archive_bytes_written", written)
+
+
+def create_client(concurrency=CONCURRENCY):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    timeout = httpx.Timeout(REQUEST_TIMEOUT, pool=None)
+    return httpx.AsyncClient(limits=limits, timeout=timeout, follow_redirects=True)
+
+
+async def fetch(client, throttle, url, headers=None, max_retries=MAX_RETRIES):
+    host = urlparse(url).netloc
+    retries = 0
+    while True:
+        async with throttle.semaphore(host):
+            await throttle.wait(host)
+            start = time.perf_counter()
+            try:
+                resp = await client.get(url, headers=headers)
+                metrics.observe("http_request_seconds", time.perf_counter() - start, status=resp.status_code)
+                metrics.increment("http_bytes_received", len(resp.content))
+                if resp.status_code == 304:
+                    return resp
+                if resp.status_code != 429 and resp.status_code < 500:
+                    resp.raise_for_status()
+                    return resp
+                error = f"HTTP {resp.status_code}"
+            except httpx.TransportError as e:
+                metrics.observe("http_request_seconds", time.perf_counter() - start, status="error")
+                error = str(e) or type(e).__name__
+        retries += 1
+        if retries > max_retries:
+            raise Exception(f"Max retries ({max_retries}) exceeded for {url}: {error}")
+        metrics.increment("http_retries")
+        metrics.increment("http_backoff_seconds", 2**retries)
+        await asyncio.sleep(2**retries)
+
+
+async def fetch_html(client, throttle, url):
+    resp = await fetch(client, throttle, url)
+    return resp.content.decode("utf-8", errors="replace")
+
+
+async def process_biography(client, throttle, bio_url, manifest, executor=None, archive=None):
+    with metrics.span("crawl_biography_seconds", markdown_key(bio_url)):
+        success, result, changed = await fetch_biography(client, throttle, bio_url, manifest, executor, archive)
+    outcome = "failed" if not success else "changed" if changed else "unchanged"
+    metrics.increment("crawl_biographies", result=outcome)
+    return success, result, changed
+
+
+def store_biography(bio_url, markdown, headers, manifest):
+    content_hash = hashlib.sha256(markdown.encode("utf-8")).hexdigest()
+    filename = markdown_filename(bio_url)
+    entry = manifest.get(bio_url, {})
+    changed = FORCE_RUN or entry.get("hash") != content_hash or not store.exists("md", markdown_key(bio_url))
+    if changed:
+        save_markdown(bio_url, markdown)
+        metrics.increment("store_bytes_written", len(markdown.encode("utf-8")), collection="md")
+
+    manifest[bio_url] = {
+        "etag": headers.get("etag"),
+        "last_modified": headers.get("last-modified"),
+        "hash": content_hash,
+        "filename": filename,
+    }
+    return filename, changed
 
-        for a in soup.find_all("a", href=True):
-            a["href"] = urljoin(bio_url, a["href"])
 
-        markdown = convert_html_to_markdown(str(soup))
-        filename = save_markdown(bio_url, markdown)
-        return True, filename
-    except Exception as e:
-        return False, f"Error processing {bio_url}: {str(e)}"
+async def fetch_biography(client, throttle, bio_url, manifest, executor=None, archive=None):
+    try:
+        resp = await fetch(client, throttle, bio_url, conditional_headers(bio_url, manifest, archive))
+        if resp.status_code == 304:
+            return True, manifest[bio_url]["filename"], False
+        archive_response(archive, bio_url, resp, "biography")
+
+        html = resp.content.decode("utf-8", errors="replace")
+        with metrics.span("convert_seconds"):
+            if executor is None:
+                markdown = render_biography(bio_url, html)
+            else:
+                loop = asyncio.get_running_loop()
+                markdown = await loop.run_in_executor(executor, render_biography, bio_url, html)
 
+        filename, changed = store_biography(bio_url, markdown, resp.headers, manifest)
+        return True, filename, changed
+    except Exception as e:
+        return False, f"Error processing {bio_url}: {str(e)}", False
+
+
+async def walk_frontier(
+    client, throttle, frontier, concurrency, visit_biography, archive=None, discovered=None, gave_up=None
+):
+    # Index pages and biographies share one priority queue backed by the frontier: biography URLs are fetched as soon
+    # as the index page listing them is parsed, while the remaining index pages go first. visit_biography(url) returns
+    # None or an error; failed URLs are re-queued until MAX_ATTEMPTS, then passed to gave_up(url, error).
+    # discovered(count) is told about new biographies, the pending ones included. Returns the URLs given up on, by kind
+    queue = asyncio.PriorityQueue()
+    sequence = itertools.count()
+    given_up = Counter()
+
+    def enqueue(url, kind):
+        queue.put_nowait((kind == "biography", next(sequence), url, kind))
+
+    pending = frontier.pending()
+    for url, kind in pending:
+        enqueue(url, kind)
+    if discovered is not None:
+        discovered(sum(kind == "biography" for _, kind in pending))
+
+    async def visit_index(url):
+        try:
+            resp = await fetch(client, throttle, url)
+            archive_response(archive, url, resp, "index")
+            links = get_biography_links(url, resp.content.decode("utf-8", errors="replace"))
+        except Exception as e:
+            if frontier.fail(url, str(e)):
+                enqueue(url, "index")
+            else:
+                given_up["index"] += 1
+                print(f"\nError getting links from {url}: {str(e)}")
+            return
+        added = frontier.add(links, "biography", parent=url)
+        for link in added:
+            enqueue(link, "biography")
+        frontier.complete(url)
+        if discovered is not None:
+            discovered(len(added))
+
+    async def visit(url):
+        error = await visit_biography(url)
+        if error is None:
+            frontier.complete(url)
+        elif frontier.fail(url, error):
+            metrics.increment("crawl_requeued")
+            enqueue(url, "biography")
+        else:
+            given_up["biography"] += 1
+            if gave_up is not None:
+                gave_up(url, error)
+
+    async def worker():
+        while True:
+            _, _, url, kind = await queue.get()
+            try:
+                await (visit_index(url) if kind == "index" else visit(url))
+            finally:
+                queue.task_done()
+            metrics.gauge("crawl_frontier_pending", queue.qsize())
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        await queue.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    frontier.finish()
+    return given_up
+
+
+def start_frontier(base_url, letters, sections=None, frontier=None):
+    frontier = frontier or Frontier(FRONTIER_PATH)
+    resumed = frontier.start(index_urls(base_url, letters, sections or SECTIONS), restart=FORCE_RUN or RESTART)
+    if resumed:
+        done = sum(count for (_, status), count in frontier.counts().items() if status == "done")
+        print(f"Resuming crawl: {done} pages already done")
+    return frontier
+
+
+async def crawl_biographies_async(
+    base_url=BASE_URL, letters=None, concurrency=CONCURRENCY, sections=None, frontier=None
+):
+    if letters is None:
+        letters = [chr(letter) for letter in range(ord("a"), ord("z") + 1)]
+    throttle = HostThrottle(concurrency=min(concurrency, HOST_CONCURRENCY))
+    executor = ProcessPoolExecutor(max_workers=CONVERT_WORKERS) if CONVERT_WORKERS > 0 else None
+    archive = open_archive()
+    manifest = load_manifest()
+    frontier = start_frontier(base_url, letters, sections, frontier)
+    stats = Counter()
+
+    def discovered(count):
+        pbar.total += count
+        pbar.refresh()
+
+    def gave_up(url, error):
+        print(f"\n{error}")
+        pbar.update(1)
+
+    async def visit_biography(url):
+        success, result, changed = await process_biography(client, throttle, url, manifest, executor, archive)
+        if not success:
+            return result
+        stats["success"] += 1
+        stats["changed"] += changed
+        if stats["success"] % MANIFEST_SAVE_EVERY == 0:
+            save_manifest(manifest)
+        pbar.update(1)
+        return None
 
-def crawl_biographies():
-    letters = [chr(letter) for letter in range(ord("a"), ord("z") + 1)]
-    all_bio_links = []
-    for letter in letters:
-        letter_url = f"{BASE_URL}letter-{letter}/"
-        print(f"Processing letter page: {letter_url}")
+    try:
+        async with create_client(concurrency) as client:
+            with tqdm(total=0, desc="Fetching biographies") as pbar:
+                given_up = await walk_frontier(
+                    client, throttle, frontier, concurrency, visit_biography, archive, discovered, gave_up
+                )
+    finally:
+        save_manifest(manifest)
+        if executor is not None:
+            executor.shutdown()
+        if archive is not None:
+            archive.close()
+
+    print(
+        f"Completed: {stats['success']} succeeded ({stats['changed']} changed), {given_up['biography']} failed"
+        + (f", {given_up['index']} index pages failed" if given_up["index"] else "")
+    )
+    return stats["success"], given_up["biography"]
+
+
+def crawl_biographies(base_url=BASE_URL, letters=None, concurrency=CONCURRENCY, sections=None, frontier=None):
+    return asyncio.run(crawl_biographies_async(base_url, letters, concurrency, sections, frontier))
+
+
+def replay_batch(archive_dir, records):
+    # Runs in a worker process: reads its records straight from the segments and converts them
+    archive = Archive(archive_dir)
+    results = []
+    for url, segment, offset, length in records:
         try:
-            bio_links = get_biography_links(letter_url)
-            all_bio_links.extend(bio_links)
-            print(f"Found {len(bio_links)} biographies for letter '{letter}'")
+            _, _, headers, body = archive.read(segment, offset, length)
+            results.append((url, render_biography(url, body.decode("utf-8", errors="replace")), headers, None))
         except Exception as e:
-            print(f"Error getting links for letter {letter}: {str(e)}")
-
-    print(f"Processing {len(all_bio_links)} biographies with {WORKERS} workers")
-
-    success_count = 0
-    error_count = 0
-
-    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
-        with tqdm(total=len(all_bio_links), desc="Fetching biographies") as pbar:
-            future_to_url = {
-                executor.submit(process_biography, url): url for url in all_bio_links
-            }
-            for future in concurrent.futures.as_completed(future_to_url):
-                url = future_to_url[future]
-                try:
-                    success, result = future.result()
-                    if success:
-                        success_count += 1
+            results.append((url, None, None, str(e) or type(e).__name__))
+    return results
+
+
+def replay_biographies(workers=REPLAY_WORKERS):
+    # Regenerates store/md from the newest archived response of every biography, with no network; the manifest is
+    # rebuilt from the archived headers, so a later crawl still sends conditional requests. Biographies in the manifest
+    # with no archived response cannot be replayed and are counted as failed
+    archive = Archive(ARCHIVE_DIR)
+    records = archive.latest("biography")
+    batches = [records[i : i + REPLAY_BATCH] for i in range(0, len(records), REPLAY_BATCH)]
+    manifest = load_manifest()
+    archived = {record[0] for record in records}
+    missing = [url for url in manifest if url not in archived]
+    stats = Counter()
+    if missing:
+        stats["error"] += len(missing)
+        metrics.increment("replay_biographies", len(missing), result="missing")
+        print(
+            f"{len(missing)} biographies in the manifest have no archived response and are not replayed "
+            f"(e.g. {missing[0]}); crawl them again with CRAWL_ARCHIVE=1 to archive them"
+        )
+    start = time.perf_counter()
+    try:
+        with (
+            ProcessPoolExecutor(max_workers=workers) as executor,
+            tqdm(total=len(records), desc="Replaying biographies") as pbar,
+        ):
+            for results in executor.map(replay_batch, itertools.repeat(ARCHIVE_DIR), batches):
+                for url, markdown, headers, error in results:
+                    if error is not None:
+                        stats["error"] += 1
+                        print(f"\nError replaying {url}: {error}")
                     else:
-                        error_count += 1
-                        print(f"\n{result}")
-                except Exception as exc:
-                    print(f"\nError processing {url}: {exc}")
-                    error_count += 1
-
-                pbar.update(1)
-
-    print(f"Completed: {success_count} succeeded, {error_count} failed")
-    return success_count, error_count
+                        _, changed = store_biography(url, markdown, headers, manifest)
+                        stats["success"] += 1
+                        stats["changed"] += changed
+                    metrics.increment("replay_biographies", result="failed" if error else "replayed")
+                pbar.update(len(results))
+    finally:
+        save_manifest(manifest)
+    elapsed = time.perf_counter() - start
+    print(
+        f"Replayed {stats['success']} biographies in {elapsed:.2f}s ({stats['changed']} changed), "
+        f"{stats['error']} failed"
+    )
+    return stats["success"], stats["error"]
 
 
 if __name__ == "__main__":
-    crawl_biographies()
+    command = sys.argv[1] if len(sys.argv) > 1 else "crawl"
+    if command == "crawl":
+        crawl_biographies()
+        write_metrics("crawl")
+    elif command == "replay":
+        replay_biographies()
+        write_metrics("replay")
+    else:
+        raise Exception("Usage: python -m crawler.crawler [crawl|replay]")
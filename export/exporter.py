@@ -0,0 +1,227 @@
+import gzip
+import hashlib
+import json
+import os
+from collections import Counter
+
+from utils.store import open_store
+
+LOCATIONS_PATH = os.path.join(os.path.dirname(__file__), "..", "store/json/locations.json")
+EXPORT_DIR = os.path.join(os.path.dirname(__file__), "..", "store/bundle")
+
+FORMAT_VERSION = 1
+INDEX_FILENAME = "index.json.gz"
+SHARD_PREFIX = "shard-"
+UNKNOWN_SHARD = "unknown"
+COMPRESS_LEVEL = 9
+
+# Same estimate the app uses for people whose birth year is unknown
+AVERAGE_LIFESPAN = 50
+LIST_FIELDS = ("lived_in", "worked_in", "religions", "profession", "institution_affiliation", "locations")
+CONNECTION_TYPE_ALIASES = {"collaborator with": "collaborated with"}
+
+store = open_store()
+
+
+class StringTable:
+    # Places, professions, institutions, religions, connection types and people are stored once in the index and
+    # referenced everywhere else by position, -1 standing for a missing value
+    def __init__(self):
+        self.values = []
+        self.positions = {}
+
+    def intern(self, value):
+        if value is None:
+            return -1
+        position = self.positions.get(value)
+        if position is None:
+            position = self.positions[value] = len(self.values)
+            self.values.append(value)
+        return position
+
+
+def estimated_birth_year(document):
+    born = (document.get("born") or {}).get("year")
+    if born is not None:
+        return born
+    died = (document.get("died") or {}).get("year")
+    return died - AVERAGE_LIFESPAN if died is not None else None
+
+
+def shard_key(year):
+    return UNKNOWN_SHARD if year is None else str(year // 100 * 100)
+
+
+def shard_order(document):
+    year = estimated_birth_year(document)
+    return (year is None, year // 100 if year is not None else 0, document["id"])
+
+
+def load_documents():
+    documents = []
+    for key, content in store.items("l2"):
+        try:
+            document = json.loads(content)
+            document.setdefault("id", key)
+            documents.append(document)
+        except Exception as ex:
+            print(f"Error reading {key}: {ex}")
+    return documents
+
+
+def load_locations():
+    if not os.path.exists(LOCATIONS_PATH):
+        return {}
+    with open(LOCATIONS_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)["locations"]
+
+
+def location_table(locations, strings):
+    # The location hierarchy from parser-locations, so a filter on a country or region can expand to its places
+    table = {"id": [], "name": [], "kind": [], "parent": []}
+    for id, location in locations.items():
+        table["id"].append(strings.intern(id))
+        table["name"].append(strings.intern(location["name"]))
+        table["kind"].append(strings.intern(location["kind"]))
+        table["parent"].append(strings.intern(location["parent"]))
+    return table
+
+
+def build_bundle(documents, locations=None):
+    # Nodes are ordered by shard so every shard covers a contiguous range of the global node table, and edges point at
+    # global node positions so a view spanning several shards needs no remapping
+    documents = sorted(documents, key=shard_order)
+    strings = StringTable()
+    positions = {document["id"]: position for position, document in enumerate(documents)}
+    nodes = {"id": [], "name": [], "born": [], "died": [], "year": []}
+    shards = {}
+    stats = Counter()
+
+    for position, document in enumerate(documents):
+        born = document.get("born") or {}
+        died = document.get("died") or {}
+        year = estimated_birth_year(document)
+        nodes["id"].append(document["id"])
+        nodes["name"].append(document.get("name") or document["id"])
+        nodes["born"].append(born.get("year"))
+        nodes["died"].append(died.get("year"))
+        nodes["year"].append(year)
+
+        key = shard_key(year)
+        if key not in shards:
+            shards[key] = {
+                "version": FORMAT_VERSION,
+                "key": key,
+                "start": position,
+                "nodes": {
+                    "summary": [],
+                    "picture": [],
+                    "born_approx": [],
+                    "died_approx": [],
+                    "born_place": [],
+                    "died_place": [],
+                    "born_link": [],
+                    "died_link": [],
+                    **{field: [] for field in LIST_FIELDS},
+                },
+                "edges": {"source": [], "target": [], "type": [], "person": []},
+            }
+        shard_nodes = shards[key]["nodes"]
+        shard_nodes["summary"].append(document.get("summary"))
+        shard_nodes["picture"].append(document.get("picture"))
+        shard_nodes["born_approx"].append(bool(born.get("approx")))
+        shard_nodes["died_approx"].append(bool(died.get("approx")))
+        shard_nodes["born_place"].append(strings.intern(born.get("place") or None))
+        shard_nodes["died_place"].append(strings.intern(died.get("place") or None))
+        shard_nodes["born_link"].append(born.get("link"))
+        shard_nodes["died_link"].append(died.get("link"))
+        for field in LIST_FIELDS:
+            shard_nodes[field].append([strings.intern(value) for value in document.get(field) or [] if value])
+
+        edges = shards[key]["edges"]
+        for connection in document.get("connections") or []:
+            connection_type = str(connection.get("connection_type", "")).strip()
+            connection_type = CONNECTION_TYPE_ALIASES.get(connection_type.lower(), connection_type)
+            target = positions.get(connection.get("key"), -1)
+            edges["source"].append(position)
+            edges["target"].append(target)
+            edges["type"].append(strings.intern(connection_type))
+            edges["person"].append(strings.intern(connection.get("person") or connection.get("key")))
+            stats["edges"] += 1
+            stats["unresolved_edges"] += target == -1
+
+    stats["nodes"] = len(documents)
+    index = {"version": FORMAT_VERSION, "strings": strings.values, "nodes": nodes, "shards": []}
+    if locations:
+        index["locations"] = location_table(locations, strings)
+    return index, list(shards.values()), stats
+
+
+def compress(payload):
+    # mtime=0 keeps the output byte-identical across runs, so unchanged shards keep their file names
+    data = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()[:12], gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+
+def write_file(filename, data):
+    file_path = os.path.join(EXPORT_DIR, filename)
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+
+
+def export_bundle(documents=None, locations=None):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    if documents is None:
+        documents = load_documents()
+    if locations is None:
+        locations = load_locations()
+    index, shards, stats = build_bundle(documents, locations)
+
+    # Shard names carry a content hash so they can be cached forever; the index is written last and is the only file
+    # that has to be revalidated
+    for shard in shards:
+        digest, data = compress(shard)
+        filename = f"{SHARD_PREFIX}{shard['key']}.{digest}.json.gz"
+        if not os.path.exists(os.path.join(EXPORT_DIR, filename)):
+            write_file(filename, data)
+        start = shard["start"]
+        year = None if shard["key"] == UNKNOWN_SHARD else int(shard["key"])
+        index["shards"].append(
+            {
+                "key": shard["key"],
+                "from": year,
+                "to": year + 99 if year is not None else None,
+                "start": start,
+                "count": len(shard["nodes"]["summary"]),
+                "edges": len(shard["edges"]["source"]),
+                "file": filename,
+                "bytes": len(data),
+            }
+        )
+    _, data = compress(index)
+    write_file(INDEX_FILENAME, data)
+
+    current = {shard["file"] for shard in index["shards"]}
+    for filename in os.listdir(EXPORT_DIR):
+        if filename.startswith(SHARD_PREFIX) and filename not in current:
+            os.remove(os.path.join(EXPORT_DIR, filename))
+
+    stats["index_bytes"] = len(data)
+    stats["shard_bytes"] = sum(shard["bytes"] for shard in index["shards"])
+    print(
+        f"Exported {stats['nodes']} people and {stats['edges']} connections "
+        f"({stats['unresolved_edges']} to people outside the corpus) into {len(shards)} shards"
+    )
+    print(
+        f"Bundle size: index {stats['index_bytes'] / 1024:.0f} KiB, "
+        f"shards {stats['shard_bytes'] / 1024:.0f} KiB, {len(index['strings'])} interned strings"
+    )
+    return index, stats
+
+
+if __name__ == "__main__":
+    print("Exporting static graph bundle...")
+    export_bundle()
+    print("Export complete!")
@@ -0,0 +1,307 @@
+import json
+import os
+import sys
+import time
+from array import array
+from collections import Counter
+from itertools import accumulate, compress
+from operator import itemgetter, mul, sub
+
+from export.exporter import CONNECTION_TYPE_ALIASES, compress as compress_payload, shard_order
+from utils.store import open_store
+
+EXPORT_PATH = os.path.join(os.path.dirname(__file__), "..", "store/bundle/graph.json.gz")
+
+FORMAT_VERSION = 1
+# PageRank parameters: the usual damping factor, and the L1 change between iterations that counts as converged, well
+# below the four decimals ranks are exported with
+DAMPING = 0.85
+TOLERANCE = 1e-6
+MAX_ITERATIONS = 100
+
+# Lineage edges point from teacher to student whichever side of the relationship the biography was written from
+STUDENT_OF = "student of"
+TEACHER_OF = "teacher of"
+
+store = open_store()
+
+
+def gatherer(indices):
+    # itemgetter returns a bare value for a single index and needs at least one
+    if len(indices) > 1:
+        return itemgetter(*indices)
+    return lambda values: tuple(values[index] for index in indices)
+
+
+class CSR:
+    # Compressed sparse rows: the edges leaving node i are targets[offsets[i]:offsets[i + 1]], with their types at the
+    # same positions
+    def __init__(self, count, sources, targets, types=None):
+        # A stable sort by source keeps the order edges were listed in within each node
+        order = sorted(range(len(sources)), key=sources.__getitem__)
+        degrees = Counter(sources)
+        self.offsets = array("I", accumulate((degrees.get(node, 0) for node in range(count)), initial=0))
+        self.targets = array("I", map(targets.__getitem__, order))
+        self.types = array("H", map(types.__getitem__, order)) if types is not None else None
+
+    def neighbours(self, node):
+        return self.targets[self.offsets[node] : self.offsets[node + 1]]
+
+    def degrees(self):
+        return list(map(sub, self.offsets[1:], self.offsets[:-1]))
+
+    def nbytes(self):
+        return sum(
+            column.itemsize * len(column) for column in (self.offsets, self.targets, self.types) if column is not None
+        )
+
+
+class Graph:
+    # The connection network over integer node positions, in the bundle's node order so positions line up with the
+    # exported node table. Edges run from the biography to the person it mentions; the reverse CSR holds the same
+    # edges grouped by target
+    def __init__(self, ids, names, types, sources, targets, edge_types, unresolved=0):
+        self.ids = ids
+        self.names = names
+        self.types = types
+        self.positions = {id: position for position, id in enumerate(ids)}
+        self.unresolved = unresolved
+        count = len(ids)
+        self.out = CSR(count, sources, targets, edge_types)
+        self.into = CSR(count, targets, sources, edge_types)
+
+        teachers = array("I")
+        students = array("I")
+        student_of = types.index(STUDENT_OF) if STUDENT_OF in types else -1
+        teacher_of = types.index(TEACHER_OF) if TEACHER_OF in types else -1
+        for source, target, edge_type in zip(sources, targets, edge_types):
+            if edge_type == student_of:
+                teachers.append(target)
+                students.append(source)
+            elif edge_type == teacher_of:
+                teachers.append(source)
+                students.append(target)
+        self.students = CSR(count, teachers, students)
+        self.teachers = CSR(count, students, teachers)
+
+    @property
+    def count(self):
+        return len(self.ids)
+
+    @property
+    def edges(self):
+        return len(self.out.targets)
+
+    def nbytes(self):
+        return sum(csr.nbytes() for csr in (self.out, self.into, self.students, self.teachers))
+
+    def node(self, id):
+        position = self.positions.get(id)
+        if position is None:
+            raise Exception(f"Unknown biography {id}")
+        return position
+
+    def pagerank(self, damping=DAMPING, tolerance=TOLERANCE, iterations=MAX_ITERATIONS):
+        # Each iteration gathers the share of every in-edge with one itemgetter call over the reverse CSR and sums the
+        # row of each node as a tuple slice, so no Python code runs per edge. People who link to nobody spread their
+        # rank evenly
+        count = self.count
+        if not count:
+            return []
+        out_degrees = self.out.degrees()
+        inverse = [1 / degree if degree else 0.0 for degree in out_degrees]
+        dangling = [degree == 0 for degree in out_degrees]
+        gather = gatherer(self.into.targets)
+        rows = list(map(slice, self.into.offsets[:-1], self.into.offsets[1:]))
+        rank = [1 / count] * count
+        for _ in range(iterations):
+            shares = gather(list(map(mul, rank, inverse)))
+            base = (1 - damping + damping * sum(compress(rank, dangling))) / count
+            updated = [base + damping * incoming for incoming in map(sum, map(shares.__getitem__, rows))]
+            change = sum(map(abs, map(sub, updated, rank)))
+            rank = updated
+            if change < tolerance:
+                break
+        return rank
+
+    def reach(self, starts, csrs, hops=None):
+        # Breadth-first, a frontier at a time: each node contributes one CSR slice and the visited check is a set
+        # difference, so only the nodes themselves are looped over in Python
+        distances = dict.fromkeys(starts, 0)
+        frontier = list(distances)
+        depth = 0
+        while frontier and (hops is None or depth < hops):
+            depth += 1
+            reached = set()
+            for node in frontier:
+                for csr in csrs:
+                    reached.update(csr.targets[csr.offsets[node] : csr.offsets[node + 1]])
+            frontier = list(reached.difference(distances))
+            distances.update(dict.fromkeys(frontier, depth))
+        return distances
+
+    def components(self):
+        # Connected components ignoring edge direction, numbered from the largest
+        labels = [-1] * self.count
+        members = []
+        for node in range(self.count):
+            if labels[node] == -1:
+                component = list(self.reach([node], (self.out, self.into)))
+                for member in component:
+                    labels[member] = len(members)
+                members.append(component)
+        order = sorted(range(len(members)), key=lambda label: (-len(members[label]), label))
+        renumbered = [0] * len(members)
+        for new_label, label in enumerate(order):
+            renumbered[label] = new_label
+        return [renumbered[label] for label in labels], [len(members[label]) for label in order]
+
+    def generations(self):
+        # Teacher-student steps from the nearest ancestor with no known teacher; None outside any lineage, and for
+        # people whose only teachers form a cycle
+        teacher_counts = self.teachers.degrees()
+        student_counts = self.students.degrees()
+        roots = [node for node in range(self.count) if not teacher_counts[node] and student_counts[node]]
+        distances = self.reach(roots, (self.students,))
+        return [distances.get(node) for node in range(self.count)]
+
+    def neighbourhood(self, id, hops=2):
+        # Everyone within the given number of connections, in either direction, with their distance
+        distances = self.reach([self.node(id)], (self.out, self.into), hops)
+        return {self.ids[node]: distance for node, distance in distances.items()}
+
+    def lineage(self, student, ancestor):
+        # Shortest chain of teachers from a student up to an ancestor, both ends included, or None
+        start = self.node(student)
+        goal = self.node(ancestor)
+        parents = {start: None}
+        frontier = [start]
+        while frontier and goal not in parents:
+            next_frontier = []
+            for node in frontier:
+                for teacher in self.teachers.neighbours(node):
+                    if teacher not in parents:
+                        parents[teacher] = node
+                        next_frontier.append(teacher)
+            frontier = next_frontier
+        if goal not in parents:
+            return None
+        path = []
+        node = goal
+        while node is not None:
+            path.append(self.ids[node])
+            node = parents[node]
+        return path[::-1]
+
+    def analyse(self):
+        # Per-node fields for the app, columnar like the bundle's node table. Rank is scaled so that 1.0 is an average
+        # person
+        rank = self.pagerank()
+        components, sizes = self.components()
+        return {
+            "id": self.ids,
+            "rank": [round(value * self.count, 4) for value in rank],
+            "in_degree": self.into.degrees(),
+            "out_degree": self.out.degrees(),
+            "component": components,
+            "students": self.students.degrees(),
+            "teachers": self.teachers.degrees(),
+            "generation": self.generations(),
+        }, sizes
+
+
+def connection_type(connection):
+    connection_type = str(connection.get("connection_type", "")).strip().lower()
+    return CONNECTION_TYPE_ALIASES.get(connection_type, connection_type)
+
+
+def build_graph(documents):
+    # Connections to people outside the corpus and self references are left out of the graph and counted
+    documents = sorted(documents, key=shard_order)
+    ids = [document["id"] for document in documents]
+    positions = {id: position for position, id in enumerate(ids)}
+    types = []
+    type_positions = {}
+    sources = array("I")
+    targets = array("I")
+    edge_types = array("H")
+    unresolved = 0
+    for source, document in enumerate(documents):
+        for connection in document.get("connections") or []:
+            target = positions.get(connection.get("key"))
+            if target is None or target == source:
+                unresolved += 1
+                continue
+            name = connection_type(connection)
+            if name not in type_positions:
+                type_positions[name] = len(types)
+                types.append(name)
+            sources.append(source)
+            targets.append(target)
+            edge_types.append(type_positions[name])
+    names = [document.get("name") or document["id"] for document in documents]
+    return Graph(ids, names, types, sources, targets, edge_types, unresolved)
+
+
+def load_graph():
+    documents = []
+    for key, content in store.items("l2"):
+        try:
+            document = json.loads(content)
+            document.setdefault("id", key)
+            documents.append(document)
+        except Exception as ex:
+            print(f"Error reading {key}: {ex}")
+    return build_graph(documents)
+
+
+def export_graph(graph=None, path=EXPORT_PATH):
+    if graph is None:
+        graph = load_graph()
+    start = time.perf_counter()
+    nodes, sizes = graph.analyse()
+    elapsed = time.perf_counter() - start
+    payload = {"version": FORMAT_VERSION, "types": graph.types, "components": sizes, "nodes": nodes}
+    _, data = compress_payload(payload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    print(
+        f"Analysed {graph.count} people and {graph.edges} connections "
+        f"({graph.unresolved} to people outside the corpus) in {elapsed * 1000:.0f}ms"
+    )
+    print(
+        f"{len(sizes)} components, the largest with {sizes[0] if sizes else 0} people; "
+        f"{graph.nbytes() / 1024:.0f} KiB of graph arrays, {len(data) / 1024:.0f} KiB exported"
+    )
+    return nodes
+
+
+def print_top(graph, limit):
+    nodes, _ = graph.analyse()
+    for position in sorted(range(graph.count), key=lambda node: -nodes["rank"][node])[:limit]:
+        print(
+            f"{nodes['rank'][position]:>8.2f}  {graph.names[position]} ({graph.ids[position]}), "
+            f"{nodes['in_degree'][position]} in, {nodes['out_degree'][position]} out"
+        )
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "export":
+        export_graph()
+    elif command == "top":
+        print_top(load_graph(), int(sys.argv[2]) if len(sys.argv) > 2 else 20)
+    elif command == "lineage" and len(sys.argv) == 4:
+        path = load_graph().lineage(sys.argv[2], sys.argv[3])
+        print(" -> ".join(path) if path else f"No lineage from {sys.argv[2]} to {sys.argv[3]}")
+    elif command == "neighbours" and len(sys.argv) in (3, 4):
+        hops = int(sys.argv[3]) if len(sys.argv) == 4 else 2
+        for id, distance in sorted(load_graph().neighbourhood(sys.argv[2], hops).items(), key=lambda item: item[1]):
+            print(f"{distance}  {id}")
+    else:
+        raise Exception(
+            "Usage: python -m graph.graph export|top [count]|lineage <student> <ancestor>|neighbours <id> [hops]"
+        )
@@ -1,56 +1,134 @@
+import hashlib
 import json
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-INPUT_DIR = os.path.join(os.path.dirname(__file__), "..", "store/md")
-OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "..", "store/json/l1")
+from tqdm import tqdm
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+from utils.metrics import absorb_measured, metrics, run_measured, write_metrics
+from utils.store import QUERY_BATCH, open_store
+from utils.workers import get_worker_count
 
+MANIFEST_PATH = os.path.join(os.path.dirname(__file__), "..", "store/json/l1-manifest.json")
 
-def extract_name(text):
-    lines = text.split("\n")
-    if lines and lines[0].startswith("# "):
-        return lines[0][2:].strip()
-    return ""
+WORKERS = get_worker_count()
 
+FORCE_RUN = os.environ.get("FORCE_RUN", "").lower() in ("1", "true", "yes")
 
-def extract_summary(text):
-    summary_match = re.search(r"Summary\s+(.+?)(?=\[|$)", text, re.DOTALL | re.MULTILINE)
-    if summary_match:
-        summary_text = summary_match.group(1).strip()
-        return re.sub(r"\*\*(.+?)\*\*", r"\1", summary_text)
-    return ""
+store = open_store()
+
+
+BIOGRAPHY_PREFIX = "https://mathshistory.st-andrews.ac.uk/Biographies/"
+
+SECTION_ANCHORS = ("Summary", "Born", "Died")
+PICTURE_PATTERN = re.compile(r"!\[Thumbnail of .+?\]\((.+?)\)")
+WHITESPACE_PATTERN = re.compile(r"\s*")
+DIED_END_PATTERN = re.compile(r"\*\s\*\s\*")
+BOLD_PATTERN = re.compile(r"\*\*(.+?)\*\*")
+YEAR_PATTERN = re.compile(r"(?=\d)(\d{1,2}\s+\w+\s+)?(\d{4})")
+LINK_PATTERN = re.compile(r"\[(.*?)\]\((.*?)\)")
+PLACE_PATTERN = re.compile(r"\d{4}\s+(.+)")
+CONNECTION_PATTERN = re.compile(r"\[.+?]\((https?://mathshistory\.st-andrews\.ac\.uk/Biographies/[^#)]+?)/?\)")
 
 
-def extract_picture(text):
-    picture_match = re.search(r"!\[Thumbnail of .+?\]\((.+?)\)", text)
-    if picture_match:
-        return picture_match.group(1).strip()
+def find_anchor(text, anchor):
+    # First "<anchor>\s", returning the position after the whitespace character
+    pos = text.find(anchor)
+    while pos != -1:
+        end = pos + len(anchor)
+        if end < len(text) and text[end].isspace():
+            return end + 1
+        pos = text.find(anchor, end)
     return None
 
 
+def find_picture(text):
+    pos = text.find("![Thumbnail of ")
+    while pos != -1:
+        picture_match = PICTURE_PATTERN.match(text, pos)
+        if picture_match:
+            return picture_match.group(1).strip()
+        pos = text.find("![Thumbnail of ", pos + 1)
+    return None
+
+
+def scan_anchors(text):
+    anchors = {}
+    for anchor in SECTION_ANCHORS:
+        end = find_anchor(text, anchor)
+        if end is not None:
+            anchors[anchor] = end
+    return anchors
+
+
+def end_of_text(text):
+    return len(text) - 1 if text.endswith("\n") else len(text)
+
+
+def summary_end(text, start):
+    ends = [text.find("[", start + 1), text.find("\n", start + 1)]
+    return min([end for end in ends if end != -1] or [len(text)])
+
+
+def born_end(text, start):
+    end = text.find("Died", start + 1)
+    return end_of_text(text) if end == -1 else min(end, end_of_text(text))
+
+
+def died_end(text, start):
+    match = DIED_END_PATTERN.search(text, start + 1)
+    return end_of_text(text) if match is None else min(match.start(), end_of_text(text))
+
+
+def section_text(text, anchors, section, find_end):
+    # Same span as "<section>\s+(.+?)(?=<end>)": the anchor already consumed one whitespace character
+    if section not in anchors:
+        return None
+    after_anchor = anchors[section]
+    start = WHITESPACE_PATTERN.match(text, after_anchor).end()
+    if start == len(text):
+        return "" if start > after_anchor else None
+    return text[start : find_end(text, start)]
+
+
+def extract_name(text):
+    end = text.find("\n")
+    first_line = text if end == -1 else text[:end]
+    if first_line.startswith("# "):
+        return first_line[2:].strip()
+    return ""
+
+
+def extract_summary(summary_text):
+    if summary_text is None:
+        return ""
+    return BOLD_PATTERN.sub(r"\1", summary_text.strip())
+
+
 def extract_date_info(text_section):
     info = {"year": None, "approx": False, "place": None, "link": None}
 
     if not text_section:
         return info
 
-    year_match = re.search(r"(\d{1,2}\s+\w+\s+)?(\d{4})", text_section)
+    year_match = YEAR_PATTERN.search(text_section)
     if year_match:
         try:
             info["year"] = int(year_match.group(2))
             has_month_day = year_match.group(1) is not None
-            info["approx"] = "approx" in text_section.lower() or "about" in text_section.lower() or not has_month_day
+            lower_section = text_section.lower()
+            info["approx"] = "approx" in lower_section or "about" in lower_section or not has_month_day
         except ValueError:
             pass
 
-    place_link_match = re.search(r"\[(.*?)\]\((.*?)\)", text_section)
+    place_link_match = LINK_PATTERN.search(text_section)
     if place_link_match:
         info["place"] = place_link_match.group(1).strip()
         info["link"] = place_link_match.group(2).strip()
     else:
-        place_match = re.search(r"\d{4}\s+(.+)", text_section)
+        place_match = PLACE_PATTERN.search(text_section)
         if place_match:
             info["place"] = place_match.group(1).strip()
         elif not year_match:
@@ -59,74 +137,135 @@ def extract_date_info(text_section):
     return info
 
 
-def extract_birth_info(text):
-    born_section = re.search(r"Born\s+(.+?)(?=Died|$)", text, re.DOTALL)
-    if born_section:
-        return extract_date_info(born_section.group(1).strip())
-    return {"year": None, "approx": None, "place": None, "link": None}
+def extract_life_event(section):
+    if section is None:
+        return {"year": None, "approx": None, "place": None, "link": None}
+    return extract_date_info(section.strip())
 
 
-def extract_death_info(text):
-    died_section = re.search(r"Died\s+(.+?)(?=\*\s\*\s\*|$)", text, re.DOTALL)
-    if died_section:
-        return extract_date_info(died_section.group(1).strip())
-    return {"year": None, "approx": None, "place": None, "link": None}
+def extract_connections(text, id):
+    unique_connections = []
+    seen = set()
+    for link in CONNECTION_PATTERN.findall(text):
+        clean_link = link.rstrip("/")
+        # Skip self-links (links to the current biography)
+        if (
+            f"Biographies/{id}" not in clean_link
+            and "#reference-" not in clean_link
+            and "/quotations" not in clean_link
+            and "/poster/" not in clean_link
+            and clean_link.startswith(BIOGRAPHY_PREFIX)
+        ):
+            clean_link = clean_link[len(BIOGRAPHY_PREFIX) :]
+            if clean_link not in seen:
+                seen.add(clean_link)
+                unique_connections.append(clean_link)
+    return unique_connections
 
 
-def extract_connections(text, id):
-    connections = re.findall(
-        r"\[.+?]\((https?://mathshistory\.st-andrews\.ac\.uk/Biographies/[^#)]+?)/?\)",
-        text,
-    )
-    if connections:
-        unique_connections = []
-        prefix = "https://mathshistory.st-andrews.ac.uk/Biographies/"
-        for link in connections:
-            clean_link = link.rstrip("/")
-            # Skip self-links (links to the current biography)
-            if (
-                f"Biographies/{id}" not in clean_link
-                and "#reference-" not in clean_link
-                and "/quotations" not in clean_link
-                and "/poster/" not in clean_link
-            ):
-                # Remove the prefix
-                if clean_link.startswith(prefix):
-                    clean_link = clean_link[len(prefix) :]
-                    # Add to unique connections if not already there
-                    if clean_link not in unique_connections:
-                        unique_connections.append(clean_link)
-        return unique_connections
-    return []
-
-
-def extract_biography_data(id, text):
+def extract_biography_data(id, text, indent=4):
+    anchors = scan_anchors(text)
     data = {
         "id": id,
         "name": extract_name(text),
-        "summary": extract_summary(text),
-        "born": extract_birth_info(text),
-        "died": extract_death_info(text),
-        "picture": f"https://mathshistory.st-andrews.ac.uk/Biographies/{id}/{extract_picture(text)}",
+        "summary": extract_summary(section_text(text, anchors, "Summary", summary_end)),
+        "born": extract_life_event(section_text(text, anchors, "Born", born_end)),
+        "died": extract_life_event(section_text(text, anchors, "Died", died_end)),
+        "picture": f"{BIOGRAPHY_PREFIX}{id}/{find_picture(text)}",
         "connections": extract_connections(text, id),
     }
-    return json.dumps(data, indent=4, ensure_ascii=False)
+    return json.dumps(data, indent=indent, ensure_ascii=False)
 
 
-for file in os.listdir(INPUT_DIR):
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest):
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    tmp_path = f"{MANIFEST_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(manifest, indent=4, ensure_ascii=False, sort_keys=True))
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def process_file(filename, known_hash=None):
+    # known_hash is only passed when the L1 document exists, so an unchanged hash means there is nothing to do
     try:
-        if not file.endswith(".md"):
-            continue
-        with open(os.path.join(INPUT_DIR, file), "r", encoding="utf-8") as f:
-            markdown_text = f.read()
-
-        print("Processing file:", file)
-        result = extract_biography_data(file.replace(".md", ""), markdown_text)
-        with open(
-            os.path.join(OUTPUT_DIR, file.replace(".md", ".json")),
-            "w",
-            encoding="utf-8",
-        ) as f:
-            f.write(result)
+        key = filename.replace(".md", "")
+        markdown_text = store.get("md", key)
+        if markdown_text is None:
+            raise Exception("markdown not found")
+
+        content_hash = hashlib.sha256(markdown_text.encode("utf-8")).hexdigest()
+        if content_hash == known_hash and not FORCE_RUN:
+            return True, filename, content_hash, None
+
+        with metrics.span("parse_l1_seconds", key):
+            document = extract_biography_data(key, markdown_text, store.indent)
+        metrics.increment("parse_bytes_read", len(markdown_text.encode("utf-8")), stage="l1")
+        metrics.increment("parse_bytes_written", len(document.encode("utf-8")), stage="l1")
+        return True, filename, content_hash, document
     except Exception as ex:
-        raise Exception(f"Error processing file {file}: {ex}") from ex
+        return False, filename, f"Error processing file {filename}: {ex}", None
+
+
+def parse_l1(filenames=None, workers=WORKERS):
+    if not filenames:
+        filenames = [f"{key}.md" for key in store.keys("md")]
+
+    manifest = load_manifest()
+    parsed_keys = set(store.keys("l1"))
+    known_hashes = [
+        manifest.get(filename) if filename.replace(".md", "") in parsed_keys else None for filename in filenames
+    ]
+
+    success_count = 0
+    parsed_count = 0
+    error_count = 0
+    pending = []
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        chunksize = max(1, len(filenames) // (workers * 8))
+        # Workers hand back the metrics of each file with its result
+        results = absorb_measured(
+            executor.map(partial(run_measured, process_file), filenames, known_hashes, chunksize=chunksize)
+        )
+    else:
+        executor = None
+        results = map(process_file, filenames, known_hashes)
+
+    try:
+        for success, filename, result, document in tqdm(
+            results, total=len(filenames), desc="Parsing L1", mininterval=1
+        ):
+            if success:
+                success_count += 1
+                manifest[filename] = result
+                if document is not None:
+                    # Parsed documents are written in bulk by this process rather than one file per worker call
+                    pending.append((filename.replace(".md", ""), document))
+                    parsed_count += 1
+                    if len(pending) >= QUERY_BATCH:
+                        store.put_many("l1", pending)
+                        pending = []
+            else:
+                error_count += 1
+                print(f"\n{result}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        store.put_many("l1", pending)
+        save_manifest(manifest)
+
+    print(f"Completed: {success_count} succeeded ({parsed_count} parsed), {error_count} failed")
+    return success_count, error_count
+
+
+if __name__ == "__main__":
+    parse_l1()
+    write_metrics("parse-l1")
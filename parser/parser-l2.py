@@ -1,42 +1,117 @@
-import concurrent.futures
+import asyncio
 import json
 import os
-from concurrent.futures import ProcessPoolExecutor
+import re
+import time
+from collections import Counter
 
 from tqdm import tqdm
 
-from utils.llm import query_llm
-from utils.workers import get_worker_count
+from utils.batch import batch_request, batch_results, batch_status, submit_batch
+from utils.llm import (
+    LLM_CONCURRENCY,
+    AsyncLLMClient,
+    extract_json_from_response,
+    llm_provider,
+    query_cache_key,
+    response_cache,
+)
+from utils.metrics import metrics, write_metrics
+from utils.store import open_store
+from utils.tokens import count_tokens, split_text
+
+BATCH_STATE_PATH = os.path.join(os.path.dirname(__file__), "..", "store/json/l2-batches.json")
+TELEMETRY_PATH = os.path.join(os.path.dirname(__file__), "..", "store/json/l2-telemetry.jsonl")
 
-MD_INPUT_DIR = os.path.join(os.path.dirname(__file__), "..", "store/md")
-L1_INPUT_DIR = os.path.join(os.path.dirname(__file__), "..", "store/json/l1")
-OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "..", "store/json/l2")
+FORCE_RUN = os.environ.get("FORCE_RUN", "").lower() in ("1", "true", "yes")
+BATCH_MODE = os.environ.get("BATCH_MODE", "").lower() in ("1", "true", "yes")
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 5000))
+BATCH_POLL_SECONDS = int(os.environ.get("BATCH_POLL_SECONDS", 60))
+EXTRACTION_MODE = os.environ.get("EXTRACTION_MODE", "combined").lower()
+EXTRACTION_MODES = ("combined", "concurrent", "sequential")
 
-WORKERS = get_worker_count(max_workers=4)
+MAX_INPUT_TOKENS = int(os.environ.get("L2_MAX_INPUT_TOKENS", 12000))
 
-FORCE_RUN = os.environ.get("FORCE_RUN", "").lower() in ("1", "true", "yes")
+if EXTRACTION_MODE not in EXTRACTION_MODES:
+    raise Exception(f"Unknown EXTRACTION_MODE {EXTRACTION_MODE}, expected one of {', '.join(EXTRACTION_MODES)}")
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+store = open_store()
 
 
-def extract_biography_data(text, l1_data):
-    bio_prompt = """Given the markdown-formatted biography text, extract the following structured JSON fields:
-- lived_in: list of places they lived at (array of strings)
+BIO_FIELDS = ("lived_in", "worked_in", "religions", "profession", "institution_affiliation")
+BIO_FIELDS_PROMPT = """- lived_in: list of places they lived at (array of strings)
 - worked_in: list of places they worked at (array of strings)
 - religions: specify any religions mentioned (array of strings, or null if none)
 - profession: list of professions (array of strings)
-- institution_affiliation: list of affiliations (array of strings)
+- institution_affiliation: list of affiliations (array of strings)"""
+BIO_PROMPT = f"""Given the markdown-formatted biography text, extract the following structured JSON fields:
+{BIO_FIELDS_PROMPT}
 
 Return ONLY a JSON object with those fields, ensure it's valid JSON without comments."""
-
-    l2_data = query_llm(text, bio_prompt, max_tokens=2000)
-    if not l2_data:
-        return None
-
-    result_data = l1_data.copy()
-    result_data.update(l2_data)
-
-    connections_prompt = f"""Given the markdown-formatted biography text, and the following connections:
+BIO_MAX_TOKENS = 2000
+BIO_MIN_TOKENS = 512
+CONNECTIONS_MAX_TOKENS = 5000
+CONNECTION_OUTPUT_TOKENS = 30
+
+# A combined response is only requested when its max_tokens fits COMBINED_MAX_TOKENS, otherwise (and when a combined
+# response comes back truncated or incomplete) the two prompts are sent concurrently
+COMBINED_MAX_TOKENS = int(os.environ.get("COMBINED_MAX_TOKENS", 4000))
+
+BIOGRAPHY_PREFIX = "https://mathshistory.st-andrews.ac.uk/Biographies/"
+BIOGRAPHY_HEADING = "### Biography\n"
+TRAILING_SECTIONS_PATTERN = re.compile(
+    r"^### (?:References|Additional Resources|Other pages about|Other websites about|Honours|Cross-references)",
+    re.MULTILINE,
+)
+LONG_URL_CHARS = 60
+NOISE_PATTERN = re.compile(
+    r"\[!\[[^\]]*\]\([^)]*\)\]\([^)]*\)"
+    r"|!\[[^\]]*\]\([^)]*\)"
+    r"|\[\[\d+\]\]\([^)]*\)"
+    r"|\[([^\]]*)\]\((https?://[^)\s]*)\)"
+    rf"|https?://\S{{{LONG_URL_CHARS},}}"
+)
+
+
+def replace_noise(match):
+    # Thumbnails, images, reference markers and long bare URLs are dropped, links keep their text and biography links
+    # keep the short name the L1 connections use
+    text, url = match.groups()
+    if url is None:
+        return ""
+    if url.startswith(BIOGRAPHY_PREFIX):
+        return f"[{text}]({url[len(BIOGRAPHY_PREFIX):].split('#')[0].rstrip('/')})"
+    return text
+
+
+def prepare_biography(markdown_text):
+    trailing_section = TRAILING_SECTIONS_PATTERN.search(markdown_text)
+    if trailing_section:
+        markdown_text = markdown_text[: trailing_section.start()]
+    return NOISE_PATTERN.sub(replace_noise, markdown_text)
+
+
+def biography_chunks(markdown_text, l1_data):
+    text = prepare_biography(markdown_text)
+    if count_tokens(text) <= MAX_INPUT_TOKENS:
+        return [(text, l1_data)]
+
+    # Every chunk repeats the header (quick info and summary) and is asked only about the connections it links to,
+    # connections not linked from any chunk go to the first one
+    header, heading, body = text.partition(BIOGRAPHY_HEADING)
+    if not heading or count_tokens(header) > MAX_INPUT_TOKENS // 4:
+        header, heading, body = "", "", text
+    chunks = [header + heading + part for part in split_text(body, MAX_INPUT_TOKENS - count_tokens(header + heading))]
+    chunk_connections = [
+        [connection for connection in l1_data["connections"] if f"]({connection})" in chunk] for chunk in chunks
+    ]
+    linked = {connection for connections in chunk_connections for connection in connections}
+    chunk_connections[0] += [connection for connection in l1_data["connections"] if connection not in linked]
+    return [(chunk, dict(l1_data, connections=connections)) for chunk, connections in zip(chunks, chunk_connections)]
+
+
+def connections_prompt(l1_data):
+    return f"""Given the markdown-formatted biography text, and the following connections:
 [{", ".join(l1_data["connections"])}]
 find for each connection the relationship type (e.g., "student of", "influenced by", "collaborator with").
 
@@ -47,91 +122,411 @@ Extract the following structured JSON fields:
 
 Return ONLY a valid JSON object with those fields, ensure it's proper JSON format."""
 
-    connections_data = query_llm(text, connections_prompt, max_tokens=5000)
-    if not connections_data:
+
+def combined_prompt(l1_data):
+    return f"""Given the markdown-formatted biography text, and the following connections:
+[{", ".join(l1_data["connections"])}]
+extract the following structured JSON fields:
+{BIO_FIELDS_PROMPT}
+- connections: list of objects, one for each of the connections above, with fields:
+    - person: name of a connected person
+    - connection_type: relationship (e.g., "student of", "influenced by", "collaborator with")
+
+Return ONLY a JSON object with those fields, ensure it's valid JSON without comments."""
+
+
+def is_combined_complete(combined_data):
+    return (
+        isinstance(combined_data, dict)
+        and all(field in combined_data for field in BIO_FIELDS)
+        and isinstance(combined_data.get("connections"), list)
+    )
+
+
+def extraction_prompts(l1_data, input_tokens, mode=EXTRACTION_MODE):
+    # max_tokens grows with the input for the profile fields and with the number of connections for their types
+    bio_max_tokens = min(BIO_MAX_TOKENS, max(BIO_MIN_TOKENS, input_tokens // 16))
+    connections_max_tokens = min(CONNECTIONS_MAX_TOKENS, 256 + CONNECTION_OUTPUT_TOKENS * len(l1_data["connections"]))
+    if mode == "combined" and bio_max_tokens + connections_max_tokens <= COMBINED_MAX_TOKENS:
+        return {"combined": (combined_prompt(l1_data), bio_max_tokens + connections_max_tokens)}
+    prompts = {"bio": (BIO_PROMPT, bio_max_tokens)}
+    if l1_data["connections"]:
+        prompts["connections"] = (connections_prompt(l1_data), connections_max_tokens)
+    return prompts
+
+
+def chunk_result(responses):
+    if "combined" in responses:
+        return responses["combined"] if is_combined_complete(responses["combined"]) else None
+    l2_data = responses["bio"]
+    connections_data = responses.get("connections", {"connections": []})
+    if not l2_data or not connections_data:
+        return None
+    return {**l2_data, "connections": connections_data.get("connections", [])}
+
+
+def merge_values(values):
+    merged = {}
+    for value in values:
+        for item in value if isinstance(value, list) else [value]:
+            key = json.dumps(item, sort_keys=True).lower() if isinstance(item, dict) else str(item).strip().lower()
+            merged.setdefault(key, item)
+    return list(merged.values())
+
+
+def merge_chunk_results(results):
+    if len(results) == 1:
+        return results[0]
+    merged = {}
+    for field in {field: None for result in results for field in result}:
+        values = [result[field] for result in results if result.get(field) is not None]
+        merged[field] = merge_values(values) if values else None
+    connections = {}
+    for connection in merged.get("connections") or []:
+        if isinstance(connection, dict):
+            connections.setdefault(str(connection.get("person", "")).lower(), connection)
+    merged["connections"] = list(connections.values())
+    return merged
+
+
+def merge_extraction(l1_data, l2_data):
+    result_data = l1_data.copy()
+    result_data.update(l2_data)
+    return store.dump(result_data)
+
+
+async def extract_chunk(client, text, l1_data, mode=EXTRACTION_MODE, usage=None):
+    prompts = extraction_prompts(l1_data, count_tokens(text), mode)
+    if "combined" in prompts:
+        prompt, max_tokens = prompts["combined"]
+        combined_data = await client.query(text, prompt, max_tokens=max_tokens, usage=usage)
+        if is_combined_complete(combined_data):
+            return combined_data
+        prompts = extraction_prompts(l1_data, count_tokens(text), "concurrent")
+
+    responses = {}
+    if mode == "sequential":
+        for kind, (prompt, max_tokens) in prompts.items():
+            responses[kind] = await client.query(text, prompt, max_tokens=max_tokens, usage=usage)
+            if not responses[kind]:
+                return None
+    else:
+        results = await asyncio.gather(
+            *(client.query(text, prompt, max_tokens=max_tokens, usage=usage) for prompt, max_tokens in prompts.values())
+        )
+        responses = dict(zip(prompts, results))
+    return chunk_result(responses)
+
+
+async def extract_biography_data(client, text, l1_data, mode=EXTRACTION_MODE, usage=None):
+    chunks = biography_chunks(text, l1_data)
+    if usage is not None:
+        usage["chunks"] += len(chunks)
+        usage["prepared_tokens"] += sum(count_tokens(chunk) for chunk, _ in chunks)
+    results = await asyncio.gather(
+        *(extract_chunk(client, chunk, chunk_l1_data, mode, usage) for chunk, chunk_l1_data in chunks)
+    )
+    if not all(results):
         return None
-    result_data.update(connections_data)
 
-    return json.dumps(result_data, indent=4, ensure_ascii=False)
+    return merge_extraction(l1_data, merge_chunk_results(results))
 
 
-def process_file(filename):
-    try:
-        if not filename.endswith(".md"):
-            return False, filename, "Not a markdown file"
+def write_telemetry(record):
+    os.makedirs(os.path.dirname(TELEMETRY_PATH), exist_ok=True)
+    with open(TELEMETRY_PATH, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
 
-        l1_file = filename.replace(".md", ".json")
-        l1_path = os.path.join(L1_INPUT_DIR, l1_file)
-        output_path = os.path.join(OUTPUT_DIR, l1_file)
 
-        if not os.path.exists(l1_path):
-            return False, filename, f"L1 data not found: {l1_file}"
+def is_complete(content):
+    existing_data = json.loads(content)
+    return (
+        "connections" in existing_data
+        and isinstance(existing_data["connections"], list)
+        and all(isinstance(conn, dict) for conn in existing_data["connections"])
+    )
 
-        if os.path.exists(output_path) and not FORCE_RUN:
-            with open(output_path, "r") as f:
-                existing_data = json.loads(f.read())
-            if (
-                "connections" in existing_data
-                and isinstance(existing_data["connections"], list)
-                and all(isinstance(conn, dict) for conn in existing_data["connections"])
-            ):
-                return True, filename, "Skipped (already exists)"
 
-        with open(os.path.join(MD_INPUT_DIR, filename), "r", encoding="utf-8") as f:
-            markdown_text = f.read()
+def is_extracted(key):
+    if FORCE_RUN:
+        return False
+    content = store.get("l2", key)
+    return content is not None and is_complete(content)
 
-        with open(l1_path, "r", encoding="utf-8") as f:
-            l1_json_text = f.read()
 
-        result = extract_biography_data(markdown_text, json.loads(l1_json_text))
+def extracted_keys(keys):
+    if FORCE_RUN:
+        return set()
+    return {key for key, content in store.items("l2", keys) if is_complete(content)}
 
-        if not result:
-            return False, filename, "failed"
 
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(result)
+def list_biographies():
+    markdown_keys = set(store.keys("md"))
+    return [f"{key}.md" for key in store.keys("l1") if key in markdown_keys]
+
+
+def read_inputs(filename):
+    key = filename.replace(".md", "")
+    return store.get("md", key), store.load("l1", key)
+
+
+async def extract_and_store(client, key, markdown_text, l1_data):
+    usage = Counter()
+    start = time.perf_counter()
+    with metrics.span("l2_extraction_seconds", key, mode=EXTRACTION_MODE):
+        result = await extract_biography_data(client, markdown_text, l1_data, usage=usage)
+    metrics.increment("parse_bytes_read", len(markdown_text.encode("utf-8")), stage="l2")
+    if result:
+        store.put("l2", key, result)
+        metrics.increment("parse_bytes_written", len(result.encode("utf-8")), stage="l2")
+    # Telemetry comes after the result is stored: losing a telemetry line must not throw away a paid extraction
+    try:
+        write_telemetry(
+            {
+                "id": l1_data["id"],
+                "timestamp": int(time.time()),
+                "mode": EXTRACTION_MODE,
+                "success": bool(result),
+                "latency_seconds": round(time.perf_counter() - start, 3),
+                "raw_tokens": count_tokens(markdown_text),
+                **usage,
+            }
+        )
+    except OSError as ex:
+        print(f"\nError writing telemetry for {key}: {ex}")
+    return bool(result)
+
+
+async def process_file(client, filename):
+    try:
+        if not filename.endswith(".md"):
+            return False, filename, "Not a markdown file"
+
+        key = filename.replace(".md", "")
+        if not store.exists("l1", key):
+            return False, filename, f"L1 data not found: {key}"
+
+        if is_extracted(key):
+            return True, filename, "Skipped (already exists)"
+
+        markdown_text, l1_data = read_inputs(filename)
+        if not await extract_and_store(client, key, markdown_text, l1_data):
+            return False, filename, "failed"
 
         return True, filename, None
     except Exception as ex:
         return False, filename, f"Error: {str(ex)}"
 
 
-def parse_biographies(filenames=None):
+async def parse_biographies_async(filenames=None, concurrency=LLM_CONCURRENCY):
     if filenames is None or filenames == []:
-        filenames = []
-        for file in os.listdir(L1_INPUT_DIR):
-            if file.endswith(".json"):
-                md_file = file.replace(".json", ".md")
-                if os.path.exists(os.path.join(MD_INPUT_DIR, md_file)):
-                    filenames.append(md_file)
+        filenames = list_biographies()
 
-    print(f"Processing {len(filenames)} biographies with {WORKERS} workers")
+    print(
+        f"Processing {len(filenames)} biographies with up to {concurrency} concurrent requests "
+        f"({EXTRACTION_MODE} extraction)"
+    )
+    cache_before = response_cache.stats()
 
     success_count = 0
     error_count = 0
 
-    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+    async with AsyncLLMClient(concurrency=concurrency) as client:
         with tqdm(total=len(filenames), desc="Processing biographies") as pbar:
-            future_to_file = {executor.submit(process_file, filename): filename for filename in filenames}
-
-            for future in concurrent.futures.as_completed(future_to_file):
-                filename = future_to_file[future]
-                try:
-                    success, file, error = future.result()
-                    if success:
-                        success_count += 1
-                    else:
-                        error_count += 1
-                        print(f"\nError processing {file}: {error}")
-                except Exception as exc:
+            for task in asyncio.as_completed([process_file(client, filename) for filename in filenames]):
+                success, file, error = await task
+                if success:
+                    success_count += 1
+                else:
                     error_count += 1
-                    print(f"\nException processing {filename}: {exc}")
-
+                    print(f"\nError processing {file}: {error}")
                 pbar.update(1)
+        throttled = client.limiter.throttled
+
+    cache_after = response_cache.stats()
+    print(
+        f"LLM cache: {cache_after['hits'] - cache_before['hits']} hits, "
+        f"{cache_after['misses'] - cache_before['misses']} misses, "
+        f"{cache_after['entries']} entries ({cache_after['bytes'] / 1024 / 1024:.1f} MB)"
+    )
+    print(f"Rate limited {throttled} times")
+    print(f"Completed: {success_count} succeeded, {error_count} failed")
+    return success_count, error_count
+
+
+def parse_biographies(filenames=None, concurrency=LLM_CONCURRENCY):
+    return asyncio.run(parse_biographies_async(filenames, concurrency))
+
+
+def load_batch_state():
+    if not os.path.exists(BATCH_STATE_PATH):
+        return {"jobs": []}
+    with open(BATCH_STATE_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_batch_state(state):
+    os.makedirs(os.path.dirname(BATCH_STATE_PATH), exist_ok=True)
+    tmp_path = f"{BATCH_STATE_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(state, indent=4, ensure_ascii=False))
+    os.replace(tmp_path, BATCH_STATE_PATH)
+
+
+def batch_prompts(markdown_text, l1_data, mode):
+    for chunk_index, (chunk, chunk_l1_data) in enumerate(biography_chunks(markdown_text, l1_data)):
+        for kind, (prompt, max_tokens) in extraction_prompts(chunk_l1_data, count_tokens(chunk), mode).items():
+            # Part of the batch custom_id, which Anthropic restricts to [a-zA-Z0-9_-]
+            yield f"{chunk_index}_{kind}", chunk, prompt, max_tokens
+
+
+def batch_cache_keys(prompts):
+    return {
+        request_kind: query_cache_key(chunk, prompt, max_tokens) for request_kind, chunk, prompt, max_tokens in prompts
+    }
+
+
+def submit_batch_job(filenames, mode=EXTRACTION_MODE):
+    # The cache key of every request sent is kept with the job, so results are only applied to unchanged inputs
+    batch_requests = []
+    cache_keys = {}
+    for index, filename in enumerate(filenames):
+        markdown_text, l1_data = read_inputs(filename)
+        prompts = list(batch_prompts(markdown_text, l1_data, mode))
+        for request_kind, chunk, prompt, max_tokens in prompts:
+            batch_requests.append(batch_request(f"item_{index}_{request_kind}", chunk, prompt, max_tokens))
+        cache_keys[filename] = batch_cache_keys(prompts)
+    return {
+        "id": submit_batch(batch_requests),
+        "provider": llm_provider(),
+        "mode": mode,
+        "items": filenames,
+        "cache_keys": cache_keys,
+        "status": "submitted",
+    }
+
+
+def apply_batch_results(job):
+    # Returns the counts and the biographies whose combined response came back truncated or incomplete, which are
+    # resubmitted with the separate prompts the synchronous path falls back to
+    responses = {}
+    success_count = 0
+    error_count = 0
+    separate = []
+
+    for custom_id, response_text in batch_results(job["id"]):
+        # Jobs submitted before the ids were restricted to Anthropic's pattern used item-N-chunk.kind
+        _, index, request_kind = custom_id.replace("-", "_").replace(".", "_").split("_", 2)
+        filename = job["items"][int(index)]
+        responses.setdefault(filename, {})[request_kind] = response_text
+
+    for filename, item_responses in responses.items():
+        try:
+            markdown_text, l1_data = read_inputs(filename)
+            prompts = list(batch_prompts(markdown_text, l1_data, job.get("mode", "concurrent")))
+            if set(item_responses) != {request_kind for request_kind, _, _, _ in prompts}:
+                error_count += 1
+                print(f"\nError processing {filename}: missing batch results")
+                continue
+            # Inputs changed while the batch ran would get answers to prompts that were never sent; they are skipped
+            # and resubmitted on the next run. Jobs from before the keys were kept are applied but not cached
+            cache_keys = batch_cache_keys(prompts)
+            submitted_keys = job.get("cache_keys", {}).get(filename)
+            if "cache_keys" in job and submitted_keys != cache_keys:
+                error_count += 1
+                print(f"\nError processing {filename}: inputs changed since the batch was submitted")
+                continue
+
+            chunk_responses = {}
+            for request_kind, _, _, _ in prompts:
+                response_text = item_responses[request_kind]
+                if response_text and submitted_keys is not None:
+                    response_cache.set(cache_keys[request_kind], response_text)
+                chunk_index, kind = request_kind.split("_", 1)
+                chunk_responses.setdefault(chunk_index, {})[kind] = extract_json_from_response(response_text)
+
+            results = [chunk_result(kinds) for kinds in chunk_responses.values()]
+            if not all(results):
+                error_count += 1
+                if any("combined" in kinds and not result for kinds, result in zip(chunk_responses.values(), results)):
+                    separate.append(filename)
+                    print(f"\nError processing {filename}: incomplete combined response, separate prompts next run")
+                else:
+                    print(f"\nError processing {filename}: failed")
+                continue
+
+            store.put("l2", filename.replace(".md", ""), merge_extraction(l1_data, merge_chunk_results(results)))
+            success_count += 1
+        except Exception as ex:
+            error_count += 1
+            print(f"\nError processing {filename}: {str(ex)}")
+
+    error_count += len(set(job["items"]) - set(responses))
+    return success_count, error_count, separate
+
+
+def parse_biographies_batch(filenames=None):
+    if filenames is None or filenames == []:
+        filenames = list_biographies()
+
+    state = load_batch_state()
+    in_flight = {filename for job in state["jobs"] if job["status"] != "done" for filename in job["items"]}
+    extracted = extracted_keys(filename.replace(".md", "") for filename in filenames)
+    pending = [
+        filename for filename in filenames if filename not in in_flight and filename.replace(".md", "") not in extracted
+    ]
+    # Biographies a combined batch could not answer go out with the separate bio and connections prompts instead
+    separate = {filename for filename in state.get("separate", []) if filename.replace(".md", "") not in extracted}
+    state["separate"] = sorted(separate)
+
+    print(f"Submitting {len(pending)} biographies in batches of {BATCH_MAX_ITEMS}, {len(in_flight)} already in flight")
+    for mode, items in (
+        (EXTRACTION_MODE, [filename for filename in pending if filename not in separate]),
+        ("concurrent", [filename for filename in pending if filename in separate]),
+    ):
+        for start in range(0, len(items), BATCH_MAX_ITEMS):
+            job = submit_batch_job(items[start : start + BATCH_MAX_ITEMS], mode)
+            state["jobs"].append(job)
+            save_batch_state(state)
+            print(f"Submitted batch {job['id']} with {len(job['items'])} biographies ({mode} prompts)")
+
+    success_count = 0
+    error_count = 0
+
+    while True:
+        active_jobs = [job for job in state["jobs"] if job["status"] != "done"]
+        if not active_jobs:
+            break
+        for job in active_jobs:
+            status = batch_status(job["id"])
+            if status == "in_progress":
+                continue
+            if status == "ended":
+                succeeded, failed, fallbacks = apply_batch_results(job)
+                state["separate"] = sorted(set(state.get("separate", [])) | set(fallbacks))
+                print(f"Batch {job['id']} ended: {succeeded} succeeded, {failed} failed")
+                success_count += succeeded
+                error_count += failed
+            else:
+                print(f"\n!!! Batch {job['id']} failed, its biographies will be resubmitted on the next run")
+                error_count += len(job["items"])
+            job["status"] = "done"
+            save_batch_state(state)
+        if any(job["status"] != "done" for job in state["jobs"]):
+            time.sleep(BATCH_POLL_SECONDS)
+
+    state["jobs"] = [job for job in state["jobs"] if job["status"] != "done"]
+    extracted = extracted_keys(filename.replace(".md", "") for filename in state["separate"])
+    state["separate"] = [filename for filename in state["separate"] if filename.replace(".md", "") not in extracted]
+    save_batch_state(state)
 
     print(f"Completed: {success_count} succeeded, {error_count} failed")
     return success_count, error_count
 
 
 if __name__ == "__main__":
-    parse_biographies()
+    if BATCH_MODE:
+        parse_biographies_batch()
+    else:
+        parse_biographies()
+    write_metrics("parse-l2")
@@ -0,0 +1,205 @@
+import importlib
+import json
+import os
+import re
+import unicodedata
+from collections import Counter
+
+from tqdm import tqdm
+
+from utils.store import QUERY_BATCH, open_store
+
+LOCATIONS_PATH = os.path.join(os.path.dirname(__file__), "..", "store/json/locations.json")
+
+PLACE_FIELDS = ("lived_in", "worked_in")
+NOW_PATTERN = re.compile(r"\(\s*now\s+(?:in\s+)?([^)]*)\)", re.IGNORECASE)
+PARENTHESES_PATTERN = re.compile(r"\([^)]*\)")
+SLUG_PATTERN = re.compile(r"[^a-z0-9]+")
+# Letters NFKD leaves without an ASCII base
+SLUG_LETTERS = str.maketrans(
+    {"ł": "l", "Ł": "L", "ø": "o", "Ø": "O", "đ": "d", "Đ": "D", "ı": "i", "ß": "ss", "æ": "ae", "Æ": "Ae", "œ": "oe"}
+)
+COUNTRY_ALIASES = {
+    "us": "USA",
+    "u.s.a": "USA",
+    "united states": "USA",
+    "united states of america": "USA",
+    "uk": "United Kingdom",
+    "holland": "Netherlands",
+    "the netherlands": "Netherlands",
+}
+KINDS = ("country", "region", "city")
+
+parser_merge = importlib.import_module("parser.parser-merge")
+
+store = open_store()
+
+
+def slug(name):
+    ascii_name = unicodedata.normalize("NFKD", name.translate(SLUG_LETTERS)).encode("ascii", "ignore").decode().lower()
+    return SLUG_PATTERN.sub("-", ascii_name).strip("-")
+
+
+def split_parts(text):
+    return [part.strip(" .") for part in text.split(",") if part.strip(" .")]
+
+
+def place_parts(place):
+    # "Breslau, Germany (now Wrocław, Poland)" is filed under its modern name and "Basel (now Switzerland)" under
+    # the modern country; other parenthesised remarks are dropped
+    now = NOW_PATTERN.search(place)
+    parts = split_parts(PARENTHESES_PATTERN.sub("", NOW_PATTERN.sub("", place)))
+    if now:
+        modern = split_parts(now.group(1))
+        if len(modern) > 1 or not parts:
+            parts = modern
+        elif modern:
+            parts = parts[:-1] + modern if len(parts) > 1 else parts + modern
+    if parts:
+        parts[-1] = COUNTRY_ALIASES.get(parts[-1].lower(), parts[-1])
+    return parts
+
+
+def document_places(document):
+    places = [(document.get(field) or {}).get("place") for field in ("born", "died")]
+    for field in PLACE_FIELDS:
+        places += document.get(field) or []
+    return [place for place in places if isinstance(place, str) and place.strip()]
+
+
+class LocationResolver:
+    # Places are read country first, so "St Andrews, Fife, Scotland" becomes scotland > scotland/fife >
+    # scotland/fife/st-andrews. A place naming only a city is attached to the one country it appears under elsewhere in
+    # the corpus, and a lone name that the corpus uses as a country is that country
+    def __init__(self, places):
+        self.parsed = {place: place_parts(place) for place in set(places)}
+        self.countries = {slug(parts[-1]) for parts in self.parsed.values() if len(parts) > 1}
+        self.cities = {}
+        for parts in self.parsed.values():
+            if len(parts) > 1:
+                self.cities.setdefault(slug(parts[0]), set()).add(tuple(slug(part) for part in parts))
+        self.locations = {}
+        self.spellings = {}
+        self.resolved = {place: self.resolve(place) for place in sorted(self.parsed)}
+
+    def add(self, path, names, place):
+        # Returns the id of the deepest location, registering it and all of its ancestors
+        parent = None
+        for depth in range(len(path)):
+            id = "/".join(path[: depth + 1])
+            if id not in self.locations:
+                kind = "country" if depth == 0 else "city" if depth == len(path) - 1 else "region"
+                self.locations[id] = {"name": None, "kind": kind, "parent": parent, "variants": set()}
+                self.spellings[id] = Counter()
+            elif depth < len(path) - 1 and self.locations[id]["kind"] == "city":
+                # "Fife, Scotland" alone reads as a city until "St Andrews, Fife, Scotland" shows it is a region
+                self.locations[id]["kind"] = "region"
+            if names:
+                self.spellings[id][names[depth]] += 1
+            parent = id
+        self.locations[parent]["variants"].add(place)
+        return parent
+
+    def resolve(self, place):
+        parts = self.parsed[place]
+        if not parts:
+            return None
+        path = [slug(part) for part in reversed(parts)]
+        if not all(path):
+            return None
+        if len(parts) > 1:
+            return self.add(path, list(reversed(parts)), place)
+        if path[0] in self.countries:
+            return self.add(path, parts, place)
+        known = self.cities.get(path[0], set())
+        if len(known) == 1:
+            return self.add(list(reversed(next(iter(known)))), None, place)
+        # Unknown or ambiguous: kept as a top-level place of its own
+        self.locations.setdefault(path[0], {"name": None, "kind": "place", "parent": None, "variants": set()})
+        self.spellings.setdefault(path[0], Counter())[parts[0]] += 1
+        self.locations[path[0]]["variants"].add(place)
+        return path[0]
+
+    def ancestors(self, id):
+        while id is not None:
+            yield id
+            id = self.locations[id]["parent"]
+
+    def table(self, index):
+        # The most common spelling names each location, the first in sort order breaking ties
+        table = {}
+        for id in sorted(self.locations):
+            location = self.locations[id]
+            spellings = sorted(self.spellings[id].items(), key=lambda item: (-item[1], item[0]))
+            table[id] = {
+                "name": spellings[0][0] if spellings else id.rsplit("/", 1)[-1],
+                "kind": location["kind"],
+                "parent": location["parent"],
+                "mathematicians": len(index.get(id, ())),
+                "variants": sorted(location["variants"]),
+            }
+        return table
+
+
+def locate_document(document, resolver):
+    ids = set()
+    for field in ("born", "died"):
+        if isinstance(document.get(field), dict):
+            place = document[field].get("place")
+            document[field]["location"] = resolver.resolved.get(place) if isinstance(place, str) else None
+    for place in document_places(document):
+        ids.update(resolver.ancestors(resolver.resolved.get(place)))
+    document["locations"] = sorted(ids)
+    if "query" in document:
+        # The query map's location facet includes the location ids just assigned
+        document["query"] = parser_merge.query_fields(document)
+    return document["locations"]
+
+
+def build_location_index(keys=None):
+    documents = {}
+    for key, content in tqdm(store.items("l2", keys), desc="Reading places", mininterval=1):
+        try:
+            documents[key] = (content, json.loads(content))
+        except Exception as ex:
+            print(f"\nError reading {key}: {ex}")
+
+    resolver = LocationResolver(place for _, document in documents.values() for place in document_places(document))
+
+    index = {}
+    pending = []
+    updated = 0
+    for key, (existing, document) in tqdm(documents.items(), desc="Locating", mininterval=1):
+        id = document.get("id") or key
+        for location_id in locate_document(document, resolver):
+            index.setdefault(location_id, []).append(id)
+        located = store.dump(document)
+        if located != existing:
+            pending.append((key, located))
+            if len(pending) >= QUERY_BATCH:
+                updated += store.put_many("l2", pending)
+                pending = []
+    updated += store.put_many("l2", pending)
+
+    index = {location_id: sorted(ids) for location_id, ids in sorted(index.items())}
+    table = resolver.table(index)
+    os.makedirs(os.path.dirname(LOCATIONS_PATH), exist_ok=True)
+    tmp_path = f"{LOCATIONS_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"locations": table, "index": index}, indent=4, ensure_ascii=False))
+    os.replace(tmp_path, LOCATIONS_PATH)
+
+    kinds = Counter(location["kind"] for location in table.values())
+    unresolved = sum(location_id is None for location_id in resolver.resolved.values())
+    print(
+        f"{len(resolver.parsed)} distinct place strings resolved into {len(table)} locations "
+        f"({', '.join(f'{kinds[kind]} {kind}' for kind in KINDS + ('place',))}), {unresolved} unresolved"
+    )
+    print(f"Documents: {updated} updated, {len(documents) - updated} unchanged")
+    return table, index
+
+
+if __name__ == "__main__":
+    print("Building location index...")
+    build_location_index()
+    print("Location index complete!")
@@ -1,62 +1,368 @@
 import json
 import os
-import glob
+import re
 import unicodedata
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from difflib import SequenceMatcher
+from functools import lru_cache, partial
 
-from requests import delete
+from tqdm import tqdm
 
-L1_DIR = os.path.join(os.path.dirname(__file__), "..", "store/json/l1")
-L2_DIR = os.path.join(os.path.dirname(__file__), "..", "store/json/l2")
+from utils.metrics import absorb_measured, metrics, run_measured, write_metrics
+from utils.store import QUERY_BATCH, open_store
+from utils.workers import get_worker_count
 
+REPORT_PATH = os.path.join(os.path.dirname(__file__), "..", "store/json/merge-report.json")
+INDEXES_PATH = os.path.join(os.path.dirname(__file__), "..", "store/json/firestore.indexes.json")
 
-def merge_json_files():
-    os.makedirs(L2_DIR, exist_ok=True)
+WORKERS = get_worker_count()
+FUZZY_THRESHOLD = 0.85
+REPORT_EXAMPLES = 50
 
-    for l1_file_path in glob.glob(os.path.join(L1_DIR, "*.json")):
-        filename = os.path.basename(l1_file_path)
-        l2_file_path = os.path.join(L2_DIR, filename)
+NAME_PARTICLES = {"al", "d", "da", "de", "del", "della", "der", "di", "du", "el", "la", "le", "van", "von", "y"}
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+MATCH_STAGES = ("exact", "blocked", "fuzzy", "unmatched")
 
-        with open(l1_file_path, 'r', encoding='utf-8') as f:
-            l1_data = json.load(f)
+COLLECTION = "l2"
+# Same estimate the app uses for whichever of the birth and death year is unknown
+AVERAGE_LIFESPAN = 50
+# Lowercased arrays in the query map and the document fields each is built from; locations holds the location ids from
+# parser-locations as well as every place string, birth and death places included
+QUERY_FACETS = {
+    "profession": ("profession",),
+    "religions": ("religions",),
+    "institutions": ("institution_affiliation",),
+    "worked_in": ("worked_in",),
+    "locations": ("locations", "lived_in", "worked_in", "born", "died"),
+}
+# Large fields nothing filters on, kept out of Firestore's automatic single-field indexes
+UNINDEXED_FIELDS = ("summary", "connections", "picture")
+# Composite indexes the app's current queries rely on: an unknown birth year with a death year range
+APP_INDEXES = ((("born.year", "ASCENDING"), ("died.year", "ASCENDING")),)
 
-        if os.path.exists(l2_file_path):
-            with open(l2_file_path, 'r', encoding='utf-8') as f:
-                l2_data = json.load(f)
+store = open_store()
 
-            for key, value in l1_data.items():
-                if key != "connections":
-                    l2_data[key] = value
+
+@lru_cache(maxsize=None)
+def name_tokens(name):
+    # The same people are mentioned across many biographies, so each distinct name is normalised once per process
+    ascii_name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode().lower()
+    tokens = TOKEN_PATTERN.findall(ascii_name)
+    return tuple(token for token in tokens if token not in NAME_PARTICLES) or tuple(tokens)
+
+
+def given_name_score(given_names, tokens):
+    # Full given names count one, a matching initial half; None when the person has given names but none match
+    score = 0
+    for given_name in given_names:
+        if given_name in tokens:
+            score += 1
+        elif any(len(token) == 1 and token == given_name[0] for token in tokens):
+            score += 0.5
+    if not score and given_names and len(tokens) > 1:
+        return None
+    return score
+
+
+class ConnectionIndex:
+    # Every L2 person name is normalised once into its token set and indexed by full name and by each name token
+    def __init__(self, connections):
+        self.connections = connections
+        self.tokens = []
+        self.by_name = {}
+        self.by_token = {}
+        self.assigned = set()
+        for position, connection in enumerate(connections):
+            tokens = name_tokens(str(connection.get("person", "")))
+            self.tokens.append(tokens)
+            self.by_name.setdefault(frozenset(tokens), []).append(position)
+            for token in set(tokens):
+                if len(token) > 1:
+                    self.by_token.setdefault(token, []).append(position)
+
+    def best(self, candidates, given_names):
+        scored = []
+        for position in candidates:
+            if position in self.assigned:
+                continue
+            score = given_name_score(given_names, self.tokens[position])
+            if score is not None:
+                scored.append((score, -position))
+        if not scored:
+            return None, 0
+        return -max(scored)[1], len(scored)
+
+    def fuzzy_candidates(self, surname):
+        # One matcher per key compares it against the distinct indexed tokens sharing its first letter, skipping tokens
+        # whose length alone bounds the similarity below the threshold
+        matcher = SequenceMatcher(None, b=surname)
+        candidates = []
+        for token, positions in self.by_token.items():
+            if token[0] != surname[0]:
+                continue
+            if 2 * min(len(token), len(surname)) < FUZZY_THRESHOLD * (len(token) + len(surname)):
+                continue
+            matcher.set_seq1(token)
+            if matcher.quick_ratio() >= FUZZY_THRESHOLD and matcher.ratio() >= FUZZY_THRESHOLD:
+                candidates.extend(positions)
+        return sorted(set(candidates))
+
+    def match(self, key):
+        # Exact full-name match, then people sharing the surname, then surnames within FUZZY_THRESHOLD similarity
+        tokens = name_tokens(key.replace("_", " "))
+        if not tokens:
+            return None, "unmatched", 0
+        surname, given_names = tokens[0], tokens[1:]
+        stage = "exact"
+        position, candidate_count = self.best(self.by_name.get(frozenset(tokens), ()), given_names)
+        if position is None:
+            stage = "blocked"
+            position, candidate_count = self.best(self.by_token.get(surname, ()), given_names)
+        if position is None:
+            stage = "fuzzy"
+            position, candidate_count = self.best(self.fuzzy_candidates(surname), given_names)
+        if position is None:
+            return None, "unmatched", 0
+        self.assigned.add(position)
+        return self.connections[position], stage, candidate_count
+
+
+def merge_connections(keys, l2_connections):
+    for conn in l2_connections:
+        conn.pop("key", None)
+    index = ConnectionIndex(l2_connections)
+    stats = Counter()
+    examples = {"fuzzy": [], "unmatched": []}
+    for key in keys:
+        l2_connection, stage, candidate_count = index.match(key)
+        stats[stage] += 1
+        stats["ambiguous"] += candidate_count > 1
+        if l2_connection is not None:
+            l2_connection["key"] = key
+            if stage == "fuzzy":
+                examples["fuzzy"].append([key, l2_connection["person"]])
+        else:
+            l2_connections.append({"person": key, "key": key, "connection_type": "Other"})
+            examples["unmatched"].append(key)
+    stats["unkeyed_l2"] = sum("key" not in conn for conn in l2_connections)
+    return stats, examples
+
+
+def year(value):
+    return value if isinstance(value, int) and not isinstance(value, bool) else None
+
+
+def facet_array(document, fields):
+    values = set()
+    for field in fields:
+        value = document.get(field)
+        if isinstance(value, dict):
+            value = [value.get("place")]
+        if isinstance(value, list):
+            values.update(item.strip().lower() for item in value if isinstance(item, str) and item.strip())
+    return sorted(values)
+
+
+def query_fields(document):
+    # Denormalised fields that let one indexed query serve each of the app's filters: a range on born_year instead of
+    # the born.year, estimated died.year and unknown queries, array-contains-any on the decades or centuries a lifespan
+    # covers to find everyone alive in a range, and array-contains-any on the lowercased facets. Firestore takes one
+    # array filter per query, so a facet with the alive filter is checked against born_year and died_year client-side
+    born = year((document.get("born") or {}).get("year"))
+    died = year((document.get("died") or {}).get("year"))
+    born_year = born if born is not None else died - AVERAGE_LIFESPAN if died is not None else None
+    died_year = died if died is not None else born + AVERAGE_LIFESPAN if born is not None else None
+    known = born_year is not None
+    if known and died_year < born_year:
+        died_year = born_year
+    fields = {
+        "known": known,
+        "born_year": born_year,
+        "died_year": died_year,
+        "estimated": known and (born is None or died is None),
+        "century": born_year // 100 * 100 if known else None,
+        "decade": born_year // 10 * 10 if known else None,
+        "active_centuries": list(range(born_year // 100 * 100, died_year // 100 * 100 + 1, 100)) if known else [],
+        "active_decades": list(range(born_year // 10 * 10, died_year // 10 * 10 + 1, 10)) if known else [],
+    }
+    for name, source_fields in QUERY_FACETS.items():
+        fields[name] = facet_array(document, source_fields)
+    return fields
+
+
+def composite_index(*fields):
+    return {
+        "collectionGroup": COLLECTION,
+        "queryScope": "COLLECTION",
+        "fields": [
+            (
+                {"fieldPath": path, "arrayConfig": "CONTAINS"}
+                if order == "CONTAINS"
+                else {"fieldPath": path, "order": order}
+            )
+            for path, order in fields
+        ],
+    }
+
+
+def index_key(index):
+    return index.get("collectionGroup"), index.get("queryScope"), json.dumps(index.get("fields"), sort_keys=True)
+
+
+def index_definitions(existing=None):
+    # firestore.indexes.json for `firebase deploy --only firestore:indexes`, which deletes every index missing from the
+    # file. Single-field queries are served by the automatic indexes; a facet combined with the birth year range or with
+    # the unknown years needs a composite index, as do the app's own queries. Indexes and overrides already in the file
+    # are kept
+    indexes = [composite_index(*fields) for fields in APP_INDEXES]
+    for name in QUERY_FACETS:
+        indexes.append(composite_index((f"query.{name}", "CONTAINS"), ("query.born_year", "ASCENDING")))
+        indexes.append(composite_index((f"query.{name}", "CONTAINS"), ("query.known", "ASCENDING")))
+    field_overrides = [{"collectionGroup": COLLECTION, "fieldPath": field, "indexes": []} for field in UNINDEXED_FIELDS]
+    if existing:
+        generated = {index_key(index) for index in indexes}
+        indexes += [index for index in existing.get("indexes", []) if index_key(index) not in generated]
+        overridden = {(override["collectionGroup"], override["fieldPath"]) for override in field_overrides}
+        field_overrides += [
+            override
+            for override in existing.get("fieldOverrides", [])
+            if (override.get("collectionGroup"), override.get("fieldPath")) not in overridden
+        ]
+    return {"indexes": indexes, "fieldOverrides": field_overrides}
+
+
+def write_index_definitions():
+    existing = None
+    if os.path.exists(INDEXES_PATH):
+        with open(INDEXES_PATH, "r", encoding="utf-8") as f:
+            existing = json.load(f)
+    definitions = index_definitions(existing)
+    os.makedirs(os.path.dirname(INDEXES_PATH), exist_ok=True)
+    tmp_path = f"{INDEXES_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(definitions, indent=2))
+    os.replace(tmp_path, INDEXES_PATH)
+    return definitions
+
+
+def process_file(key):
+    with metrics.span("merge_seconds", key):
+        result = merge_file(key)
+    if result[0]:
+        for stage in MATCH_STAGES:
+            metrics.increment("merge_connections", result[2].get(stage, 0), result=stage)
+    return result
+
+
+def keep_location(value, previous):
+    # born and died come from L1 without the location id parser-locations added; it is kept while the place is the same
+    if isinstance(value, dict) and isinstance(previous, dict) and "location" in previous:
+        if value.get("place") == previous.get("place"):
+            return {**value, "location": previous["location"]}
+    return value
+
+
+def merge_file(key):
+    # The merged document is handed back to the parent, which writes changed documents in bulk
+    filename = f"{key}.json"
+    try:
+        l1_data = store.load("l1", key)
+        if l1_data is None:
+            raise Exception("L1 data not found")
+
+        stats = Counter()
+        examples = {}
+        existing = store.get("l2", key)
+        if existing is not None:
+            l2_data = json.loads(existing)
+
+            for field, value in l1_data.items():
+                if field != "connections":
+                    l2_data[field] = keep_location(value, l2_data.get(field))
                 else:
-                    l2_connections = l2_data.get("connections", [])
-                    for conn in l2_connections:
-                        conn.pop("key", None)
-                    for connection in value:
-                        l2_connection = next(
-                            (
-                                conn
-                                for conn in l2_connections
-                                if connection.split("_")[0]
-                                in unicodedata.normalize("NFKD", conn["person"]).encode("ascii", "ignore").decode()
-                            ),
-                            None,
-                        )
-                        if l2_connection:
-                            l2_connection["key"] = connection
-                        else:
-                            l2_connections.append({"person": connection, "key": connection, "connection_type": "Other"})
-
-            with open(l2_file_path, 'w', encoding='utf-8') as f:
-                f.write(json.dumps(l2_data, indent=4, ensure_ascii=False))
-
-            print(f"Updated: {filename}")
+                    l2_data["connections"] = l2_data.get("connections", [])
+                    stats, examples = merge_connections(value, l2_data["connections"])
+            stats["updated"] += 1
         else:
-            with open(l2_file_path, 'w', encoding='utf-8') as f:
-                f.write(json.dumps(l1_data, indent=4, ensure_ascii=False))
+            existing = None
+            l2_data = l1_data
+            stats["created"] += 1
+
+        l2_data["query"] = query_fields(l2_data)
+        merged = store.dump(l2_data)
+        return True, filename, stats, examples, merged if merged != existing else None
+    except Exception as ex:
+        return False, filename, f"Error merging {filename}: {ex}", {}, None
+
+
+def match_report(stats, examples):
+    matched = stats["exact"] + stats["blocked"] + stats["fuzzy"]
+    keys = matched + stats["unmatched"]
+    return {
+        "files": {"created": stats["created"], "updated": stats["updated"], "failed": stats["failed"]},
+        "connections": {stage: stats[stage] for stage in MATCH_STAGES},
+        "match_rate": round(matched / keys, 4) if keys else None,
+        "ambiguous": stats["ambiguous"],
+        "unkeyed_l2": stats["unkeyed_l2"],
+        "examples": examples,
+    }
+
+
+def merge_json_files(keys=None, workers=WORKERS):
+    if not keys:
+        keys = store.keys("l1")
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        chunksize = max(1, len(keys) // (workers * 8))
+        results = absorb_measured(executor.map(partial(run_measured, process_file), keys, chunksize=chunksize))
+    else:
+        executor = None
+        results = map(process_file, keys)
+
+    stats = Counter()
+    examples = {"fuzzy": [], "unmatched": []}
+    pending = []
+    try:
+        for success, filename, file_stats, file_examples, merged in tqdm(
+            results, total=len(keys), desc="Merging", mininterval=1
+        ):
+            if not success:
+                stats["failed"] += 1
+                print(f"\n{file_stats}")
+                continue
+            stats.update(file_stats)
+            for kind, kind_examples in file_examples.items():
+                examples[kind].extend([filename, example] for example in kind_examples)
+            if merged is not None:
+                metrics.increment("store_bytes_written", len(merged.encode("utf-8")), collection="l2")
+                pending.append((filename[: -len(".json")], merged))
+                if len(pending) >= QUERY_BATCH:
+                    store.put_many("l2", pending)
+                    pending = []
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        store.put_many("l2", pending)
+
+    report = match_report(stats, {kind: found[:REPORT_EXAMPLES] for kind, found in examples.items()})
+    os.makedirs(os.path.dirname(REPORT_PATH), exist_ok=True)
+    with open(REPORT_PATH, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(report, indent=4, ensure_ascii=False))
 
-            print(f"Created: {filename}")
+    definitions = write_index_definitions()
+    print(f"Files: {stats['created']} created, {stats['updated']} updated, {stats['failed']} failed")
+    print(
+        f"Connections: {stats['exact']} exact, {stats['blocked']} blocked, {stats['fuzzy']} fuzzy, "
+        f"{stats['unmatched']} unmatched ({stats['ambiguous']} ambiguous, {stats['unkeyed_l2']} L2 people without key)"
+    )
+    print(f"Firestore index definitions: {len(definitions['indexes'])} composite indexes written to {INDEXES_PATH}")
+    return report
 
 
 if __name__ == "__main__":
     print("Merging L1 data into L2 data...")
     merge_json_files()
+    write_metrics("merge")
     print("Merge complete!")
@@ -0,0 +1,480 @@
+import asyncio
+import hashlib
+import importlib
+import json
+import os
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from tqdm import tqdm
+
+from crawler import crawler
+from utils.llm import LLM_CONCURRENCY, AsyncLLMClient
+from utils.metrics import metrics, run_measured, write_metrics
+from utils.store import content_hash, open_store
+from utils.workers import get_worker_count
+
+parser_l1 = importlib.import_module("parser.parser-l1")
+parser_l2 = importlib.import_module("parser.parser-l2")
+parser_merge = importlib.import_module("parser.parser-merge")
+parser_locations = importlib.import_module("parser.parser-locations")
+
+LEDGER_PATH = os.path.join(os.path.dirname(__file__), "..", "store/pipeline-ledger.sqlite")
+
+STAGES = ("crawl", "l1", "l2", "merge", "locations", "upload")
+SOURCES = ("crawl", "store", "failed")
+WORKERS = get_worker_count()
+QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 64))
+SOURCE = os.environ.get("PIPELINE_SOURCE", "crawl").lower()
+UPLOAD = os.environ.get("PIPELINE_UPLOAD", "").lower() in ("1", "true", "yes")
+UPLOAD_BATCH_ITEMS = int(os.environ.get("PIPELINE_UPLOAD_BATCH_ITEMS", 100))
+UPLOAD_LINGER_SECONDS = 2
+FORCE_RUN = os.environ.get("FORCE_RUN", "").lower() in ("1", "true", "yes")
+
+if SOURCE not in SOURCES:
+    raise Exception(f"Unknown PIPELINE_SOURCE {SOURCE}, expected one of {', '.join(SOURCES)}")
+
+
+def fingerprint(*parts):
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def use_store(store):
+    # Runs in every worker process; under spawn or forkserver the workers import the modules afresh and would otherwise
+    # open the default store
+    for module in (crawler, parser_l1, parser_l2, parser_merge, parser_locations):
+        module.store = store
+
+
+async def missing_inputs():
+    return "inputs not found"
+
+
+class Ledger:
+    # Per item and stage: the fingerprint of the inputs the stage last ran on, whether it succeeded and why not
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS items (key TEXT NOT NULL, stage TEXT NOT NULL, fingerprint TEXT, "
+                "status TEXT NOT NULL, error TEXT, attempts INTEGER NOT NULL, updated REAL NOT NULL, "
+                "PRIMARY KEY (key, stage))"
+            )
+        return self.connection
+
+    def done(self, key, stage):
+        # The fingerprint the stage last succeeded on, None when it never did or the last attempt failed
+        row = (
+            self.connect()
+            .execute("SELECT fingerprint FROM items WHERE key = ? AND stage = ? AND status = 'done'", (key, stage))
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def record(self, key, stage, fingerprint, status, error=None):
+        self.connect().execute(
+            "INSERT INTO items (key, stage, fingerprint, status, error, attempts, updated) "
+            "VALUES (?, ?, ?, ?, ?, 1, ?) "
+            "ON CONFLICT (key, stage) DO UPDATE SET fingerprint = excluded.fingerprint, status = excluded.status, "
+            "error = excluded.error, updated = excluded.updated, "
+            "attempts = CASE WHEN excluded.status = 'failed' THEN attempts + 1 ELSE 1 END",
+            (key, stage, fingerprint, status, error, time.time()),
+        )
+
+    def failed(self):
+        # The earliest failed stage of every item, which is where a retry picks it up
+        failed = {}
+        for key, stage in self.connect().execute("SELECT key, stage FROM items WHERE status = 'failed' ORDER BY key"):
+            if key not in failed or STAGES.index(stage) < STAGES.index(failed[key]):
+                failed[key] = stage
+        return failed
+
+    def counts(self):
+        rows = self.connect().execute("SELECT stage, status, COUNT(*) FROM items GROUP BY stage, status")
+        return {(stage, status): count for stage, status, count in rows}
+
+
+class Pipeline:
+    # Stages are connected by bounded queues, so an item moves on as soon as a stage is done with it and a slow stage
+    # holds back the ones feeding it instead of letting work pile up in memory
+    def __init__(self, store, ledger, upload=UPLOAD, queue_size=QUEUE_SIZE):
+        self.store = store
+        self.ledger = ledger
+        self.stages = STAGES if upload else STAGES[:-1]
+        self.queues = {stage: asyncio.Queue(queue_size) for stage in self.stages[1:]}
+        self.workers = {
+            "crawl": crawler.CONCURRENCY,
+            "l1": WORKERS,
+            "l2": LLM_CONCURRENCY,
+            "merge": WORKERS,
+            "locations": 1,
+            "upload": 1,
+        }
+        self.stats = {stage: Counter() for stage in self.stages}
+        self.busy = Counter()
+        self.active = {}
+        self.l1_hashes = {}
+        self.executor = None
+        self.client = None
+        self.uploader = None
+        self.progress = None
+
+    def next_stage(self, stage):
+        position = self.stages.index(stage) + 1
+        return self.stages[position] if position < len(self.stages) else None
+
+    def finished(self, stage, key, moved_on):
+        # Items leave the pipeline after the last stage or at the first stage that fails them
+        if not moved_on or self.next_stage(stage) is None:
+            self.progress.update(1)
+
+    async def run_item(self, stage, key, item_fingerprint, work):
+        # Skips the work when the stage already succeeded on the same inputs; returns whether the item moves on
+        if not FORCE_RUN and item_fingerprint is not None and self.ledger.done(key, stage) == item_fingerprint:
+            self.stats[stage]["skipped"] += 1
+            metrics.increment("pipeline_items", stage=stage, status="skipped")
+            return True
+        start = time.perf_counter()
+        self.active.setdefault(stage, [start, start])
+        try:
+            with metrics.span("pipeline_stage_seconds", key, stage=stage):
+                error = await work()
+        except Exception as ex:
+            error = str(ex) or type(ex).__name__
+        end = time.perf_counter()
+        self.busy[stage] += end - start
+        self.active[stage][1] = max(self.active[stage][1], end)
+        status = "failed" if error else "done"
+        self.ledger.record(key, stage, item_fingerprint, status, error)
+        self.stats[stage][status] += 1
+        metrics.increment("pipeline_items", stage=stage, status=status)
+        if error:
+            print(f"\n{stage} failed for {key}: {error}")
+        return not error
+
+    async def crawl_item(self, client, throttle, url, manifest, archive):
+        # Returns None once the item is handed to L1, or the error
+        key = crawler.markdown_key(url)
+        result = {}
+
+        async def work():
+            success, message, changed = await crawler.process_biography(
+                client, throttle, url, manifest, self.executor, archive
+            )
+            result["changed"] = changed
+            result["error"] = None if success else message
+            return result["error"]
+
+        if not await self.run_item("crawl", key, None, work):
+            return result.get("error") or "crawl failed"
+        self.stats["crawl"]["changed"] += result["changed"]
+        await self.enqueue("l1", key)
+        return None
+
+    def discovered(self, count):
+        self.progress.total = (self.progress.total or 0) + count
+        self.progress.refresh()
+
+    async def resume_crawled(self, frontier):
+        # Biographies an interrupted run already fetched may not have made it through the later stages; the ledger
+        # skips the ones that did
+        urls = frontier.done()
+        self.discovered(len(urls))
+        for url in urls:
+            await self.enqueue("l1", crawler.markdown_key(url))
+
+    async def crawl(self, base_url, letters, keys=None):
+        # Biographies are handed to L1 parsing as soon as they are stored. A full crawl goes through the crawler's
+        # persistent frontier, so an interrupted run resumes where it stopped; failed items are fetched again by URL
+        manifest = crawler.load_manifest()
+        throttle = crawler.HostThrottle(concurrency=min(self.workers["crawl"], crawler.HOST_CONCURRENCY))
+        archive = crawler.open_archive()
+        try:
+            async with crawler.create_client(self.workers["crawl"]) as client:
+
+                async def visit_biography(url):
+                    return await self.crawl_item(client, throttle, url, manifest, archive)
+
+                def gave_up(url, error):
+                    self.finished("crawl", crawler.markdown_key(url), False)
+
+                if keys is None:
+                    frontier = crawler.start_frontier(base_url, letters)
+                    await asyncio.gather(
+                        self.resume_crawled(frontier),
+                        crawler.walk_frontier(
+                            client,
+                            throttle,
+                            frontier,
+                            self.workers["crawl"],
+                            visit_biography,
+                            archive,
+                            self.discovered,
+                            gave_up,
+                        ),
+                    )
+                    return
+
+                urls = [f"{base_url}{key}/" for key in keys]
+                self.discovered(len(urls))
+                pending = asyncio.Queue()
+                for url in urls:
+                    pending.put_nowait(url)
+
+                async def worker():
+                    while not pending.empty():
+                        url = pending.get_nowait()
+                        error = await visit_biography(url)
+                        if error is not None:
+                            gave_up(url, error)
+
+                await asyncio.gather(*(worker() for _ in range(self.workers["crawl"])))
+        finally:
+            crawler.save_manifest(manifest)
+            if archive is not None:
+                archive.close()
+
+    async def parse_l1(self, key):
+        markdown_text = self.store.get("md", key)
+        markdown_hash = content_hash(markdown_text) if markdown_text is not None else None
+
+        async def work():
+            if markdown_text is None:
+                return "markdown not found"
+            self.l1_hashes[f"{key}.md"] = markdown_hash
+            loop = asyncio.get_running_loop()
+            with metrics.span("parse_l1_seconds", key):
+                document = await loop.run_in_executor(
+                    self.executor, parser_l1.extract_biography_data, key, markdown_text, self.store.indent
+                )
+            self.store.put("l1", key, document)
+
+        return await self.run_item("l1", key, markdown_hash, work)
+
+    async def extract_l2(self, key):
+        markdown_text = self.store.get("md", key)
+        l1_text = self.store.get("l1", key)
+        if markdown_text is None or l1_text is None:
+            return await self.run_item("l2", key, None, missing_inputs)
+        item_fingerprint = fingerprint(content_hash(markdown_text), content_hash(l1_text))
+
+        if self.ledger.done(key, "l2") is None and parser_l2.is_extracted(key):
+            # Extracted before the ledger knew about it, by an earlier parser-l2 run: recorded instead of paid for again
+            self.ledger.record(key, "l2", item_fingerprint, "done")
+            self.stats["l2"]["skipped"] += 1
+            metrics.increment("pipeline_items", stage="l2", status="skipped")
+            return True
+
+        async def work():
+            if not await parser_l2.extract_and_store(self.client, key, markdown_text, json.loads(l1_text)):
+                return "extraction failed"
+
+        return await self.run_item("l2", key, item_fingerprint, work)
+
+    async def merge(self, key):
+        # Re-merged when the L1 document or the L2 extraction it was merged from changed
+        l1_text = self.store.get("l1", key)
+        extraction = self.ledger.done(key, "l2")
+        if l1_text is None or extraction is None:
+            return await self.run_item("merge", key, None, missing_inputs)
+
+        async def work():
+            loop = asyncio.get_running_loop()
+            result, snapshot = await loop.run_in_executor(self.executor, run_measured, parser_merge.process_file, key)
+            metrics.absorb(snapshot)
+            success, _, error, _, merged = result
+            if not success:
+                return error
+            if merged is not None:
+                self.store.put("l2", key, merged)
+
+        return await self.run_item("merge", key, fingerprint(content_hash(l1_text), extraction), work)
+
+    async def locations(self):
+        # Places are resolved against every place in the corpus, so this stage waits for the last merge, locates the whole
+        # corpus once and then hands on the items that reached it
+        queue = self.queues["locations"]
+        keys = []
+        while (key := await queue.get()) is not None:
+            keys.append(key)
+        next_stage = self.next_stage("locations")
+        if keys:
+            start = time.perf_counter()
+            self.active.setdefault("locations", [start, start])
+            loop = asyncio.get_running_loop()
+            try:
+                with metrics.span("pipeline_stage_seconds", "corpus", stage="locations"):
+                    await loop.run_in_executor(None, parser_locations.build_location_index)
+                error = None
+            except Exception as ex:
+                error = str(ex) or type(ex).__name__
+                print(f"\nlocations failed for {len(keys)} items: {error}")
+            end = time.perf_counter()
+            self.busy["locations"] += end - start
+            self.active["locations"][1] = end
+            status = "failed" if error else "done"
+            for key in keys:
+                self.ledger.record(key, "locations", None, status, error)
+                self.stats["locations"][status] += 1
+                metrics.increment("pipeline_items", stage="locations", status=status)
+                self.finished("locations", key, not error)
+                if not error and next_stage is not None:
+                    await self.enqueue(next_stage, key)
+        if next_stage is not None:
+            await self.close(next_stage)
+
+    async def upload_batch(self, keys):
+        # All three collections of a batch of items are upserted in one go on a worker thread
+        fingerprints = {}
+        for key in keys:
+            contents = [self.store.get(collection, key) or "" for collection in ("md", "l1", "l2")]
+            fingerprints[key] = fingerprint(*(content_hash(content) for content in contents))
+        pending = [key for key in keys if FORCE_RUN or self.ledger.done(key, "upload") != fingerprints[key]]
+        self.stats["upload"]["skipped"] += len(keys) - len(pending)
+        if pending:
+            start = time.perf_counter()
+            self.active.setdefault("upload", [start, start])
+            loop = asyncio.get_running_loop()
+            try:
+                for collection in ("md", "l1", "l2"):
+                    await loop.run_in_executor(None, self.uploader.upload_documents, collection, pending)
+                error = None
+            except Exception as ex:
+                error = str(ex) or type(ex).__name__
+                print(f"\nupload failed for {len(pending)} items: {error}")
+            end = time.perf_counter()
+            self.busy["upload"] += end - start
+            self.active["upload"][1] = end
+            for key in pending:
+                self.ledger.record(key, "upload", fingerprints[key], "failed" if error else "done", error)
+            self.stats["upload"]["failed" if error else "done"] += len(pending)
+        self.progress.update(len(keys))
+
+    async def upload(self):
+        queue = self.queues["upload"]
+        batch = []
+        while True:
+            try:
+                key = await (asyncio.wait_for(queue.get(), UPLOAD_LINGER_SECONDS) if batch else queue.get())
+            except TimeoutError:
+                key = ""
+            if key:
+                batch.append(key)
+            if batch and (not key or len(batch) >= UPLOAD_BATCH_ITEMS):
+                await self.upload_batch(batch)
+                batch = []
+            if key is None:
+                return
+
+    async def run_stage(self, stage, handle):
+        # Every worker takes items until it reads the end marker, then the next stage gets one marker per worker
+        next_stage = self.next_stage(stage)
+
+        async def worker():
+            while True:
+                key = await self.queues[stage].get()
+                if key is None:
+                    return
+                moved_on = await handle(key)
+                self.finished(stage, key, moved_on)
+                if moved_on and next_stage is not None:
+                    await self.enqueue(next_stage, key)
+
+        await asyncio.gather(*(worker() for _ in range(self.workers[stage])))
+        if next_stage is not None:
+            await self.close(next_stage)
+
+    async def enqueue(self, stage, key):
+        # Depths are sampled on every hand-over; the peak shows which stage the pipeline was waiting on
+        await self.queues[stage].put(key)
+        metrics.gauge("pipeline_queue_depth", self.queues[stage].qsize(), stage=stage)
+
+    async def close(self, stage):
+        for _ in range(self.workers[stage]):
+            await self.queues[stage].put(None)
+
+    async def feed(self, source, base_url, letters):
+        if source == "crawl":
+            await self.crawl(base_url, letters)
+        elif source == "store":
+            keys = self.store.keys("md")
+            self.progress.total = len(keys)
+            for key in keys:
+                await self.enqueue("l1", key)
+        else:
+            # Failed items re-enter at the stage that failed them; failed crawls are fetched again by URL
+            failed = self.ledger.failed()
+            crawls = [key for key, stage in failed.items() if stage == "crawl"]
+            self.progress.total = len(failed) - len(crawls)
+            if crawls:
+                await self.crawl(base_url, letters, crawls)
+            for stage in self.stages[1:]:
+                for key in (key for key, failed_stage in failed.items() if failed_stage == stage):
+                    await self.enqueue(stage, key)
+        await self.close("l1")
+
+    async def run(self, source=SOURCE, base_url=crawler.BASE_URL, letters=None):
+        if letters is None:
+            letters = [chr(letter) for letter in range(ord("a"), ord("z") + 1)]
+        if "upload" in self.stages:
+            self.uploader = importlib.import_module("upload.uploader")
+        # Every stage reads and writes the same store, including the worker processes started below
+        use_store(self.store)
+        if self.uploader is not None:
+            self.uploader.store = self.store
+
+        self.executor = ProcessPoolExecutor(max_workers=WORKERS, initializer=use_store, initargs=(self.store,))
+        start = time.perf_counter()
+        try:
+            async with AsyncLLMClient(concurrency=LLM_CONCURRENCY) as client:
+                self.client = client
+                with tqdm(desc="Pipeline", unit="item", mininterval=1) as self.progress:
+                    stages = [
+                        self.feed(source, base_url, letters),
+                        self.run_stage("l1", self.parse_l1),
+                        self.run_stage("l2", self.extract_l2),
+                        self.run_stage("merge", self.merge),
+                        self.locations(),
+                    ]
+                    if "upload" in self.stages:
+                        stages.append(self.upload())
+                    await asyncio.gather(*stages)
+        finally:
+            self.executor.shutdown()
+            manifest = parser_l1.load_manifest()
+            manifest.update(self.l1_hashes)
+            parser_l1.save_manifest(manifest)
+        elapsed = time.perf_counter() - start
+        self.report(elapsed)
+        return elapsed
+
+    def report(self, elapsed):
+        print(f"{'stage':<9} {'done':>6} {'skipped':>8} {'failed':>7} {'busy s':>9} {'active s':>9}")
+        for stage in self.stages:
+            stats = self.stats[stage]
+            first, last = self.active.get(stage, (0, 0))
+            print(
+                f"{stage:<9} {stats['done']:>6} {stats['skipped']:>8} {stats['failed']:>7} "
+                f"{self.busy[stage]:>9.1f} {last - first:>9.1f}"
+            )
+        stage_total = sum(last - first for first, last in self.active.values())
+        print(f"End to end {elapsed:.1f}s, stages active for {stage_total:.1f}s in total")
+
+
+def run_pipeline(source=SOURCE, upload=UPLOAD, base_url=crawler.BASE_URL, letters=None, store=None, ledger=None):
+    pipeline = Pipeline(store or open_store(), ledger or Ledger(LEDGER_PATH), upload)
+    return asyncio.run(pipeline.run(source, base_url, letters))
+
+
+if __name__ == "__main__":
+    run_pipeline()
+    write_metrics("pipeline")
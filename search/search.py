@@ -0,0 +1,352 @@
+import array
+import heapq
+import json
+import math
+import os
+import re
+import sqlite3
+import sys
+import unicodedata
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from tqdm import tqdm
+
+from export.exporter import compress
+from utils.store import QUERY_BATCH, open_store
+from utils.workers import get_worker_count
+
+INDEX_PATH = os.path.join(os.path.dirname(__file__), "..", "store/search.sqlite")
+EXPORT_DIR = os.path.join(os.path.dirname(__file__), "..", "store/bundle/search")
+
+WORKERS = get_worker_count()
+FORCE_RUN = os.environ.get("FORCE_RUN", "").lower() in ("1", "true", "yes")
+FORMAT_VERSION = 1
+INDEX_FILENAME = "index.json.gz"
+SHARD_PREFIX = "terms-"
+# Postings per exported shard, so a query fetches a few hundred KiB at most per term
+SHARD_POSTINGS = int(os.environ.get("SEARCH_SHARD_POSTINGS", 20000))
+
+# Okapi BM25 parameters
+K1 = 1.2
+B = 0.75
+
+LINK_PATTERN = re.compile(r"!?\[([^\]]*)\]\([^)]*\)")
+URL_PATTERN = re.compile(r"https?://\S+")
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+COMBINING_PATTERN = re.compile("[\u0300-\u036f]")
+QUERY_PATTERN = re.compile(r'"([^"]*)"|(\S+)')
+# Letters NFKD leaves without an ASCII base
+FOLD_LETTERS = str.maketrans(
+    {"ł": "l", "Ł": "L", "ø": "o", "Ø": "O", "đ": "d", "Đ": "D", "ı": "i", "ß": "ss", "æ": "ae", "Æ": "Ae", "œ": "oe"}
+)
+
+store = open_store()
+
+
+def fold(text):
+    # "Gödel", "Godel" and "GÖDEL" all become "godel"; other non-ASCII characters separate words
+    decomposed = unicodedata.normalize("NFKD", text.translate(FOLD_LETTERS))
+    return COMBINING_PATTERN.sub("", decomposed).encode("ascii", "replace").decode().lower()
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(fold(text))
+
+
+def document_text(markdown_text):
+    # Link targets and bare URLs are noise; link texts (names of other mathematicians) are kept
+    return URL_PATTERN.sub(" ", LINK_PATTERN.sub(r" \1 ", markdown_text))
+
+
+def encode_positions(positions):
+    # Fixed-width little-endian uint32s: larger than varints but decoded by a single copy, which keeps phrase queries
+    # over common words fast
+    data = array.array("I", positions)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data.tobytes()
+
+
+def decode_positions(data):
+    positions = array.array("I")
+    positions.frombytes(data)
+    if sys.byteorder != "little":
+        positions.byteswap()
+    return positions
+
+
+def index_document(key, markdown_text):
+    # Runs in a worker process: the document length and its postings, positions already encoded
+    positions = defaultdict(list)
+    tokens = tokenize(document_text(markdown_text))
+    for position, token in enumerate(tokens):
+        positions[token].append(position)
+    postings = [
+        (term, len(term_positions), encode_positions(term_positions)) for term, term_positions in positions.items()
+    ]
+    return key, len(tokens), postings
+
+
+def parse_query(query):
+    # Bare words are scored, "quoted phrases" must also appear word for word
+    terms = []
+    phrases = []
+    for phrase, word in QUERY_PATTERN.findall(query):
+        tokens = tokenize(phrase or word)
+        terms += tokens
+        if phrase and len(tokens) > 1:
+            phrases.append(tokens)
+    return list(dict.fromkeys(terms)), phrases
+
+
+def contains_phrase(positions, phrase):
+    # positions maps each phrase term to its positions in one document; a phrase start has every following term right
+    # after it
+    starts = set(positions[phrase[0]])
+    for offset, term in enumerate(phrase[1:], 1):
+        starts &= {position - offset for position in positions[term]}
+        if not starts:
+            return False
+    return bool(starts)
+
+
+class SearchIndex:
+    # Positional inverted index in SQLite: postings are clustered by term, so a query term is a single range read
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self.connection = None
+        self.documents = None
+
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, "
+                "name TEXT, hash TEXT NOT NULL, length INTEGER NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, document INTEGER NOT NULL, "
+                "frequency INTEGER NOT NULL, positions BLOB NOT NULL, PRIMARY KEY (term, document)) WITHOUT ROWID"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS postings_document ON postings (document)")
+        return self.connection
+
+    def load_documents(self):
+        # Lengths and names of every document, kept in memory for scoring
+        if self.documents is None:
+            rows = self.connect().execute("SELECT id, key, name, length FROM documents")
+            self.documents = {id: (key, name, length) for id, key, name, length in rows}
+            total = sum(length for _, _, length in self.documents.values())
+            self.average_length = total / len(self.documents) if self.documents else 0
+        return self.documents
+
+    def update(self, store=store, workers=WORKERS):
+        # Only documents whose markdown hash changed are tokenised again; removed documents are dropped
+        connection = self.connect()
+        hashes = store.hashes("md")
+        indexed = {key: (id, digest) for id, key, digest in connection.execute("SELECT id, key, hash FROM documents")}
+        changed = sorted(
+            key for key, digest in hashes.items() if FORCE_RUN or indexed.get(key, (None, None))[1] != digest
+        )
+        removed = [key for key in indexed if key not in hashes]
+        self.remove([indexed[key][0] for key in removed])
+
+        if workers > 1 and len(changed) > workers:
+            executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            executor = None
+        try:
+            for start in tqdm(range(0, len(changed), QUERY_BATCH), desc="Indexing", unit="batch", mininterval=1):
+                keys = changed[start : start + QUERY_BATCH]
+                texts = store.get_many("md", keys)
+                names = {key: json.loads(content).get("name") for key, content in store.get_many("l1", keys).items()}
+                keys = [key for key in keys if key in texts]
+                if executor is not None:
+                    chunksize = max(1, len(keys) // (workers * 8))
+                    results = executor.map(index_document, keys, [texts[key] for key in keys], chunksize=chunksize)
+                else:
+                    results = map(index_document, keys, [texts[key] for key in keys])
+                self.write(list(results), hashes, names, indexed)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        self.documents = None
+        print(f"Search index: {len(changed)} documents indexed, {len(removed)} removed, {len(hashes)} in total")
+        return len(changed), len(removed)
+
+    def write(self, results, hashes, names, indexed):
+        connection = self.connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for key, length, postings in results:
+                id = indexed.get(key, (None, None))[0]
+                if id is not None:
+                    connection.execute("DELETE FROM postings WHERE document = ?", (id,))
+                    connection.execute(
+                        "UPDATE documents SET name = ?, hash = ?, length = ? WHERE id = ?",
+                        (names.get(key), hashes[key], length, id),
+                    )
+                else:
+                    id = connection.execute(
+                        "INSERT INTO documents (key, name, hash, length) VALUES (?, ?, ?, ?)",
+                        (key, names.get(key), hashes[key], length),
+                    ).lastrowid
+                connection.executemany(
+                    "INSERT INTO postings (term, document, frequency, positions) VALUES (?, ?, ?, ?)",
+                    ((term, id, frequency, positions) for term, frequency, positions in postings),
+                )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def remove(self, ids):
+        connection = self.connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany("DELETE FROM postings WHERE document = ?", ((id,) for id in ids))
+            connection.executemany("DELETE FROM documents WHERE id = ?", ((id,) for id in ids))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def postings(self, term, positions=False):
+        column = "positions" if positions else "NULL"
+        query = f"SELECT document, frequency, {column} FROM postings WHERE term = ?"
+        return self.connect().execute(query, (term,)).fetchall()
+
+    def search(self, query, limit=10):
+        # BM25 over every query term; documents missing a quoted phrase are dropped
+        documents = self.load_documents()
+        terms, phrases = parse_query(query)
+        if not terms or not documents:
+            return []
+        phrase_terms = {term for phrase in phrases for term in phrase}
+        count = len(documents)
+        scores = defaultdict(float)
+        positions = defaultdict(dict)
+        for term in terms:
+            rows = self.postings(term, term in phrase_terms)
+            idf = math.log(1 + (count - len(rows) + 0.5) / (len(rows) + 0.5))
+            for id, frequency, data in rows:
+                length = documents[id][2]
+                norm = K1 * (1 - B + B * length / self.average_length)
+                scores[id] += idf * frequency * (K1 + 1) / (frequency + norm)
+                if data is not None:
+                    positions[id][term] = data
+        for phrase in phrases:
+            # Positions are only decoded for documents that have every term of the phrase
+            for id in list(scores):
+                found = positions[id]
+                if not all(term in found for term in phrase) or not contains_phrase(
+                    {term: decode_positions(found[term]) for term in phrase}, phrase
+                ):
+                    del scores[id]
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+        return [{"key": documents[id][0], "name": documents[id][1], "score": round(score, 4)} for id, score in best]
+
+    def export(self, export_dir=EXPORT_DIR):
+        # Terms in sort order are cut into shards of about SHARD_POSTINGS postings; the index lists the first term of
+        # every shard so the app can find the one holding a term by binary search
+        documents = self.load_documents()
+        ids = sorted(documents)
+        positions = {id: position for position, id in enumerate(ids)}
+        os.makedirs(export_dir, exist_ok=True)
+        index = {
+            "version": FORMAT_VERSION,
+            "k1": K1,
+            "b": B,
+            "documents": {
+                "key": [documents[id][0] for id in ids],
+                "name": [documents[id][1] for id in ids],
+                "length": [documents[id][2] for id in ids],
+            },
+            "shards": [],
+        }
+        shard = None
+        rows = self.connect().execute(
+            "SELECT term, document, frequency, positions FROM postings ORDER BY term, document"
+        )
+        for term, id, frequency, data in rows:
+            if shard is None or shard["terms"][-1] != term:
+                if shard is not None and shard["postings"] >= SHARD_POSTINGS:
+                    self.write_shard(export_dir, index, shard)
+                    shard = None
+                if shard is None:
+                    shard = {
+                        "version": FORMAT_VERSION,
+                        "terms": [],
+                        "documents": [],
+                        "frequencies": [],
+                        "positions": [],
+                    }
+                    shard["postings"] = 0
+                for column in ("documents", "frequencies", "positions"):
+                    shard[column].append([])
+                shard["terms"].append(term)
+            shard["documents"][-1].append(positions[id])
+            shard["frequencies"][-1].append(frequency)
+            shard["positions"][-1].append(decode_positions(data).tolist())
+            shard["postings"] += 1
+        if shard is not None:
+            self.write_shard(export_dir, index, shard)
+
+        _, data = compress(index)
+        write_file(export_dir, INDEX_FILENAME, data)
+        current = {entry["file"] for entry in index["shards"]}
+        for filename in os.listdir(export_dir):
+            if filename.startswith(SHARD_PREFIX) and filename not in current:
+                os.remove(os.path.join(export_dir, filename))
+        size = len(data) + sum(entry["bytes"] for entry in index["shards"])
+        print(f"Exported {len(ids)} documents into {len(index['shards'])} term shards ({size / 1024:.0f} KiB)")
+        return index
+
+    def write_shard(self, export_dir, index, shard):
+        # Document positions and term positions are both stored as gaps from the previous value
+        del shard["postings"]
+        shard["documents"] = [gaps(documents) for documents in shard["documents"]]
+        shard["positions"] = [[gaps(term_positions) for term_positions in term] for term in shard["positions"]]
+        digest, data = compress(shard)
+        filename = f"{SHARD_PREFIX}{len(index['shards'])}.{digest}.json.gz"
+        if not os.path.exists(os.path.join(export_dir, filename)):
+            write_file(export_dir, filename, data)
+        index["shards"].append(
+            {"first": shard["terms"][0], "terms": len(shard["terms"]), "file": filename, "bytes": len(data)}
+        )
+
+
+def gaps(values):
+    return [value - previous for previous, value in zip([0] + values, values)]
+
+
+def write_file(export_dir, filename, data):
+    file_path = os.path.join(export_dir, filename)
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+
+
+def print_results(results):
+    for rank, result in enumerate(results, 1):
+        print(f"{rank:>3}. {result['score']:>8.3f}  {result['key']}  {result['name'] or ''}")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    search_index = SearchIndex()
+    if command == "update":
+        search_index.update()
+    elif command == "export":
+        search_index.update()
+        search_index.export()
+    elif command == "query" and len(sys.argv) > 2:
+        print_results(search_index.search(" ".join(sys.argv[2:])))
+    else:
+        raise Exception('Usage: python -m search.search update|export|query "words or a quoted phrase"')
@@ -0,0 +1,385 @@
+import asyncio
+import bisect
+import json
+import os
+import re
+import time
+from array import array
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from export.exporter import AVERAGE_LIFESPAN, CONNECTION_TYPE_ALIASES
+from utils.metrics import metrics
+from utils.store import open_store
+
+HOST = os.environ.get("SERVICE_HOST", "127.0.0.1")
+PORT = int(os.environ.get("SERVICE_PORT", 8765))
+ALLOW_ORIGIN = os.environ.get("SERVICE_ALLOW_ORIGIN", "*")
+# Requests larger than this, or idle connections past the timeout, are dropped
+MAX_REQUEST_BYTES = 64 * 1024
+IDLE_TIMEOUT_SECONDS = 30
+
+# Query parameters, named after the app's filters, and the document fields each one is matched against
+FACETS = {
+    "profession": ("profession",),
+    "religions": ("religions",),
+    "institutions": ("institution_affiliation",),
+    "worked_in": ("worked_in",),
+    "locations": ("locations", "lived_in", "worked_in", "born", "died"),
+}
+MODES = ("born", "alive")
+# Facet values held by at least one person in this many are stored as bitmaps, where the bitmap is the smaller form
+DENSE_RATIO = 32
+ONE_PATTERN = re.compile("1")
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Content Too Large",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+}
+
+
+class RequestError(Exception):
+    # A request that can't be framed; answered with its status and the connection closed
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+store = open_store()
+
+
+def estimated_lifespan(document):
+    # Birth and death years, each estimated from the other when missing, as the app does for birth years
+    born = (document.get("born") or {}).get("year")
+    died = (document.get("died") or {}).get("year")
+    if born is None and died is None:
+        return None
+    return (
+        born if born is not None else died - AVERAGE_LIFESPAN,
+        died if died is not None else born + AVERAGE_LIFESPAN,
+    )
+
+
+def facet_values(document, fields):
+    # Location ids from parser-locations when present, and the place strings themselves, birth and death places included
+    values = set()
+    for field in fields:
+        value = document.get(field)
+        if isinstance(value, dict):
+            value = [value.get("place")]
+        values.update(item for item in value or [] if isinstance(item, str) and item.strip())
+    return values
+
+
+def facet_key(value):
+    return value.strip().casefold()
+
+
+def bitmap(positions, count):
+    data = bytearray((count + 7) // 8)
+    for position in positions:
+        data[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(data, "little")
+
+
+def facet_count(matched):
+    return matched.bit_count() if isinstance(matched, int) else len(matched)
+
+
+def positions(mask):
+    # Set bits of a bitmap, lowest first
+    return [match.start() for match in ONE_PATTERN.finditer(bin(mask)[:1:-1])]
+
+
+def dumps(payload):
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class QueryIndex:
+    # People sorted by estimated birth year, so a birth year range is a contiguous run of positions and its bitmap a
+    # single shift; those with no known years come last. Facet values map to bitmaps over the same positions, ORed
+    # within a filter and ANDed across filters. Nodes and links are serialised once at load time
+    def __init__(self, documents):
+        documents = sorted(
+            documents, key=lambda document: (estimated_lifespan(document) or (float("inf"),), document["id"])
+        )
+        self.documents = documents
+        self.ids = [document["id"] for document in documents]
+        self.positions = {id: position for position, id in enumerate(self.ids)}
+        lifespans = [estimated_lifespan(document) for document in documents]
+        self.known = sum(lifespan is not None for lifespan in lifespans)
+        self.starts = [lifespan[0] for lifespan in lifespans[: self.known]]
+        self.ends = [lifespan[1] for lifespan in lifespans[: self.known]]
+        # Longest lifespan, bounding how far before a range someone alive in it can have been born
+        self.longest = max((end - start for start, end in zip(self.starts, self.ends)), default=0)
+        self.unknown = ((1 << len(documents)) - 1) ^ ((1 << self.known) - 1)
+
+        self.facets = {name: {} for name in FACETS}
+        self.values = {name: {} for name in FACETS}
+        for position, document in enumerate(documents):
+            for name, fields in FACETS.items():
+                for value in facet_values(document, fields):
+                    key = facet_key(value)
+                    self.facets[name].setdefault(key, array("I")).append(position)
+                    self.values[name].setdefault(key, value)
+        # Values shared by many people are kept as bitmaps, rare ones (most places) as positions until queried
+        for facets in self.facets.values():
+            for key, matched in facets.items():
+                if len(matched) * DENSE_RATIO >= len(documents):
+                    facets[key] = bitmap(matched, len(documents))
+
+        self.nodes = [dumps(self.node(document)) for document in documents]
+        self.links = [self.document_links(document) for document in documents]
+
+    def node(self, document):
+        return {
+            "id": document["id"],
+            "name": document.get("name") or document["id"],
+            "val": 1 + len(document.get("connections") or []) * 0.5,
+            "img": document.get("picture"),
+            "data": document,
+        }
+
+    def document_links(self, document):
+        # Connections to people in the corpus as (target position, serialised link)
+        links = []
+        for connection in document.get("connections") or []:
+            target = self.positions.get(connection.get("key"))
+            if target is None:
+                continue
+            connection_type = str(connection.get("connection_type", "")).strip()
+            connection_type = CONNECTION_TYPE_ALIASES.get(connection_type.lower(), connection_type)
+            link = {"source": document["id"], "target": connection["key"], "type": connection_type}
+            links.append((target, dumps(link)))
+        return links
+
+    def range_mask(self, start, stop):
+        return ((1 << stop) - 1) ^ ((1 << start) - 1) if stop > start else 0
+
+    def years(self, min_year, max_year, mode):
+        # born: estimated birth year in the range. alive: estimated lifespan overlapping it, which only needs a look at
+        # the end years of people born up to `longest` years before the range
+        first = bisect.bisect_left(self.starts, min_year)
+        last = bisect.bisect_right(self.starts, max_year)
+        mask = self.range_mask(first, last)
+        if mode == "alive":
+            for position in range(bisect.bisect_left(self.starts, min_year - self.longest), first):
+                if self.ends[position] >= min_year:
+                    mask |= 1 << position
+        return mask
+
+    def query(self, min_year=None, max_year=None, include_unknown=False, mode="born", facets=None, limit=None):
+        if min_year is None and max_year is None:
+            mask = self.range_mask(0, self.known)
+        else:
+            mask = self.years(
+                min_year if min_year is not None else -(10**9),
+                max_year if max_year is not None else 10**9,
+                mode,
+            )
+        if include_unknown:
+            mask |= self.unknown
+        for name, values in (facets or {}).items():
+            selected = 0
+            for value in values:
+                matched = self.facets[name].get(facet_key(value), 0)
+                selected |= matched if isinstance(matched, int) else bitmap(matched, len(self.ids))
+            mask &= selected
+        matched = positions(mask)
+        return matched[:limit] if limit is not None else matched
+
+    def graph(self, matched):
+        # The graph payload assembled from pre-serialised nodes and links; links stay inside the matched people
+        included = set(matched)
+        links = [link for position in matched for target, link in self.links[position] if target in included]
+        return b"".join(
+            (
+                b'{"nodes":[',
+                b",".join(self.nodes[position] for position in matched),
+                b'],"links":[',
+                b",".join(links),
+                b"]}",
+            )
+        )
+
+    def facet_counts(self):
+        return {
+            name: sorted(
+                ({"value": self.values[name][key], "count": facet_count(matched)} for key, matched in facets.items()),
+                key=lambda entry: (-entry["count"], entry["value"]),
+            )
+            for name, facets in self.facets.items()
+        }
+
+
+def load_index():
+    documents = []
+    for key, content in store.items("l2"):
+        try:
+            document = json.loads(content)
+            document.setdefault("id", key)
+            documents.append(document)
+        except Exception as ex:
+            print(f"Error reading {key}: {ex}")
+    return QueryIndex(documents)
+
+
+def parse_request(head):
+    # (method, path, version, headers, body length) of a request head, or RequestError when it is malformed
+    lines = head.decode("latin-1").split("\r\n")
+    request = lines[0].split(" ")
+    if len(request) != 3 or not request[1].startswith("/") or request[2] not in ("HTTP/1.0", "HTTP/1.1"):
+        raise RequestError(400, "malformed request line")
+    method, path, version = request
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, separator, value = line.partition(":")
+        if not separator or not name.strip() or name != name.strip():
+            raise RequestError(400, "malformed header")
+        headers[name.lower()] = value.strip()
+    if "transfer-encoding" in headers:
+        raise RequestError(400, "chunked request bodies are not supported")
+    length = headers.get("content-length", "0")
+    if not length.isdigit():
+        raise RequestError(400, "invalid content-length")
+    if int(length) > MAX_REQUEST_BYTES:
+        raise RequestError(413, "request body too large")
+    return method, path, version, headers, int(length)
+
+
+def year_parameter(parameters, name):
+    value = parameters.get(name, [None])[-1]
+    if value in (None, ""):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a year, got {value}")
+
+
+class QueryService:
+    # GET /query?from=1700&to=1800&unknown=1&mode=born|alive&profession=...&religions=...&institutions=...
+    #     &worked_in=...&locations=...&limit=...  (facet parameters repeat for several values)
+    # GET /person/<id>, GET /facets, GET /health, GET /metrics
+    def __init__(self, index):
+        self.index = index
+
+    def handle(self, path):
+        url = urlsplit(path)
+        parameters = parse_qs(url.query)
+        if url.path == "/query":
+            mode = parameters.get("mode", ["born"])[-1]
+            if mode not in MODES:
+                raise ValueError(f"mode must be one of {', '.join(MODES)}")
+            limit = parameters.get("limit", [None])[-1]
+            matched = self.index.query(
+                year_parameter(parameters, "from"),
+                year_parameter(parameters, "to"),
+                parameters.get("unknown", [""])[-1].lower() in ("1", "true", "yes"),
+                mode,
+                {name: parameters[name] for name in FACETS if name in parameters},
+                int(limit) if limit else None,
+            )
+            return 200, "application/json", self.index.graph(matched)
+        if url.path.startswith("/person/"):
+            position = self.index.positions.get(unquote(url.path[len("/person/") :]))
+            if position is None:
+                return 404, "application/json", dumps({"error": "unknown person"})
+            return 200, "application/json", dumps(self.index.documents[position])
+        if url.path == "/facets":
+            return 200, "application/json", dumps(self.index.facet_counts())
+        if url.path == "/health":
+            return 200, "application/json", dumps({"people": len(self.index.ids)})
+        if url.path == "/metrics":
+            return 200, "text/plain; version=0.0.4", metrics.prometheus().encode("utf-8")
+        return 404, "application/json", dumps({"error": "not found"})
+
+    def respond(self, method, path):
+        if method not in ("GET", "HEAD"):
+            return 405, "application/json", dumps({"error": "only GET is supported"})
+        try:
+            return self.handle(path)
+        except ValueError as ex:
+            # Also malformed percent-encoding or UTF-8 (UnicodeDecodeError is a ValueError)
+            return 400, "application/json", dumps({"error": str(ex)})
+        except Exception as ex:
+            print(f"Error handling {path}: {ex}")
+            return 500, "application/json", dumps({"error": "internal error"})
+
+    def write_response(self, writer, status, content_type, body, keep_alive, head_only=False):
+        writer.write(
+            (
+                f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Access-Control-Allow-Origin: {ALLOW_ORIGIN}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+            ).encode("latin-1")
+            + (body if not head_only else b"")
+        )
+
+    async def read_request(self, reader):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT_SECONDS)
+        except (asyncio.LimitOverrunError, ValueError):
+            # readuntil reports an oversized head as LimitOverrunError, or as ValueError once the buffer is full
+            raise RequestError(431, "request head too large")
+        method, path, version, headers, length = parse_request(head)
+        # Bodies are read to keep the connection framed, but no route takes one
+        await asyncio.wait_for(reader.readexactly(length), IDLE_TIMEOUT_SECONDS)
+        return method, path, version, headers
+
+    async def connection(self, reader, writer):
+        # HTTP/1.1 with keep-alive; requests are answered in order, one at a time per connection
+        try:
+            while True:
+                try:
+                    method, path, version, headers = await self.read_request(reader)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                except RequestError as error:
+                    self.write_response(writer, error.status, "application/json", dumps({"error": str(error)}), False)
+                    await writer.drain()
+                    metrics.increment("service_requests", route="invalid", status=error.status)
+                    break
+                start = time.perf_counter()
+                status, content_type, body = self.respond(method, path)
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                self.write_response(writer, status, content_type, body, keep_alive, method == "HEAD")
+                await writer.drain()
+                route = urlsplit(path).path.split("/")[1] or "root"
+                metrics.observe("service_request_seconds", time.perf_counter() - start, route=route)
+                metrics.increment("service_requests", route=route, status=status)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=HOST, port=PORT, ready=None):
+        server = await asyncio.start_server(self.connection, host, port, limit=MAX_REQUEST_BYTES)
+        print(f"Serving {len(self.index.ids)} people on http://{host}:{server.sockets[0].getsockname()[1]}")
+        if ready is not None:
+            ready(server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+
+
+def run_service(host=HOST, port=PORT, ready=None):
+    start = time.perf_counter()
+    index = load_index()
+    print(f"Loaded {len(index.ids)} people in {time.perf_counter() - start:.2f}s")
+    asyncio.run(QueryService(index).serve(host, port, ready))
+
+
+if __name__ == "__main__":
+    try:
+        run_service()
+    except KeyboardInterrupt:
+        pass
@@ -1,119 +1,250 @@
 import os
 import json
 import sys
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
 from google.api_core.exceptions import ResourceExhausted
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import firestore as cloud_firestore
 from tqdm import tqdm
 
+from utils.metrics import metrics, write_metrics
+from utils.ratelimit import AdaptiveRate
+from utils.store import content_hash, open_store
 from utils.workers import get_worker_count
 
-MD_DIR = os.path.join(os.path.dirname(__file__), "..", "store/md")
-L1_DIR = os.path.join(os.path.dirname(__file__), "..", "store/json/l1")
-L2_DIR = os.path.join(os.path.dirname(__file__), "..", "store/json/l2")
-
-WORKERS = get_worker_count()
-os.environ.get("WORKER_COUNT", WORKERS)
-
-cred = credentials.Certificate(os.path.join(os.path.dirname(__file__), "..", "gcloud-sa.json"))
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+MANIFEST_PATH = os.path.join(os.path.dirname(__file__), "..", "store/upload-manifest.json")
 
+COLLECTIONS = ("md", "l1", "l2")
 
-def upload_md_file(filename):
+WORKERS = get_worker_count()
+BATCH_SIZE = 500
+# Firestore also caps a commit request at 10 MiB; batches are closed below that, leaving room for request overhead
+MAX_BATCH_BYTES = 9 * 1024 * 1024
+WRITE_OVERHEAD_BYTES = 256
+FORCE_RUN = os.environ.get("FORCE_RUN", "").lower() in ("1", "true", "yes")
+RECONCILE = os.environ.get("UPLOAD_RECONCILE", "").lower() in ("1", "true", "yes")
+WRITES_PER_SECOND = int(os.environ.get("UPLOAD_WRITES_PER_SECOND", 500))
+MAX_RETRIES = int(os.environ.get("UPLOAD_MAX_RETRIES", 6))
+BACKOFF_SECONDS = 2
+
+
+def create_client():
+    # FIRESTORE_EMULATOR_HOST points the client at a local emulator, which needs no service account
+    if os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        project = os.environ.get("FIREBASE_PROJECT_ID", "demo-mactutorindex")
+        return cloud_firestore.Client(project=project, credentials=AnonymousCredentials())
+    cred = credentials.Certificate(os.path.join(os.path.dirname(__file__), "..", "gcloud-sa.json"))
+    firebase_admin.initialize_app(cred)
+    return firestore.client()
+
+
+db = create_client()
+store = open_store()
+write_rate = AdaptiveRate(WRITES_PER_SECOND, max_per_second=WRITES_PER_SECOND * 10)
+quota_exhausted = threading.Event()
+
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest):
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    tmp_path = f"{MANIFEST_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(manifest, indent=4, ensure_ascii=False, sort_keys=True))
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def local_hashes(collection):
+    return store.hashes(collection)
+
+
+def to_document(collection, content):
+    return {"md": content} if collection == "md" else json.loads(content)
+
+
+def read_document(collection, doc_id):
+    return to_document(collection, store.get(collection, doc_id))
+
+
+def plan_changes(collection, uploaded):
+    hashes = local_hashes(collection)
+    changed = [doc_id for doc_id, content_hash in hashes.items() if FORCE_RUN or uploaded.get(doc_id) != content_hash]
+    deleted = [doc_id for doc_id in uploaded if doc_id not in hashes]
+    if RECONCILE:
+        # Also catch documents uploaded before the manifest existed or by another machine
+        remote = {ref.id for ref in db.collection(collection).list_documents()}
+        deleted += sorted(remote - set(hashes) - set(deleted))
+    return hashes, changed, deleted
+
+
+def plan_batches(collection, writes, sizes):
+    # Consecutive writes grouped up to BATCH_SIZE writes or MAX_BATCH_BYTES of documents, whichever comes first
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for doc_id, upsert in writes:
+        size = len(collection) + len(doc_id.encode("utf-8")) + WRITE_OVERHEAD_BYTES
+        size += sizes.get(doc_id, 0) if upsert else 0
+        if batch and (len(batch) == BATCH_SIZE or batch_bytes + size > MAX_BATCH_BYTES):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append((doc_id, upsert))
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def commit_batch(collection, writes):
+    # Quota errors halve the write rate and back off exponentially; once retries run out the quota is treated as
+    # exhausted for this session and the remaining batches are skipped
+    if quota_exhausted.is_set():
+        return "skipped", writes, None
     try:
-        file_path = os.path.join(MD_DIR, filename)
-        with open(file_path, "r", encoding="utf-8") as f:
-            content = f.read()
-
-        doc_id = filename.replace(".md", "")
-        try:
-            db.collection("md").document(doc_id).set({"md": content})
-            return True, filename, None
-        except ResourceExhausted as e:
-            print(f"\n\nFIREBASE RATE LIMIT EXCEEDED: {str(e)}")
-            print("Exiting program immediately to respect Firebase quotas.")
-            sys.exit(1)
+        batch = db.batch()
+        contents = store.get_many(collection, [doc_id for doc_id, upsert in writes if upsert])
+        for doc_id, upsert in writes:
+            ref = db.collection(collection).document(doc_id)
+            if upsert:
+                batch.set(ref, to_document(collection, contents[doc_id]))
+            else:
+                batch.delete(ref)
+        for attempt in range(MAX_RETRIES + 1):
+            with metrics.span("firestore_rate_wait_seconds", collection=collection):
+                write_rate.acquire(len(writes))
+            try:
+                with metrics.span("firestore_commit_seconds", collection=collection):
+                    batch.commit()
+                write_rate.succeeded()
+                metrics.gauge("firestore_write_rate", write_rate.rate)
+                metrics.increment("firestore_writes", len(contents), collection=collection, operation="set")
+                metrics.increment(
+                    "firestore_writes", len(writes) - len(contents), collection=collection, operation="delete"
+                )
+                metrics.increment(
+                    "firestore_bytes_written",
+                    sum(len(content.encode("utf-8")) for content in contents.values()),
+                    collection=collection,
+                )
+                return "committed", writes, None
+            except ResourceExhausted as e:
+                write_rate.throttle()
+                metrics.increment("firestore_throttled", collection=collection)
+                metrics.gauge("firestore_write_rate", write_rate.rate)
+                if attempt == MAX_RETRIES or quota_exhausted.is_set():
+                    quota_exhausted.set()
+                    return "skipped", writes, str(e)
+                wait_time = BACKOFF_SECONDS * 2**attempt
+                print(f"\nFirestore quota exceeded, retrying in {wait_time}s at {write_rate.rate:.0f} writes/s")
+                metrics.increment("firestore_retries", collection=collection)
+                metrics.increment("firestore_backoff_seconds", wait_time, collection=collection)
+                time.sleep(wait_time)
     except Exception as e:
-        return False, filename, str(e)
+        metrics.increment("firestore_failed_writes", len(writes), collection=collection)
+        return "failed", writes, str(e)
 
 
-def upload_json_file(filename, collection):
-    try:
-        if collection == "l1":
-            file_path = os.path.join(L1_DIR, filename)
-        else:
-            file_path = os.path.join(L2_DIR, filename)
-
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-        doc_id = filename.replace(".json", "")
-        try:
-            db.collection(collection).document(doc_id).set(data)
-            return True, filename, None
-        except ResourceExhausted as e:
-            print(f"\n\nFIREBASE RATE LIMIT EXCEEDED: {str(e)}")
-            print("Exiting program immediately to respect Firebase quotas.")
-            sys.exit(1)
-    except Exception as e:
-        return False, filename, str(e)
+def sync_collection(collection):
+    # Every call starts a new upload session: a quota exhausted by an earlier call in the same process may have reset
+    quota_exhausted.clear()
+    manifest = load_manifest()
+    uploaded = manifest.setdefault(collection, {})
+    hashes, changed, deleted = plan_changes(collection, uploaded)
+    print(
+        f"Collection {collection}: {len(changed)} new or changed, {len(deleted)} deleted, "
+        f"{len(hashes) - len(changed)} unchanged"
+    )
 
+    writes = [(doc_id, True) for doc_id in changed] + [(doc_id, False) for doc_id in deleted]
+    batches = plan_batches(collection, writes, store.sizes(collection))
 
-def parallel_upload(files, upload_func, desc, collection=None):
     success_count = 0
     error_count = 0
+    skipped_count = 0
+    throttled_before = write_rate.throttled
+    start = time.perf_counter()
 
     with ThreadPoolExecutor(max_workers=WORKERS) as executor:
-        with tqdm(total=len(files), desc=desc) as pbar:
-            futures = []
-
-            for filename in files:
-                if collection:
-                    future = executor.submit(upload_func, filename, collection)
+        with tqdm(total=len(writes), desc=f"Uploading {collection}") as pbar:
+            for status, batch_writes, error in executor.map(partial(commit_batch, collection), batches):
+                if status == "committed":
+                    # The manifest doubles as the checkpoint: it only ever records confirmed writes
+                    success_count += len(batch_writes)
+                    for doc_id, upsert in batch_writes:
+                        if upsert:
+                            uploaded[doc_id] = hashes[doc_id]
+                        else:
+                            uploaded.pop(doc_id, None)
+                    save_manifest(manifest)
+                elif status == "skipped":
+                    skipped_count += len(batch_writes)
                 else:
-                    future = executor.submit(upload_func, filename)
-                futures.append((future, filename))
-
-            for future, filename in futures:
-                try:
-                    success, file, error = future.result()
-                    if success:
-                        success_count += 1
-                    else:
-                        error_count += 1
-                        print(f"\nError processing {file}: {error}")
-                except Exception as exc:
-                    error_count += 1
-                    print(f"\nException processing {filename}: {exc}")
-
-                pbar.update(1)
-
-    print(f"Completed: {success_count} succeeded, {error_count} failed")
+                    error_count += len(batch_writes)
+                    print(f"\nError committing {len(batch_writes)} {collection} documents: {error}")
+                pbar.update(len(batch_writes))
+
+    elapsed = time.perf_counter() - start
+    throughput = success_count / elapsed if elapsed else 0
+    print(
+        f"Completed: {success_count} written in {elapsed:.1f}s ({throughput:.0f} writes/s), "
+        f"{error_count} failed, throttled {write_rate.throttled - throttled_before} times, "
+        f"write rate now {write_rate.rate:.0f}/s"
+    )
+    if skipped_count:
+        print(f"Firestore quota exhausted: {skipped_count} {collection} writes left for the next run")
     return success_count, error_count
 
 
+def upload_documents(collection, doc_ids):
+    # Upserts the given documents when they differ from the manifest, for callers that already know what changed. Like
+    # sync_collection, every call starts a new upload session
+    quota_exhausted.clear()
+    manifest = load_manifest()
+    uploaded = manifest.setdefault(collection, {})
+    contents = store.get_many(collection, doc_ids)
+    hashes = {doc_id: content_hash(content) for doc_id, content in contents.items()}
+    writes = [(doc_id, True) for doc_id, digest in hashes.items() if FORCE_RUN or uploaded.get(doc_id) != digest]
+    sizes = {doc_id: len(content.encode("utf-8")) for doc_id, content in contents.items()}
+    for batch in plan_batches(collection, writes, sizes):
+        status, batch_writes, error = commit_batch(collection, batch)
+        if status != "committed":
+            raise Exception(error or "Firestore quota exhausted")
+        for doc_id, _ in batch_writes:
+            uploaded[doc_id] = hashes[doc_id]
+        save_manifest(manifest)
+    return len(writes)
+
+
 def upload_l2():
-    l2_files = [f for f in os.listdir(L2_DIR) if f.endswith(".json")]
-    print(f"Found {len(l2_files)} L2 JSON files to upload")
-    parallel_upload(l2_files, upload_json_file, "Uploading L2 JSON files", "l2")
+    return sync_collection("l2")
 
 
 def upload_l1():
-    l1_files = [f for f in os.listdir(L1_DIR) if f.endswith(".json")]
-    print(f"Found {len(l1_files)} L1 JSON files to upload")
-    parallel_upload(l1_files, upload_json_file, "Uploading L1 JSON files", "l1")
+    return sync_collection("l1")
 
 
 def upload_md():
-    md_files = [f for f in os.listdir(MD_DIR) if f.endswith(".md")]
-    print(f"Found {len(md_files)} markdown files to upload")
-    parallel_upload(md_files, upload_md_file, "Uploading markdown files")
+    return sync_collection("md")
 
 
 if __name__ == "__main__":
-    upload_md()
-    upload_l1()
-    upload_l2()
+    for upload in (upload_md, upload_l1, upload_l2):
+        upload()
+        if quota_exhausted.is_set():
+            write_metrics("upload")
+            print("Stopping, run the uploader again once the quota resets to resume")
+            sys.exit(1)
+    write_metrics("upload")
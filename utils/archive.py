@@ -0,0 +1,142 @@
+import gzip
+import hashlib
+import os
+import sqlite3
+import time
+import uuid
+
+# A segment is closed and a new one started once it grows past this many bytes
+SEGMENT_BYTES = int(os.environ.get("ARCHIVE_SEGMENT_BYTES", 256 * 1024 * 1024))
+COMPRESS_LEVEL = 6
+# Headers describing the transfer rather than the stored body, which is kept decoded
+TRANSFER_HEADERS = ("content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive")
+
+
+def payload_digest(body):
+    return "sha256:" + hashlib.sha256(body).hexdigest()
+
+
+def http_block(status, headers, body):
+    lines = [f"HTTP/1.1 {status}"]
+    lines.extend(f"{name}: {value}" for name, value in headers.items() if name.lower() not in TRANSFER_HEADERS)
+    lines.append(f"Content-Length: {len(body)}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8") + body
+
+
+def warc_record(url, status, headers, body, digest):
+    block = http_block(status, headers, body)
+    head = (
+        "WARC/1.1\r\n"
+        "WARC-Type: response\r\n"
+        f"WARC-Record-ID: <urn:uuid:{uuid.uuid4()}>\r\n"
+        f"WARC-Date: {time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}\r\n"
+        f"WARC-Target-URI: {url}\r\n"
+        f"WARC-Payload-Digest: {digest}\r\n"
+        "Content-Type: application/http; msgtype=response\r\n"
+        f"Content-Length: {len(block)}\r\n\r\n"
+    )
+    return head.encode("utf-8") + block + b"\r\n\r\n"
+
+
+def parse_record(data):
+    # (url, status, headers, body) of one decompressed record
+    warc_head, _, rest = data.partition(b"\r\n\r\n")
+    warc_headers = dict(line.split(": ", 1) for line in warc_head.decode("utf-8").split("\r\n")[1:])
+    block = rest[: int(warc_headers["Content-Length"])]
+    http_head, _, body = block.partition(b"\r\n\r\n")
+    lines = http_head.decode("utf-8").split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(": ")
+        headers[name.lower()] = value
+    return warc_headers["WARC-Target-URI"], int(lines[0].split(" ")[1]), headers, body
+
+
+class Archive:
+    # Raw responses as WARC response records in append-only segment files, one gzip member per record so any record
+    # can be read on its own from its offset; index.sqlite holds the offsets. A response whose body is unchanged since
+    # the last record for its URL is not stored again
+    def __init__(self, directory):
+        self.directory = directory
+        self.connection = None
+        self.segment = None
+        self.file = None
+        self.pid = None
+
+    def connect(self):
+        if self.connection is None or self.pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            self.connection = sqlite3.connect(os.path.join(self.directory, "index.sqlite"), isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY, url TEXT NOT NULL, kind TEXT NOT NULL, "
+                "status INTEGER NOT NULL, digest TEXT NOT NULL, segment TEXT NOT NULL, offset INTEGER NOT NULL, "
+                "length INTEGER NOT NULL, archived REAL NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS records_url ON records (url, id)")
+            self.pid = os.getpid()
+            self.file = None
+        return self.connection
+
+    def segment_file(self, size):
+        # The last segment, or a new one when it would grow past SEGMENT_BYTES
+        if self.file is None:
+            row = self.connect().execute("SELECT segment FROM records ORDER BY id DESC LIMIT 1").fetchone()
+            self.segment = row[0] if row else "crawl-00000.warc.gz"
+            self.file = open(os.path.join(self.directory, self.segment), "ab")
+        if self.file.tell() and self.file.tell() + size > SEGMENT_BYTES:
+            self.file.close()
+            number = int(self.segment[len("crawl-") : -len(".warc.gz")]) + 1
+            self.segment = f"crawl-{number:05d}.warc.gz"
+            self.file = open(os.path.join(self.directory, self.segment), "ab")
+        return self.file
+
+    def latest_digest(self, url):
+        row = self.connect().execute("SELECT digest FROM records WHERE url = ? ORDER BY id DESC LIMIT 1", (url,))
+        row = row.fetchone()
+        return row[0] if row else None
+
+    def append(self, url, status, headers, body, kind):
+        digest = payload_digest(body)
+        if self.latest_digest(url) == digest:
+            return 0
+        data = gzip.compress(warc_record(url, status, headers, body, digest), compresslevel=COMPRESS_LEVEL)
+        file = self.segment_file(len(data))
+        offset = file.tell()
+        file.write(data)
+        # The bytes are in the segment before the index points at them; a crash in between leaves an unreferenced record
+        file.flush()
+        self.connect().execute(
+            "INSERT INTO records (url, kind, status, digest, segment, offset, length, archived) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (url, kind, status, digest, self.segment, offset, len(data), time.time()),
+        )
+        return len(data)
+
+    def read(self, segment, offset, length):
+        with open(os.path.join(self.directory, segment), "rb") as f:
+            f.seek(offset)
+            return parse_record(gzip.decompress(f.read(length)))
+
+    def latest(self, kind=None):
+        # The newest record of every URL as (url, segment, offset, length), in file order for sequential reads
+        query = (
+            "SELECT url, segment, offset, length FROM records WHERE id IN (SELECT MAX(id) FROM records "
+            + ("WHERE kind = ? " if kind else "")
+            + "GROUP BY url) ORDER BY segment, offset"
+        )
+        return self.connect().execute(query, (kind,) if kind else ()).fetchall()
+
+    def stats(self):
+        count, urls, size = (
+            self.connect()
+            .execute("SELECT COUNT(*), COUNT(DISTINCT url), COALESCE(SUM(length), 0) FROM records")
+            .fetchone()
+        )
+        return {"records": count, "urls": urls, "bytes": size}
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,100 @@
+import io
+import json
+
+import requests
+
+from utils.llm import (
+    ANTHROPIC_BASE_URL,
+    OPENAI_INSTRUCTIONS,
+    anthropic_headers,
+    anthropic_request,
+    anthropic_response_text,
+    llm_provider,
+    openai_client,
+    openai_request,
+    openai_response_text,
+)
+
+OPENAI_ENDPOINT = "/v1/chat/completions"
+
+
+def batch_request(custom_id, text, prompt, max_tokens=None, temperature=0):
+    if llm_provider() == "openai":
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": OPENAI_ENDPOINT,
+            "body": openai_request(prompt, text, OPENAI_INSTRUCTIONS, max_tokens, temperature),
+        }
+    return {"custom_id": custom_id, "params": anthropic_request(text, prompt, max_tokens, temperature)}
+
+
+def submit_batch(batch_requests):
+    if llm_provider() == "openai":
+        payload = "".join(json.dumps(request, ensure_ascii=False) + "\n" for request in batch_requests)
+        input_file = openai_client.files.create(
+            file=("batch.jsonl", io.BytesIO(payload.encode("utf-8"))),
+            purpose="batch",
+        )
+        batch = openai_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=OPENAI_ENDPOINT,
+            completion_window="24h",
+        )
+        return batch.id
+
+    response = requests.post(
+        f"{ANTHROPIC_BASE_URL}/v1/messages/batches",
+        headers=anthropic_headers(),
+        json={"requests": batch_requests},
+    )
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+def batch_status(batch_id):
+    if llm_provider() == "openai":
+        status = openai_client.batches.retrieve(batch_id).status
+        if status in ("completed", "expired", "cancelled"):
+            return "ended"
+        if status == "failed":
+            return "failed"
+        return "in_progress"
+
+    response = requests.get(f"{ANTHROPIC_BASE_URL}/v1/messages/batches/{batch_id}", headers=anthropic_headers())
+    response.raise_for_status()
+    return "ended" if response.json()["processing_status"] == "ended" else "in_progress"
+
+
+def iter_jsonl(lines):
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+def batch_results(batch_id):
+    if llm_provider() == "openai":
+        batch = openai_client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for result in iter_jsonl(openai_client.files.content(file_id).text.splitlines()):
+                response = result.get("response") or {}
+                choices = (response.get("body") or {}).get("choices") or []
+                if response.get("status_code") == 200 and len(choices) == 1 and choices[0]["finish_reason"] == "stop":
+                    yield result["custom_id"], openai_response_text(choices[0]["message"]["content"])
+                else:
+                    yield result["custom_id"], None
+        return
+
+    response = requests.get(f"{ANTHROPIC_BASE_URL}/v1/messages/batches/{batch_id}", headers=anthropic_headers())
+    response.raise_for_status()
+    results = requests.get(response.json()["results_url"], headers=anthropic_headers(), stream=True)
+    results.raise_for_status()
+    results.encoding = "utf-8"
+    for result in iter_jsonl(results.iter_lines(decode_unicode=True)):
+        outcome = result["result"]
+        if outcome["type"] == "succeeded" and outcome["message"].get("stop_reason") != "max_tokens":
+            yield result["custom_id"], anthropic_response_text(outcome["message"])
+        else:
+            yield result["custom_id"], None
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+EVICT_CHUNK = 64
+
+
+def cache_key(*parts):
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path, max_bytes, bypass=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        # Worker processes must not share a connection opened before the fork
+        if self.connection is None or self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            # The total size is kept up to date by triggers, so a write checks it without summing the table. Caches
+            # created before the triggers get their total computed once
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses BEGIN "
+                "INSERT INTO stats (name, value) VALUES ('bytes', NEW.size) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + NEW.size; END"
+            )
+            self.connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses BEGIN "
+                "UPDATE stats SET value = value + NEW.size - OLD.size WHERE name = 'bytes'; END"
+            )
+            self.connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses BEGIN "
+                "UPDATE stats SET value = value - OLD.size WHERE name = 'bytes'; END"
+            )
+            self.connection.execute(
+                "INSERT OR IGNORE INTO stats (name, value) SELECT 'bytes', COALESCE(SUM(size), 0) FROM responses"
+            )
+            self.connection.execute("COMMIT")
+            self.pid = os.getpid()
+        return self.connection
+
+    def total_bytes(self):
+        return self.connect().execute("SELECT value FROM stats WHERE name = 'bytes'").fetchone()[0]
+
+    def count(self, name):
+        self.connect().execute(
+            "INSERT INTO stats (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def get(self, key):
+        if self.bypass:
+            return None
+        connection = self.connect()
+        row = connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.count("misses")
+            return None
+        connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.count("hits")
+        return row[0]
+
+    def set(self, key, response):
+        if not response:
+            return
+        connection = self.connect()
+        size = len(response.encode("utf-8"))
+        connection.execute(
+            "INSERT INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET response = excluded.response, size = excluded.size, "
+            "last_used = excluded.last_used",
+            (key, response, size, time.time()),
+        )
+        self.evict()
+
+    def evict(self):
+        connection = self.connect()
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        # The oldest entries are read through the last_used index a chunk at a time, so a write at the cap stays cheap
+        evicted = 0
+        while total > self.max_bytes:
+            rows = connection.execute(
+                "SELECT key, size FROM responses ORDER BY last_used LIMIT ?", (EVICT_CHUNK,)
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total -= size
+                evicted += 1
+        connection.execute(
+            "INSERT INTO stats (name, value) VALUES ('evictions', ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (evicted,),
+        )
+
+    def stats(self):
+        connection = self.connect()
+        stats = {"hits": 0, "misses": 0, "evictions": 0}
+        stats.update(connection.execute("SELECT name, value FROM stats").fetchall())
+        stats["entries"] = connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return stats
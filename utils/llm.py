@@ -1,14 +1,50 @@
+import asyncio
 import json
 import os
 import requests
 import time
-from openai import OpenAI
+from collections import Counter
+
+import httpx
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, OpenAI, RateLimitError
+
+from utils.cache import ResponseCache, cache_key
+from utils.metrics import metrics
+from utils.ratelimit import AdaptiveLimiter
+from utils.tokens import count_tokens
 
 ANTHROPIC_API_VERSION = "2023-06-01"
+ANTHROPIC_BASE_URL = os.environ.get("ANTHROPIC_BASE_URL", "https://api.anthropic.com")
 ANTHROPIC_MODEL = "claude-3-7-sonnet-20250219"
 OPENAI_MODEL = "gpt-4o-mini"
 DEFAULT_WAIT_SECONDS = 3
+# Server errors and dropped connections back off like the SDKs' own retries: from half a second, at most eight
+TRANSIENT_WAIT_SECONDS = 0.5
+MAX_TRANSIENT_WAIT_SECONDS = 8
 MAX_RETRIES = 5
+MAX_OUTPUT_TOKENS = 8192
+# Responses retried with backoff rather than failing the request: rate limits, overload and server errors
+RATE_LIMIT_STATUSES = (429, 529)
+SERVER_ERROR_STATUSES = (500, 502, 503, 504)
+RETRY_MESSAGES = {
+    "rate_limit": "rate limit reached",
+    "server_error": "server error",
+    "connection": "connection failed",
+}
+
+ANTHROPIC_SYSTEM_PROMPT = "Extract data in JSON format. Return ONLY valid JSON without explanations or markdown."
+OPENAI_INSTRUCTIONS = "Extract exactly the data requested in the specified JSON format. Return ONLY valid JSON."
+
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", 32))
+LLM_RPM = int(os.environ.get("LLM_RPM", 500))
+LLM_TPM = int(os.environ.get("LLM_TPM", 200000))
+REQUEST_TIMEOUT = 600
+
+LLM_CACHE_PATH = os.environ.get(
+    "LLM_CACHE_PATH", os.path.join(os.path.dirname(__file__), "..", "store/cache/llm-responses.sqlite")
+)
+LLM_CACHE_MAX_MB = int(os.environ.get("LLM_CACHE_MAX_MB", 512))
+LLM_CACHE_BYPASS = os.environ.get("LLM_CACHE_BYPASS", "").lower() in ("1", "true", "yes")
 
 anthropic_api_key = os.environ.get("ANTHROPIC_API_KEY")
 openai_api_key = os.environ.get("OPENAI_API_KEY")
@@ -18,43 +54,103 @@ if not anthropic_api_key and not openai_api_key:
 
 openai_client = OpenAI() if openai_api_key else None
 
+response_cache = ResponseCache(LLM_CACHE_PATH, LLM_CACHE_MAX_MB * 1024 * 1024, bypass=LLM_CACHE_BYPASS)
+
+
+def llm_provider():
+    return "openai" if openai_api_key else "anthropic"
+
+
+def anthropic_headers():
+    return {
+        "Content-Type": "application/json",
+        "x-api-key": anthropic_api_key,
+        "anthropic-version": ANTHROPIC_API_VERSION,
+    }
+
+
+def anthropic_request(text, prompt, max_tokens=None, temperature=0):
+    return {
+        "model": ANTHROPIC_MODEL,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "messages": [{"role": "user", "content": f"{text}\n\n{prompt}"}],
+        "system": ANTHROPIC_SYSTEM_PROMPT,
+    }
+
+
+def anthropic_response_text(response_json):
+    full_response = ""
+    for content_block in response_json["content"]:
+        if content_block["type"] == "text":
+            full_response += content_block["text"]
+
+    json_content = full_response.strip()
+    if "```json" in json_content:
+        json_content = json_content.split("```json")[1].split("```")[0].strip()
+    elif "```" in json_content:
+        json_content = json_content.split("```")[1].split("```")[0].strip()
+    return json_content
+
+
+def openai_request(question, text, instructions, max_tokens=None, creativity=0):
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [
+            {"role": "user", "content": question},
+            {"role": "user", "content": text},
+            {"role": "system", "content": instructions},
+        ],
+        "max_tokens": max_tokens,
+        "temperature": creativity,
+    }
+
+
+def openai_response_text(content):
+    return content.lstrip("```json").rstrip("```").strip()
+
+
+def anthropic_cache_key(text, prompt, max_tokens, temperature):
+    return cache_key("anthropic", ANTHROPIC_MODEL, prompt, text, max_tokens, temperature)
+
+
+def openai_cache_key(question, text, instructions, max_tokens, creativity):
+    return cache_key("openai", OPENAI_MODEL, [question, instructions], text, max_tokens, creativity)
+
+
+def query_cache_key(text, prompt, max_tokens=None, temperature=0):
+    if openai_api_key:
+        return openai_cache_key(prompt, text, OPENAI_INSTRUCTIONS, max_tokens, temperature)
+    return anthropic_cache_key(text, prompt, max_tokens, temperature)
+
 
 def anthropic_query(text, prompt, max_tokens=None, temperature=0, max_retries=MAX_RETRIES):
+    key = anthropic_cache_key(text, prompt, max_tokens, temperature)
+    cached = response_cache.get(key)
+    metrics.increment("llm_cache", result="miss" if cached is None else "hit")
+    if cached is not None:
+        return cached
+
     retries = 0
     while retries <= max_retries:
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "x-api-key": anthropic_api_key,
-                "anthropic-version": ANTHROPIC_API_VERSION,
-            }
-
-            combined_message = f"{text}\n\n{prompt}"
-
-            data = {
-                "model": ANTHROPIC_MODEL,
-                "max_tokens": max_tokens,
-                "temperature": temperature,
-                "messages": [{"role": "user", "content": combined_message}],
-                "system": "Extract data in JSON format. Return ONLY valid JSON without explanations or markdown.",
-            }
-
-            response = requests.post("https://api.anthropic.com/v1/messages", headers=headers, json=data)
+            with metrics.span("llm_request_seconds", provider="anthropic"):
+                response = requests.post(
+                    f"{ANTHROPIC_BASE_URL}/v1/messages",
+                    headers=anthropic_headers(),
+                    json=anthropic_request(text, prompt, max_tokens, temperature),
+                )
             response.raise_for_status()
             response_json = response.json()
 
             if response_json and "content" in response_json:
-                full_response = ""
-                for content_block in response_json["content"]:
-                    if content_block["type"] == "text":
-                        full_response += content_block["text"]
-
-                json_content = full_response.strip()
-                if "```json" in json_content:
-                    json_content = json_content.split("```json")[1].split("```")[0].strip()
-                elif "```" in json_content:
-                    json_content = json_content.split("```")[1].split("```")[0].strip()
-
+                usage = response_json.get("usage") or {}
+                for direction in ("input", "output"):
+                    amount = usage.get(f"{direction}_tokens", 0)
+                    metrics.increment("llm_tokens", amount, provider="anthropic", direction=direction)
+                json_content = anthropic_response_text(response_json)
+                if response_json.get("stop_reason") != "max_tokens":
+                    response_cache.set(key, json_content)
                 return json_content
 
             print(f"\n!!! Unexpected response format from Anthropic API: {response_json}")
@@ -72,6 +168,8 @@ def anthropic_query(text, prompt, max_tokens=None, temperature=0, max_retries=MA
                     wait_time = max(DEFAULT_WAIT_SECONDS, int(retry_after) + 1)
 
                 print(f"\nAnthropic rate limit reached. Retrying in {wait_time:.2f}s... ({retries}/{max_retries})")
+                metrics.increment("llm_retries", reason="rate_limit")
+                metrics.increment("llm_backoff_seconds", wait_time)
                 time.sleep(wait_time)
             else:
                 print(f"\n!!! HTTP error from Anthropic API: {e}")
@@ -86,24 +184,30 @@ def anthropic_query(text, prompt, max_tokens=None, temperature=0, max_retries=MA
 
 
 def openai_query(question, text, instructions, max_tokens=None, creativity=0, max_retries=MAX_RETRIES):
+    key = openai_cache_key(question, text, instructions, max_tokens, creativity)
+    cached = response_cache.get(key)
+    metrics.increment("llm_cache", result="miss" if cached is None else "hit")
+    if cached is not None:
+        return cached
+
     retries = 0
     while retries <= max_retries:
         try:
-            response = openai_client.chat.completions.create(
-                model=OPENAI_MODEL,
-                messages=[
-                    {"role": "user", "content": question},
-                    {"role": "user", "content": text},
-                    {"role": "system", "content": instructions},
-                ],
-                max_tokens=max_tokens,
-                temperature=creativity,
-            )
+            with metrics.span("llm_request_seconds", provider="openai"):
+                response = openai_client.chat.completions.create(
+                    **openai_request(question, text, instructions, max_tokens, creativity)
+                )
+            if response.usage:
+                metrics.increment("llm_tokens", response.usage.prompt_tokens, provider="openai", direction="input")
+                metrics.increment("llm_tokens", response.usage.completion_tokens, provider="openai", direction="output")
             if len(response.choices) != 1:
                 print("\n!!! Unexpected response from OpenAI", response)
+            content = openai_response_text(response.choices[0].message.content)
             if response.choices[0].finish_reason != "stop":
                 print("\n!!! OpenAI did not finish processing the request", response)
-            return response.choices[0].message.content.lstrip("```json").rstrip("```").strip()
+            else:
+                response_cache.set(key, content)
+            return content
         except Exception as e:
             error_str = str(e)
             if "rate_limit_exceeded" in error_str:
@@ -119,6 +223,8 @@ def openai_query(question, text, instructions, max_tokens=None, creativity=0, ma
                     pass
 
                 print(f"\n!!! OpenAI rate limit reached. Retrying in {wait_time:.2f}s... ({retries}/{max_retries})")
+                metrics.increment("llm_retries", reason="rate_limit")
+                metrics.increment("llm_backoff_seconds", wait_time)
                 time.sleep(wait_time)
             else:
                 print(f"\n!!! Error querying OpenAI: {e}")
@@ -128,6 +234,171 @@ def openai_query(question, text, instructions, max_tokens=None, creativity=0, ma
     return None
 
 
+def retry_after_seconds(headers, attempt, reason="rate_limit"):
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return max(float(retry_after_ms) / 1000, 0.1)
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.1)
+        except ValueError:
+            pass
+    if reason != "rate_limit":
+        return min(TRANSIENT_WAIT_SECONDS * 2**attempt, MAX_TRANSIENT_WAIT_SECONDS)
+    return DEFAULT_WAIT_SECONDS * 2**attempt
+
+
+def estimate_tokens(text, prompt, max_tokens):
+    return count_tokens(text) + count_tokens(prompt) + (max_tokens or 0)
+
+
+class AsyncLLMClient:
+    def __init__(self, concurrency=LLM_CONCURRENCY, requests_per_minute=LLM_RPM, tokens_per_minute=LLM_TPM):
+        self.limiter = AdaptiveLimiter(requests_per_minute, tokens_per_minute, concurrency)
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        self.http_client = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(REQUEST_TIMEOUT, pool=None))
+        self.openai_client = AsyncOpenAI(http_client=self.http_client, max_retries=0) if openai_api_key else None
+        self.requests = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.http_client.aclose()
+
+    # Provider queries return (content, (usage, complete), None), or (None, None, (reason, headers)) for a failure
+    # worth retrying
+    async def anthropic_query(self, text, prompt, max_tokens=None, temperature=0):
+        try:
+            response = await self.http_client.post(
+                f"{ANTHROPIC_BASE_URL}/v1/messages",
+                headers=anthropic_headers(),
+                json=anthropic_request(text, prompt, max_tokens, temperature),
+            )
+        except httpx.TransportError:
+            return None, None, ("connection", {})
+        if response.status_code in RATE_LIMIT_STATUSES:
+            return None, None, ("rate_limit", response.headers)
+        if response.status_code in SERVER_ERROR_STATUSES:
+            return None, None, ("server_error", response.headers)
+        response.raise_for_status()
+        response_json = response.json()
+        if not response_json or "content" not in response_json:
+            raise Exception(f"Unexpected response format from Anthropic API: {response_json}")
+        usage = response_json.get("usage") or {}
+        complete = response_json.get("stop_reason") != "max_tokens"
+        usage = (usage.get("input_tokens", 0), usage.get("output_tokens", 0))
+        return anthropic_response_text(response_json), (usage, complete), None
+
+    async def openai_query(self, text, prompt, max_tokens=None, temperature=0):
+        try:
+            response = await self.openai_client.chat.completions.create(
+                **openai_request(prompt, text, OPENAI_INSTRUCTIONS, max_tokens, temperature)
+            )
+        except RateLimitError as e:
+            return None, None, ("rate_limit", e.response.headers)
+        except InternalServerError as e:
+            return None, None, ("server_error", e.response.headers)
+        except APIConnectionError:
+            # Timeouts included (APITimeoutError)
+            return None, None, ("connection", {})
+        if len(response.choices) != 1:
+            print("\n!!! Unexpected response from OpenAI", response)
+        complete = response.choices[0].finish_reason == "stop"
+        if not complete:
+            print("\n!!! OpenAI did not finish processing the request", response)
+        usage = (response.usage.prompt_tokens, response.usage.completion_tokens) if response.usage else None
+        return openai_response_text(response.choices[0].message.content), (usage, complete), None
+
+    async def query(self, text, prompt, max_tokens=None, temperature=0, max_retries=MAX_RETRIES, usage=None):
+        # usage, when given, is a Counter collecting this caller's requests, tokens, cache hits and truncations
+        usage = usage if usage is not None else Counter()
+        key = query_cache_key(text, prompt, max_tokens, temperature)
+        cached = response_cache.get(key)
+        metrics.increment("llm_cache", result="miss" if cached is None else "hit")
+        if cached is not None:
+            usage["cache_hits"] += 1
+            return extract_json_from_response(cached)
+
+        provider = llm_provider()
+        provider_query = self.openai_query if openai_api_key else self.anthropic_query
+        reserved = estimate_tokens(text, prompt, max_tokens)
+        for attempt in range(max_retries + 1):
+            with metrics.span("llm_limiter_wait_seconds", provider=provider):
+                await self.limiter.acquire(reserved)
+            metrics.gauge("llm_in_flight", self.limiter.in_flight, provider=provider)
+            tokens_used = None
+            try:
+                with metrics.span("llm_request_seconds", provider=provider):
+                    content, outcome, retry = await provider_query(text, prompt, max_tokens, temperature)
+                if outcome is not None:
+                    response_usage, complete = outcome
+                    self.requests += 1
+                    usage["requests"] += 1
+                    if response_usage is not None:
+                        input_tokens, output_tokens = response_usage
+                        self.input_tokens += input_tokens
+                        self.output_tokens += output_tokens
+                        usage["input_tokens"] += input_tokens
+                        usage["output_tokens"] += output_tokens
+                        tokens_used = input_tokens + output_tokens
+                        metrics.increment("llm_tokens", input_tokens, provider=provider, direction="input")
+                        metrics.increment("llm_tokens", output_tokens, provider=provider, direction="output")
+            except Exception as e:
+                metrics.increment("llm_requests", provider=provider, status="error")
+                print(f"\n!!! Error querying {llm_provider()}: {e}")
+                return None
+            finally:
+                await self.limiter.release(tokens_used, reserved)
+            metrics.increment("llm_requests", provider=provider, status="ok" if retry is None else retry[0])
+
+            if retry is None:
+                await self.limiter.succeeded()
+                if complete:
+                    response_cache.set(key, content)
+                elif max_tokens and max_tokens < MAX_OUTPUT_TOKENS:
+                    # Truncated responses are retried once per doubling of max_tokens, up to the output limit
+                    usage["truncated"] += 1
+                    metrics.increment("llm_retries", reason="truncated")
+                    max_tokens = min(max_tokens * 2, MAX_OUTPUT_TOKENS)
+                    reserved = estimate_tokens(text, prompt, max_tokens)
+                    # The longer answer is cached under the request that produced it; a re-run finds it there after
+                    # its own truncated first attempt
+                    key = query_cache_key(text, prompt, max_tokens, temperature)
+                    cached = response_cache.get(key)
+                    metrics.increment("llm_cache", result="miss" if cached is None else "hit")
+                    if cached is not None:
+                        usage["cache_hits"] += 1
+                        return extract_json_from_response(cached)
+                    print(f"\n{llm_provider()} response truncated. Retrying with max_tokens={max_tokens}")
+                    continue
+                return extract_json_from_response(content)
+
+            reason, headers = retry
+            wait_time = retry_after_seconds(headers, attempt, reason)
+            metrics.increment("llm_retries", reason=reason)
+            metrics.increment("llm_backoff_seconds", wait_time)
+            print(
+                f"\n{llm_provider()} {RETRY_MESSAGES[reason]}. Retrying in {wait_time:.2f}s... "
+                f"({attempt + 1}/{max_retries})"
+            )
+            # Only rate limits pause every request and halve the concurrency; a server error or dropped connection
+            # says nothing about the quota, so just this request backs off
+            if reason == "rate_limit":
+                await self.limiter.throttle(wait_time)
+            else:
+                await asyncio.sleep(wait_time)
+
+        print(f"\n!!! Max retries ({max_retries}) exceeded for {llm_provider()} query")
+        return None
+
+
 def extract_json_from_response(response_str):
     if not response_str:
         print("\n!!! Empty response from LLM")
@@ -149,8 +420,7 @@ def extract_json_from_response(response_str):
 
 def query_llm(text, prompt, max_tokens=None, temperature=0):
     if openai_api_key:
-        instructions = "Extract exactly the data requested in the specified JSON format. Return ONLY valid JSON."
-        res = openai_query(prompt, text, instructions, max_tokens, temperature)
+        res = openai_query(prompt, text, OPENAI_INSTRUCTIONS, max_tokens, temperature)
     elif anthropic_api_key:
         res = anthropic_query(text, prompt, max_tokens, temperature, max_retries=MAX_RETRIES)
     else:
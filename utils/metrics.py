@@ -0,0 +1,243 @@
+import bisect
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(os.path.dirname(__file__), "..", "store/metrics"))
+METRICS_PREFIX = "mactutor_"
+TRACE = os.environ.get("METRICS_TRACE", "").lower() in ("1", "true", "yes")
+TRACE_SLOWEST = int(os.environ.get("METRICS_TRACE_SLOWEST", 20))
+
+# Upper bounds in seconds, from a markdown parse up to an LLM call stuck behind retries
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+QUANTILES = (0.5, 0.9, 0.99)
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def label_text(key, extra=()):
+    pairs = [*key, *extra]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}" if pairs else ""
+
+
+class Metrics:
+    # Counters, gauges, latency histograms and the slowest spans of one process. Worker processes start empty after the
+    # fork and hand what they recorded back to the parent through drain/absorb
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.spans = {}
+        self.pid = os.getpid()
+
+    def owned(self):
+        # Called with the lock held: a forked worker must not report the parent's numbers as its own
+        if self.pid != os.getpid():
+            self.reset()
+
+    def increment(self, name, amount=1, **labels):
+        with self.lock:
+            self.owned()
+            key = (name, label_key(labels))
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, value, **labels):
+        # The peak is kept next to the last value, which is what matters for queue depths
+        with self.lock:
+            self.owned()
+            key = (name, label_key(labels))
+            peak = self.gauges.get(key, (value, value))[1]
+            self.gauges[key] = (value, max(peak, value))
+
+    def observe(self, name, seconds, **labels):
+        with self.lock:
+            self.owned()
+            key = (name, label_key(labels))
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * (len(LATENCY_BUCKETS) + 1), "sum": 0, "max": 0}
+            histogram["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def span(self, name, item=None, **labels):
+        # A timer that, with METRICS_TRACE on, also keeps the slowest items per span name together with the time spent
+        # in the spans nested inside them (LLM calls within an extraction, retries within a fetch)
+        if not TRACE:
+            with self.timer(name, **labels):
+                yield
+            return
+        parent = current_span.get()
+        record = {"name": name, "item": item, "labels": dict(labels), "children": []}
+        token = current_span.set(record)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            current_span.reset(token)
+            self.observe(name, seconds, **labels)
+            record["seconds"] = round(seconds, 6)
+            if parent is not None:
+                parent["children"].append(record)
+            else:
+                self.keep_span(record)
+
+    def keep_span(self, record):
+        with self.lock:
+            self.owned()
+            slowest = self.spans.setdefault(record["name"], [])
+            entry = (record["seconds"], next(self.sequence), record)
+            if len(slowest) < TRACE_SLOWEST:
+                heapq.heappush(slowest, entry)
+            else:
+                heapq.heappushpop(slowest, entry)
+
+    def snapshot(self):
+        with self.lock:
+            self.owned()
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {
+                    key: {**value, "buckets": list(value["buckets"])} for key, value in self.histograms.items()
+                },
+                "spans": [entry[2] for slowest in self.spans.values() for entry in slowest],
+            }
+
+    def drain(self):
+        snapshot = self.snapshot()
+        with self.lock:
+            self.reset()
+        return snapshot
+
+    def absorb(self, snapshot):
+        with self.lock:
+            self.owned()
+            for key, amount in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + amount
+            for key, (value, peak) in snapshot["gauges"].items():
+                self.gauges[key] = (value, max(peak, self.gauges.get(key, (value, peak))[1]))
+            for key, other in snapshot["histograms"].items():
+                histogram = self.histograms.setdefault(
+                    key, {"buckets": [0] * (len(LATENCY_BUCKETS) + 1), "sum": 0, "max": 0}
+                )
+                histogram["buckets"] = [mine + theirs for mine, theirs in zip(histogram["buckets"], other["buckets"])]
+                histogram["sum"] += other["sum"]
+                histogram["max"] = max(histogram["max"], other["max"])
+        for record in snapshot["spans"]:
+            self.keep_span(record)
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        for kind, series in (("counter", snapshot["counters"]), ("gauge", snapshot["gauges"])):
+            for name in sorted({name for name, _ in series}):
+                metric = METRICS_PREFIX + name + ("_total" if kind == "counter" else "")
+                lines.append(f"# TYPE {metric} {kind}")
+                for (series_name, labels), value in sorted(series.items()):
+                    if series_name == name:
+                        lines.append(f"{metric}{label_text(labels)} {value[0] if kind == 'gauge' else value}")
+                if kind == "gauge":
+                    lines.append(f"# TYPE {metric}_peak gauge")
+                    for (series_name, labels), (_, peak) in sorted(series.items()):
+                        if series_name == name:
+                            lines.append(f"{metric}_peak{label_text(labels)} {peak}")
+        for name in sorted({name for name, _ in snapshot["histograms"]}):
+            metric = METRICS_PREFIX + name
+            lines.append(f"# TYPE {metric} histogram")
+            for (series_name, labels), histogram in sorted(snapshot["histograms"].items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram["buckets"]):
+                    cumulative += count
+                    lines.append(f"{metric}_bucket{label_text(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{metric}_sum{label_text(labels)} {histogram['sum']:.6f}")
+                lines.append(f"{metric}_count{label_text(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        # Quantiles are read off the buckets, as Prometheus would, and capped at the largest value seen
+        snapshot = self.snapshot()
+        histograms = []
+        for (name, labels), histogram in sorted(snapshot["histograms"].items()):
+            count = sum(histogram["buckets"])
+            entry = {"name": name, "labels": dict(labels), "count": count, "sum": round(histogram["sum"], 6)}
+            entry["mean"] = round(histogram["sum"] / count, 6) if count else None
+            entry["max"] = round(histogram["max"], 6)
+            for q in QUANTILES:
+                rank = q * count
+                cumulative = 0
+                for bound, bucket in zip(LATENCY_BUCKETS + (histogram["max"],), histogram["buckets"]):
+                    cumulative += bucket
+                    if cumulative >= rank:
+                        break
+                entry[f"p{round(q * 100)}"] = min(bound, histogram["max"]) if count else None
+            histograms.append(entry)
+        spans = sorted(snapshot["spans"], key=lambda record: -record["seconds"])
+        return {
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(snapshot["counters"].items())
+            ],
+            "gauges": [
+                {"name": name, "labels": dict(labels), "value": value, "peak": peak}
+                for (name, labels), (value, peak) in sorted(snapshot["gauges"].items())
+            ],
+            "histograms": histograms,
+            "slowest": spans,
+        }
+
+
+metrics = Metrics()
+
+
+def run_measured(function, *args):
+    # Runs in a worker process and returns what the call recorded along with its result, for the parent to absorb
+    return function(*args), metrics.drain()
+
+
+def absorb_measured(results):
+    for result, snapshot in results:
+        metrics.absorb(snapshot)
+        yield result
+
+
+def write_metrics(run):
+    # A Prometheus text file for node_exporter's textfile collector or a pushgateway, and a JSON summary of the run
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    summary = {"run": run, "timestamp": int(time.time()), **metrics.summary()}
+    paths = []
+    for extension, content in (("prom", metrics.prometheus()), ("json", json.dumps(summary, indent=4))):
+        path = os.path.join(METRICS_DIR, f"{run}.{extension}")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        paths.append(path)
+    print(f"Metrics written to {paths[0]} and {paths[1]}")
+    return paths
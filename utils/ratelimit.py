@@ -0,0 +1,123 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount):
+        # Requests larger than the whole bucket are let through once it is full instead of waiting forever
+        self.refill()
+        amount = min(amount, self.capacity)
+        return 0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+
+class AdaptiveLimiter:
+    # Shared by every request in the event loop: requests/tokens per minute budgets plus an AIMD concurrency limit
+    # that halves on rate-limit responses and grows back by one slot per window of successes
+    def __init__(self, requests_per_minute, tokens_per_minute, max_concurrency, min_concurrency=1):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.cooldown_until = 0
+        self.throttled = 0
+        self.condition = asyncio.Condition()
+        self.gate = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        # Requests queue on the gate in arrival order and only the head one waits on the condition, so a release wakes
+        # one waiter instead of every queued request
+        async with self.gate, self.condition:
+            while True:
+                wait = max(0, self.cooldown_until - time.monotonic())
+                if not wait and self.requests:
+                    wait = self.requests.delay(1)
+                if not wait and self.tokens:
+                    wait = self.tokens.delay(tokens)
+                if not wait and self.in_flight < self.concurrency:
+                    break
+                try:
+                    await asyncio.wait_for(self.condition.wait(), timeout=wait or None)
+                except TimeoutError:
+                    pass
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(tokens)
+            self.in_flight += 1
+
+    async def release(self, tokens_used=None, tokens_reserved=0):
+        async with self.condition:
+            self.in_flight -= 1
+            if self.tokens and tokens_used is not None:
+                # Give back what the estimate over-reserved
+                self.tokens.tokens = min(self.tokens.capacity, self.tokens.tokens + tokens_reserved - tokens_used)
+            self.condition.notify_all()
+
+    async def succeeded(self):
+        async with self.condition:
+            self.successes += 1
+            if self.successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    async def throttle(self, retry_after):
+        async with self.condition:
+            self.throttled += 1
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+            self.successes = 0
+            self.cooldown_until = max(self.cooldown_until, time.monotonic() + retry_after)
+
+
+class AdaptiveRate:
+    # Thread-safe counterpart for blocking clients: a per-second budget that grows additively after each success and
+    # halves on quota errors
+    def __init__(self, per_second, min_per_second=1, max_per_second=None, increase=None):
+        self.rate = per_second
+        self.min_rate = min_per_second
+        self.max_rate = max_per_second or per_second * 10
+        self.increase = increase or per_second / 10
+        self.allowance = per_second
+        self.updated = time.monotonic()
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, amount):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.allowance = min(max(self.rate, amount), self.allowance + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.allowance >= amount:
+                    self.allowance -= amount
+                    return
+                wait = (amount - self.allowance) / self.rate
+            time.sleep(wait)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttle(self):
+        with self.lock:
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.allowance = min(self.allowance, 0)
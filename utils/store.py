@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+STORE_DIR = os.path.join(os.path.dirname(__file__), "..", "store")
+STORE_BACKEND = os.environ.get("CORPUS_STORE", "sqlite").lower()
+STORE_BACKENDS = ("sqlite", "files")
+DATABASE_FILENAME = "corpus.sqlite"
+MMAP_BYTES = int(os.environ.get("CORPUS_STORE_MMAP_MB", 256)) * 1024 * 1024
+QUERY_BATCH = 500
+
+# Directory layout of the files backend, which is also what the import/export bridge reads and writes
+COLLECTIONS = {"md": ("md", ".md"), "l1": ("json/l1", ".json"), "l2": ("json/l2", ".json")}
+
+if STORE_BACKEND not in STORE_BACKENDS:
+    raise Exception(f"Unknown CORPUS_STORE {STORE_BACKEND}, expected one of {', '.join(STORE_BACKENDS)}")
+
+
+def content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def is_json(collection):
+    return COLLECTIONS[collection][1] == ".json"
+
+
+class CorpusStore:
+    # Documents are text keyed by collection and id (the file name without extension); JSON collections go through
+    # load/dump so each backend picks its own formatting
+    indent = None
+
+    def dump(self, document):
+        return json.dumps(document, indent=self.indent, ensure_ascii=False)
+
+    def get(self, collection, key):
+        return self.get_many(collection, [key]).get(key)
+
+    def load(self, collection, key):
+        content = self.get(collection, key)
+        return None if content is None else json.loads(content)
+
+    def put(self, collection, key, content):
+        return self.put_many(collection, [(key, content)]) == 1
+
+
+class SqliteStore(CorpusStore):
+    # The whole corpus in one WAL-mode database read through a memory map, written in one transaction per bulk write
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def __reduce__(self):
+        # Handed to worker processes by path; each process opens its own connection
+        return SqliteStore, (self.path,)
+
+    def connect(self):
+        # One connection per thread, and worker processes must not share a connection opened before the fork
+        if getattr(self.local, "connection", None) is None or self.local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"PRAGMA mmap_size={MMAP_BYTES}")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS documents (collection TEXT NOT NULL, key TEXT NOT NULL, "
+                "content TEXT NOT NULL, hash TEXT NOT NULL, PRIMARY KEY (collection, key))"
+            )
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def get_many(self, collection, keys):
+        connection = self.connect()
+        keys = list(keys)
+        documents = {}
+        for start in range(0, len(keys), QUERY_BATCH):
+            batch = keys[start : start + QUERY_BATCH]
+            placeholders = ", ".join("?" * len(batch))
+            query = f"SELECT key, content FROM documents WHERE collection = ? AND key IN ({placeholders})"
+            documents.update(connection.execute(query, (collection, *batch)))
+        return documents
+
+    def items(self, collection, keys=None):
+        if keys is not None:
+            documents = self.get_many(collection, keys)
+            yield from sorted(documents.items())
+            return
+        yield from self.connect().execute(
+            "SELECT key, content FROM documents WHERE collection = ? ORDER BY key", (collection,)
+        )
+
+    def keys(self, collection):
+        rows = self.connect().execute("SELECT key FROM documents WHERE collection = ? ORDER BY key", (collection,))
+        return [key for key, in rows]
+
+    def exists(self, collection, key):
+        query = "SELECT 1 FROM documents WHERE collection = ? AND key = ?"
+        return self.connect().execute(query, (collection, key)).fetchone() is not None
+
+    def hashes(self, collection):
+        return dict(self.connect().execute("SELECT key, hash FROM documents WHERE collection = ?", (collection,)))
+
+    def sizes(self, collection):
+        # UTF-8 bytes of every document
+        query = "SELECT key, length(CAST(content AS BLOB)) FROM documents WHERE collection = ?"
+        return dict(self.connect().execute(query, (collection,)))
+
+    def put_many(self, collection, items):
+        # Unchanged documents are left alone, so the count is what was actually written
+        connection = self.connect()
+        changes = connection.total_changes
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT INTO documents (collection, key, content, hash) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (collection, key) DO UPDATE SET content = excluded.content, hash = excluded.hash "
+                "WHERE hash != excluded.hash",
+                ((collection, key, content, content_hash(content)) for key, content in items),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return connection.total_changes - changes
+
+    def delete(self, collection, keys):
+        connection = self.connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "DELETE FROM documents WHERE collection = ? AND key = ?", ((collection, key) for key in keys)
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+
+class DirectoryStore(CorpusStore):
+    # One pretty-printed file per document, the layout every stage used before the consolidated store
+    indent = 4
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, collection, key):
+        directory, extension = COLLECTIONS[collection]
+        return os.path.join(self.root, directory, f"{key}{extension}")
+
+    def get_many(self, collection, keys):
+        documents = {}
+        for key in keys:
+            try:
+                with open(self.path(collection, key), "r", encoding="utf-8") as f:
+                    documents[key] = f.read()
+            except FileNotFoundError:
+                pass
+        return documents
+
+    def items(self, collection, keys=None):
+        for key in sorted(self.keys(collection) if keys is None else keys):
+            content = self.get(collection, key)
+            if content is not None:
+                yield key, content
+
+    def keys(self, collection):
+        directory, extension = COLLECTIONS[collection]
+        if not os.path.isdir(os.path.join(self.root, directory)):
+            return []
+        filenames = os.listdir(os.path.join(self.root, directory))
+        return sorted(filename[: -len(extension)] for filename in filenames if filename.endswith(extension))
+
+    def exists(self, collection, key):
+        return os.path.exists(self.path(collection, key))
+
+    def hashes(self, collection):
+        return {key: content_hash(content) for key, content in self.items(collection)}
+
+    def sizes(self, collection):
+        return {key: os.path.getsize(self.path(collection, key)) for key in self.keys(collection)}
+
+    def put_many(self, collection, items):
+        os.makedirs(os.path.dirname(self.path(collection, "_")), exist_ok=True)
+        written = 0
+        for key, content in items:
+            if self.get(collection, key) != content:
+                with open(self.path(collection, key), "w", encoding="utf-8") as f:
+                    f.write(content)
+                written += 1
+        return written
+
+    def delete(self, collection, keys):
+        for key in keys:
+            if self.exists(collection, key):
+                os.remove(self.path(collection, key))
+
+
+def open_store(root=STORE_DIR, backend=STORE_BACKEND):
+    if backend == "files":
+        return DirectoryStore(root)
+    return SqliteStore(os.path.join(root, DATABASE_FILENAME))
+
+
+def copy_collections(source, target, collections=tuple(COLLECTIONS)):
+    # JSON documents are re-serialised so each side keeps its own formatting
+    copied = {}
+    for collection in collections:
+        batch = []
+        copied[collection] = 0
+        for key, content in source.items(collection):
+            batch.append((key, target.dump(json.loads(content)) if is_json(collection) else content))
+            if len(batch) == QUERY_BATCH:
+                copied[collection] += target.put_many(collection, batch)
+                batch = []
+        copied[collection] += target.put_many(collection, batch)
+    return copied
+
+
+def import_directory(store, root=STORE_DIR):
+    return copy_collections(DirectoryStore(root), store)
+
+
+def export_directory(store, root=STORE_DIR):
+    return copy_collections(store, DirectoryStore(root))
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    directory = sys.argv[2] if len(sys.argv) > 2 else STORE_DIR
+    store = open_store(backend="sqlite")
+    if command == "import":
+        copied = import_directory(store, directory)
+    elif command == "export":
+        copied = export_directory(store, directory)
+    else:
+        raise Exception("Usage: python -m utils.store import|export [directory]")
+    print(", ".join(f"{collection}: {count} written" for collection, count in copied.items()))
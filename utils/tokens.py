@@ -0,0 +1,35 @@
+CHARS_PER_TOKEN = 4
+
+
+def count_tokens(text):
+    # Approximation of the provider tokenizers, close enough for budgeting English markdown
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def split_line(line, max_chars):
+    while len(line) > max_chars:
+        cut = line.rfind(" ", 0, max_chars)
+        end = cut + 1 if cut > 0 else max_chars
+        yield line[:end]
+        line = line[end:]
+    if line:
+        yield line
+
+
+def split_text(text, max_tokens):
+    # Greedy packing of whole lines into chunks of at most max_tokens, splitting oversized lines at spaces
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunks = []
+    current = []
+    size = 0
+    for line in text.splitlines(keepends=True):
+        for piece in split_line(line, max_chars):
+            if current and size + len(piece) > max_chars:
+                chunks.append("".join(current))
+                current = []
+                size = 0
+            current.append(piece)
+            size += len(piece)
+    if current:
+        chunks.append("".join(current))
+    return chunks or [""]